@@ -0,0 +1,146 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+
+from database import DB_POOL_SIZE, DB_MAX_OVERFLOW
+from metrics import admission_wait, admission_rejected
+
+
+# Классы приоритета: меньше — важнее. Запись сообщений обслуживается первой,
+# история и прочие запросы — следом, присутствие (online/last_seen) — почти
+# последним: его потеря почти незаметна. Фоновая очистка — самая последняя.
+PRIORITIES = {
+    "write": 0,
+    "history": 1,
+    "default": 1,
+    "presence": 2,
+    "maintenance": 3,
+}
+
+# Сколько секунд запрос каждого класса может ждать в очереди, прежде чем получить отказ
+DEFAULT_BUDGETS = {
+    "write": 2.0,
+    "history": 1.0,
+    "default": 1.0,
+    "presence": 0.25,
+    "maintenance": 0.1,
+}
+
+QUEUE_BUDGETS = {
+    name: float(os.getenv(f"ADMISSION_BUDGET_{name.upper()}", default))
+    for name, default in DEFAULT_BUDGETS.items()
+}
+
+# Одновременных сессий не больше, чем соединений в пуле
+ADMISSION_LIMIT = int(os.getenv("ADMISSION_LIMIT", str(DB_POOL_SIZE + DB_MAX_OVERFLOW)))
+# Длиннее этой очереди не ждём вовсе — сразу отказ
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "1000"))
+
+
+class Overloaded(Exception):
+    """БД перегружена: повторить через retry_after секунд"""
+
+    def __init__(self, priority: str, retry_after: float):
+        super().__init__(f"Database overloaded ({priority}), retry after {retry_after:.1f}s")
+        self.priority = priority
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Ограничивает число одновременных сессий БД и выбирает, кого пустить первым.
+
+    Пока есть свободные места — пускает сразу. Когда всё занято, запросы ждут
+    в очереди по приоритету; кто не дождался своего бюджета — получает Overloaded
+    с оценкой, когда стоит повторить, вместо бесконечного ожидания пула.
+    """
+
+    def __init__(self, limit: int = ADMISSION_LIMIT, budgets: dict[str, float] = QUEUE_BUDGETS,
+                 max_queue: int = ADMISSION_MAX_QUEUE):
+        self.limit = limit
+        self.budgets = budgets
+        self.max_queue = max_queue
+        self.in_use = 0
+        self.waiters: list[tuple[int, int, asyncio.Future]] = []  # куча (приоритет, номер, future)
+        self.queued: dict[str, int] = {name: 0 for name in PRIORITIES}
+        self._order = itertools.count()
+        self.hold_time = 0.05  # скользящее среднее времени работы с БД, сек
+
+    def retry_after(self) -> float:
+        """Примерно через сколько очередь рассосётся"""
+        waiting = len(self.waiters) + 1
+        return max(0.5, round(self.hold_time * waiting / max(self.limit, 1), 1))
+
+    async def acquire(self, priority: str):
+        if self.in_use < self.limit and not self.waiters:
+            self.in_use += 1
+            admission_wait.observe(0.0, priority)
+            return
+
+        if len(self.waiters) >= self.max_queue:
+            admission_rejected.inc(priority, "queue_full")
+            raise Overloaded(priority, self.retry_after())
+
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (PRIORITIES[priority], next(self._order), future))
+        self.queued[priority] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.budgets[priority])
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # Место выдали в последний момент — берём его
+                admission_wait.observe(time.monotonic() - started, priority)
+                return
+            self._forget(future)
+            admission_rejected.inc(priority, "timeout")
+            raise Overloaded(priority, self.retry_after())
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                self._forget(future)
+            raise
+        finally:
+            self.queued[priority] -= 1
+        admission_wait.observe(time.monotonic() - started, priority)
+
+    def _forget(self, future: asyncio.Future):
+        future.cancel()
+        self.waiters = [waiter for waiter in self.waiters if waiter[2] is not future]
+        heapq.heapify(self.waiters)
+
+    def release(self):
+        # Место переходит следующему живому ожидающему, не освобождаясь
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_use -= 1
+
+    @asynccontextmanager
+    async def admit(self, priority: str):
+        """async with admission.admit("write"), async_session_factory() as session: ..."""
+        await self.acquire(priority)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.hold_time = self.hold_time * 0.9 + (time.monotonic() - started) * 0.1
+            self.release()
+
+
+def overloaded_frame(retry_after: float) -> dict:
+    """Ошибка для клиента WebSocket: сервер перегружен"""
+    return {
+        "type": "error",
+        "code": "overloaded",
+        "detail": "Сервер перегружен, попробуйте позже",
+        "retry_after_ms": int(retry_after * 1000) + 1
+    }
+
+
+admission = AdmissionController()
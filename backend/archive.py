@@ -0,0 +1,208 @@
+import asyncio
+import gzip
+import json
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Iterator
+
+from sqlalchemy import select, delete, func, and_
+
+from models import Message, MessageArchive
+from leases import acquire_lease, release_lease
+
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+MESSAGE_HOT_DAYS = int(os.getenv("MESSAGE_HOT_DAYS", "90"))
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+ARCHIVE_BATCH_CHATS = int(os.getenv("ARCHIVE_BATCH_CHATS", "100"))
+ARCHIVE_PAUSE_SECONDS = float(os.getenv("ARCHIVE_PAUSE_SECONDS", "1"))
+# Аренда архивации: пока её держит один воркер, остальные пропускают проход
+ARCHIVE_LEASE_SECONDS = int(os.getenv("ARCHIVE_LEASE_SECONDS", "600"))
+
+
+class SegmentMissing(Exception):
+    """Сегмент записан в БД, но его файла на этом хосте нет"""
+
+
+def _month_bounds(dt: datetime) -> tuple[datetime, datetime]:
+    start = dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = (start + timedelta(days=32)).replace(day=1)
+    return start, end
+
+
+def _serialize(msg: Message) -> dict:
+    return {
+        "id": msg.id,
+        "seq": msg.seq,
+        "chat_id": msg.chat_id,
+        "sender_id": msg.sender_id,
+        "text": msg.text,
+        "image_url": msg.image_url,
+        "created_at": msg.created_at.isoformat(),
+        "is_read": bool(msg.is_read),
+    }
+
+
+def _write_segment(path: str, rows: list[dict]):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Своё имя временного файла: недописанный сегмент никто не подменит
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False))
+                f.write("\n")
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def iter_segment(path: str) -> Iterator[dict]:
+    """Строки сегмента по одной — месяц целиком в памяти не держим"""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            row = json.loads(line)
+            row["created_at"] = datetime.fromisoformat(row["created_at"])
+            yield row
+
+
+def read_segment(path: str) -> list[dict]:
+    return list(iter_segment(path))
+
+
+async def _archive_chat_period(session_factory, chat_id: int, start: datetime, end: datetime) -> int:
+    """Перенести сообщения одного чата за месяц в сжатый файл"""
+    period = start.strftime("%Y-%m")
+
+    async with session_factory() as session:
+        in_period = and_(
+            Message.chat_id == chat_id,
+            Message.created_at >= start,
+            Message.created_at < end
+        )
+        result = await session.execute(
+            select(Message).where(in_period).order_by(Message.created_at, Message.id)
+        )
+        rows = [_serialize(m) for m in result.scalars()]
+        if not rows:
+            return 0
+
+        segment_query = select(MessageArchive).where(
+            and_(MessageArchive.chat_id == chat_id, MessageArchive.period == period)
+        )
+        segment = (await session.execute(segment_query)).scalar_one_or_none()
+
+        # Сегмент уже есть (например, после сбоя) — сливаем без дублей
+        if segment:
+            if not os.path.exists(segment.path):
+                # Файл на другом хосте: перезапись потеряла бы его сообщения
+                raise SegmentMissing(segment.path)
+            existing = await asyncio.to_thread(read_segment, segment.path)
+            for row in existing:
+                row["created_at"] = row["created_at"].isoformat()
+            known_ids = {row["id"] for row in rows}
+            rows = [row for row in existing if row["id"] not in known_ids] + rows
+            rows.sort(key=lambda row: (row["created_at"], row["id"]))
+
+        path = os.path.join(ARCHIVE_DIR, period, f"chat_{chat_id}.jsonl.gz")
+        await asyncio.to_thread(_write_segment, path, rows)
+
+        if not segment:
+            segment = MessageArchive(chat_id=chat_id, period=period)
+            session.add(segment)
+        segment.path = path
+        segment.messages_count = len(rows)
+        segment.first_message_at = datetime.fromisoformat(rows[0]["created_at"])
+        segment.last_message_at = datetime.fromisoformat(rows[-1]["created_at"])
+
+        max_id = max(row["id"] for row in rows)
+        await session.execute(delete(Message).where(and_(in_period, Message.id <= max_id)))
+        await session.commit()
+
+    return len(rows)
+
+
+async def archive_oldest_month(session_factory) -> int:
+    """Заархивировать часть самого старого месяца, целиком вышедшего за горизонт.
+
+    Возвращает число перенесённых сообщений (0 — архивировать нечего).
+    """
+    cutoff = datetime.utcnow() - timedelta(days=MESSAGE_HOT_DAYS)
+
+    async with session_factory() as session:
+        oldest = (await session.execute(select(func.min(Message.created_at)))).scalar()
+        if oldest is None:
+            return 0
+
+        start, end = _month_bounds(oldest)
+        if end > cutoff:
+            return 0
+
+        chats_query = (
+            select(Message.chat_id)
+            .where(and_(Message.created_at >= start, Message.created_at < end))
+            .distinct()
+            .limit(ARCHIVE_BATCH_CHATS)
+        )
+        chat_ids = (await session.execute(chats_query)).scalars().all()
+
+    moved = 0
+    for chat_id in chat_ids:
+        try:
+            moved += await _archive_chat_period(session_factory, chat_id, start, end)
+        except SegmentMissing as e:
+            print(f"Archive segment missing, chat {chat_id} skipped: {e}")
+        await asyncio.sleep(0)
+    return moved
+
+
+async def archive_loop(session_factory):
+    """Фоновая задача: периодически переносит старые месяцы в архив.
+
+    Запускается в каждом воркере, но архивирует только тот, кто взял аренду:
+    два воркера на одном месяце перезаписали бы сегменты друг друга.
+    """
+    while True:
+        try:
+            if await acquire_lease(session_factory, "archive", ARCHIVE_LEASE_SECONDS):
+                try:
+                    while await archive_oldest_month(session_factory):
+                        # Пауза между пачками, чтобы не мешать чату
+                        await asyncio.sleep(ARCHIVE_PAUSE_SECONDS)
+                        if not await acquire_lease(session_factory, "archive", ARCHIVE_LEASE_SECONDS):
+                            break  # Аренда истекла и досталась другому
+                finally:
+                    await release_lease(session_factory, "archive")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Archive error: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+
+async def read_archived_messages(session, chat_id: int, offset: int, limit: int) -> list[dict]:
+    """Архивные сообщения чата, от новых к старым"""
+    query = (
+        select(MessageArchive)
+        .where(MessageArchive.chat_id == chat_id)
+        .order_by(MessageArchive.period.desc())
+    )
+    segments = (await session.execute(query)).scalars().all()
+
+    result = []
+    for segment in segments:
+        if len(result) >= limit:
+            break
+        if offset >= segment.messages_count:
+            offset -= segment.messages_count
+            continue
+
+        rows = await asyncio.to_thread(read_segment, segment.path)
+        rows.reverse()
+        result.extend(rows[offset:offset + limit - len(result)])
+        offset = 0
+
+    return result
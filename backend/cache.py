@@ -0,0 +1,190 @@
+import functools
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Callable, Optional
+
+
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+# Общий кэш для нескольких воркеров (нужен пакет redis). Без него кэш — в памяти процесса
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL")
+# Число воркеров uvicorn/gunicorn: при нескольких кэш в памяти разошёлся бы между ними
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+
+class CacheBackend(ABC):
+    """Хранилище кэша.
+
+    MemoryCacheBackend — кэш своего процесса, RedisCacheBackend — общий
+    для всех воркеров: инвалидация в одном видна остальным сразу.
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: str, ttl: float, tags: list[str]):
+        ...
+
+    @abstractmethod
+    async def invalidate(self, *tags: str):
+        ...
+
+    async def close(self):
+        pass
+
+
+class MemoryCacheBackend(CacheBackend):
+    """LRU в памяти процесса с TTL и тегами"""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self.entries: OrderedDict[str, tuple[float, str, list[str]]] = OrderedDict()
+        self.tags: dict[str, set[str]] = {}
+        self.max_entries = max_entries
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value, _ = entry
+        if expires_at < time.monotonic():
+            self._drop(key)
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: float, tags: list[str]):
+        if key in self.entries:
+            self._drop(key)
+        self.entries[key] = (time.monotonic() + ttl, value, tags)
+        for tag in tags:
+            self.tags.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.max_entries:
+            self._drop(next(iter(self.entries)))
+
+    async def invalidate(self, *tags: str):
+        for tag in tags:
+            for key in self.tags.pop(tag, ()):
+                self._drop(key)
+
+    def _drop(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+
+class RedisCacheBackend(CacheBackend):
+    """Кэш в Redis: значение — SETEX, тег — множество ключей.
+
+    Недоступный Redis не ломает ручки: чтение считается промахом, запись
+    пропускается. Неудавшаяся инвалидация пишется в лог — ответ устареет
+    не дольше ttl.
+    """
+
+    PREFIX = "omega:cache:"
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis  # Необязательная зависимость — только для этого бэкенда
+        self.errors = redis.RedisError
+        self.client = redis.from_url(url, decode_responses=True)
+
+    async def get(self, key: str) -> Optional[str]:
+        try:
+            return await self.client.get(self.PREFIX + key)
+        except self.errors as e:
+            print(f"Cache get error: {e}")
+            return None
+
+    async def set(self, key: str, value: str, ttl: float, tags: list[str]):
+        seconds = max(1, int(ttl))
+        try:
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.setex(self.PREFIX + key, seconds, value)
+                for tag in tags:
+                    # Множество тега живёт не меньше своих ключей (ttl у ручек с общим тегом одинаков)
+                    pipe.sadd(self.PREFIX + "tag:" + tag, self.PREFIX + key)
+                    pipe.expire(self.PREFIX + "tag:" + tag, seconds)
+                await pipe.execute()
+        except self.errors as e:
+            print(f"Cache set error: {e}")
+
+    async def invalidate(self, *tags: str):
+        try:
+            for tag in tags:
+                tag_key = self.PREFIX + "tag:" + tag
+                keys = await self.client.smembers(tag_key)
+                await self.client.delete(tag_key, *keys)
+        except self.errors as e:
+            print(f"Cache invalidate error: {e}")
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def make_backend() -> CacheBackend:
+    if CACHE_REDIS_URL:
+        return RedisCacheBackend(CACHE_REDIS_URL)
+    return MemoryCacheBackend()
+
+
+class ResponseCache:
+    def __init__(self, backend: CacheBackend, enabled: bool = CACHE_ENABLED):
+        self.backend = backend
+        self.enabled = enabled
+
+    def cached(self, ttl: float, tags: Callable = None, per_user: bool = False):
+        """Кэшировать ответ ручки на ttl секунд.
+
+        tags(result, **kwargs) -> список тегов для инвалидации.
+        per_user — добавить в ключ id вызывающего (если ответ от него зависит).
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(**kwargs):
+                if not self.enabled:
+                    return await func(**kwargs)
+
+                key_parts = {k: v for k, v in kwargs.items() if k != "current_user"}
+                if per_user:
+                    key_parts["caller"] = kwargs["current_user"]["id"]
+                key = f"{func.__name__}:{json.dumps(key_parts, sort_keys=True, default=str)}"
+
+                hit = await self.backend.get(key)
+                if hit is not None:
+                    return json.loads(hit)
+
+                result = await func(**kwargs)
+                entry_tags = tags(result, **kwargs) if tags else []
+                await self.backend.set(key, json.dumps(result, default=str), ttl, entry_tags)
+                return result
+
+            return wrapper
+        return decorator
+
+    async def invalidate(self, *tags: str):
+        if self.enabled:
+            await self.backend.invalidate(*tags)
+
+    async def close(self):
+        await self.backend.close()
+
+
+def _cache_enabled() -> bool:
+    if CACHE_ENABLED and WEB_CONCURRENCY > 1 and not CACHE_REDIS_URL:
+        # Инвалидация в одном воркере не дошла бы до остальных
+        print(f"Response cache disabled: WEB_CONCURRENCY={WEB_CONCURRENCY} needs CACHE_REDIS_URL")
+        return False
+    return CACHE_ENABLED
+
+
+response_cache = ResponseCache(make_backend(), _cache_enabled())
@@ -0,0 +1,49 @@
+import os
+import zlib
+
+from fastapi import WebSocket
+
+
+# Клиент, который умеет распаковывать кадры, передаёт этот подпротокол
+# в Sec-WebSocket-Protocol. Тогда крупные сообщения приходят бинарными
+# кадрами (raw deflate от UTF-8 JSON), мелкие — как раньше, текстом.
+WS_DEFLATE_SUBPROTOCOL = "omega.deflate"
+
+WS_COMPRESSION_THRESHOLD = int(os.getenv("WS_COMPRESSION_THRESHOLD", "512"))
+WS_COMPRESSION_LEVEL = int(os.getenv("WS_COMPRESSION_LEVEL", "6"))
+
+# Включено ли в сервере расширение permessage-deflate (у uvicorn по умолчанию да,
+# выключается флагом --ws-per-message-deflate false). Если клиент его предложил,
+# кадры сжимает сам протокол — второй раз omega.deflate их не жмёт.
+WS_PER_MESSAGE_DEFLATE = os.getenv("WS_PER_MESSAGE_DEFLATE", "true").lower() in ("1", "true", "yes", "on")
+
+HTTP_GZIP_MIN_SIZE = int(os.getenv("HTTP_GZIP_MIN_SIZE", "1024"))
+HTTP_GZIP_LEVEL = int(os.getenv("HTTP_GZIP_LEVEL", "5"))
+
+
+def offers_permessage_deflate(websocket: WebSocket) -> bool:
+    """Клиент предложил расширение permessage-deflate в Sec-WebSocket-Extensions"""
+    for name, value in websocket.scope.get("headers", []):
+        if name == b"sec-websocket-extensions" and b"permessage-deflate" in value.lower():
+            return True
+    return False
+
+
+def wants_deflate(websocket: WebSocket) -> bool:
+    if WS_DEFLATE_SUBPROTOCOL not in websocket.scope.get("subprotocols", []):
+        return False
+    # Расширение будет согласовано — сжатие в приложении дало бы двойную работу
+    return not (WS_PER_MESSAGE_DEFLATE and offers_permessage_deflate(websocket))
+
+
+def deflate(text: str, level: int = None) -> bytes:
+    compressor = zlib.compressobj(WS_COMPRESSION_LEVEL if level is None else level, zlib.DEFLATED, -15)
+    return compressor.compress(text.encode("utf-8")) + compressor.flush()
+
+
+def inflate(data: bytes) -> str:
+    return zlib.decompress(data, -15).decode("utf-8")
+
+
+def should_compress(text: str) -> bool:
+    return len(text) >= WS_COMPRESSION_THRESHOLD
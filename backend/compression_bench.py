@@ -0,0 +1,114 @@
+"""Сравнение трафика и CPU при сжатии типичных ответов.
+
+    python compression_bench.py
+    python compression_bench.py --messages 50 --chats 30
+
+Показывает размер и время сжатия для реплея истории в /ws/dm
+(по сообщению и одним кадром), истории из /chats/{id}/messages
+и списка чатов /me/directs на разных уровнях сжатия. По этим цифрам
+подбираются WS_COMPRESSION_THRESHOLD/LEVEL и HTTP_GZIP_MIN_SIZE/LEVEL.
+"""
+import argparse
+import gzip
+import json
+import random
+import time
+
+from compression import deflate
+
+
+WORDS = (
+    "привет как дела что делаешь сегодня вечером играем кости колесо фортуны "
+    "давай созвонимся позже ок супер ага нет да hello see you later lol"
+).split()
+
+
+def sample_history(count: int, chat_id: int = 42) -> list[dict]:
+    rng = random.Random(1)
+    users = [(1, "alice", "/uploads/0162b9fe-f8b5-403e-a8bd-9a273a8b4909.png"),
+             (2, "bob_the_builder", None)]
+    history = []
+    for i in range(count):
+        user_id, username, avatar = users[rng.randrange(2)]
+        history.append({
+            "id": 100000 + i,
+            "username": username,
+            "user_avatar": avatar,
+            "text": " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 20))),
+            "image": None,
+            "time": f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}",
+            "chat_id": chat_id,
+            "sender_id": user_id,
+            "is_read": rng.random() < 0.8,
+        })
+    return history
+
+
+def sample_inbox(count: int) -> list[dict]:
+    rng = random.Random(2)
+    return [
+        {
+            "id": i,
+            "name": f"friend_{i}",
+            "username": f"friend_{i}",
+            "avatar_url": f"/uploads/{i:08x}-f8b5-403e-a8bd-9a273a8b4909.png",
+            "is_online": rng.random() < 0.3,
+            "last_message": " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 12))),
+            "time": "вчера",
+            "unread_count": rng.randint(0, 5),
+        }
+        for i in range(count)
+    ]
+
+
+def measure(compress, payloads: list[str], repeat: int = 200) -> tuple[int, float]:
+    """(байт после сжатия, микросекунд CPU на весь набор)"""
+    size = sum(len(compress(p)) for p in payloads)
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for p in payloads:
+            compress(p)
+    return size, (time.perf_counter() - started) / repeat * 1e6
+
+
+def row(name: str, raw: int, size: int, cpu_us: float):
+    ratio = size / raw * 100 if raw else 0
+    print(f"  {name:<34} {size:>8} байт  {ratio:5.1f}%  {cpu_us:9.1f} мкс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк сжатия ответов")
+    parser.add_argument("--messages", type=int, default=50, help="сообщений в истории")
+    parser.add_argument("--chats", type=int, default=30, help="чатов в списке")
+    parser.add_argument("--threshold", type=int, default=512, help="порог сжатия WS-кадра, символов")
+    args = parser.parse_args()
+
+    history = sample_history(args.messages)
+    frames = [json.dumps(m) for m in history]
+    batch = json.dumps({"type": "history", "chat_id": 42, "messages": history})
+
+    raw = sum(len(f.encode()) for f in frames)
+    print(f"\nРеплей истории /ws/dm ({args.messages} сообщений), без сжатия: {raw} байт")
+    row("по кадру, без сжатия", raw, raw, 0.0)
+    for level in (1, 6, 9):
+        def per_frame(p, level=level):
+            return deflate(p, level) if len(p) >= args.threshold else p.encode()
+        size, cpu = measure(per_frame, frames)
+        row(f"по кадру, deflate {level} (порог {args.threshold})", raw, size, cpu)
+    for level in (1, 6, 9):
+        size, cpu = measure(lambda p, level=level: deflate(p, level), [batch])
+        row(f"одним кадром, deflate {level}", raw, size, cpu)
+
+    for title, payload in (
+        (f"GET /chats/{{id}}/messages ({args.messages} сообщений)", json.dumps(history)),
+        (f"GET /me/directs ({args.chats} чатов)", json.dumps(sample_inbox(args.chats))),
+    ):
+        raw = len(payload.encode())
+        print(f"\n{title}, без сжатия: {raw} байт")
+        for level in (1, 5, 9):
+            size, cpu = measure(lambda p, level=level: gzip.compress(p.encode(), compresslevel=level), [payload])
+            row(f"gzip {level}", raw, size, cpu)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+from typing import Iterator
+
+
+class Connection:
+    """Одно открытое WebSocket-соединение.
+
+    Комната — id чата (int), а не строка "dm_<id>". room_slot и user_slot —
+    позиции записи в списках комнаты и пользователя: по ним запись
+    удаляется за O(1), без поиска по списку.
+    """
+    __slots__ = ("websocket", "user_id", "room", "deflate", "reconnect_hint", "draining", "room_slot", "user_slot")
+
+    def __init__(self, websocket, user_id: int, room: int, deflate: bool = False, reconnect_hint: bool = False):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.room = room
+        self.deflate = deflate
+        self.reconnect_hint = reconnect_hint  # Клиент понимает кадр {"type": "reconnect"}
+        self.draining = False  # Закрывается при выводе воркера — пользователь не уходит в офлайн сразу
+        self.room_slot = -1
+        self.user_slot = -1
+
+
+def _pop_room(items: list[Connection], conn: Connection):
+    # Последний элемент встаёт на место удаляемого — порядок не важен, сдвига нет
+    last = items.pop()
+    if last is not conn:
+        items[conn.room_slot] = last
+        last.room_slot = conn.room_slot
+    conn.room_slot = -1
+
+
+def _pop_user(items: list[Connection], conn: Connection):
+    last = items.pop()
+    if last is not conn:
+        items[conn.user_slot] = last
+        last.user_slot = conn.user_slot
+    conn.user_slot = -1
+
+
+class ConnectionRegistry:
+    """Кто куда подключён: комната -> соединения, пользователь -> соединения.
+
+    Пользователь онлайн, пока у него есть хоть одно соединение, —
+    отдельного множества онлайн нет. Добавление и удаление — O(1).
+    """
+
+    def __init__(self):
+        self.rooms: dict[int, list[Connection]] = {}
+        self.users: dict[int, list[Connection]] = {}
+        self.count = 0
+
+    def add(self, conn: Connection) -> bool:
+        """Зарегистрировать соединение. True — это первое соединение пользователя"""
+        room = self.rooms.get(conn.room)
+        if room is None:
+            room = self.rooms[conn.room] = []
+        conn.room_slot = len(room)
+        room.append(conn)
+
+        user = self.users.get(conn.user_id)
+        first = user is None
+        if first:
+            user = self.users[conn.user_id] = []
+        conn.user_slot = len(user)
+        user.append(conn)
+        self.count += 1
+        return first
+
+    def leave_room(self, conn: Connection):
+        """Убрать соединение из рассылки комнаты (пользователь остаётся онлайн)"""
+        if conn.room_slot < 0:
+            return
+        room = self.rooms[conn.room]
+        _pop_room(room, conn)
+        if not room:
+            del self.rooms[conn.room]
+
+    def remove(self, conn: Connection) -> bool:
+        """Снять соединение. True — у пользователя больше нет соединений. Повторный вызов ничего не делает"""
+        self.leave_room(conn)
+        if conn.user_slot < 0:
+            return False
+        user = self.users[conn.user_id]
+        _pop_user(user, conn)
+        self.count -= 1
+        if user:
+            return False
+        del self.users[conn.user_id]
+        return True
+
+    def in_room(self, room: int) -> list[Connection]:
+        return self.rooms.get(room, [])
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self.users
+
+    def is_user_in_room(self, user_id: int, room: int) -> bool:
+        # У пользователя единицы соединений — перебор дешевле ещё одного индекса
+        return any(conn.room == room for conn in self.users.get(user_id, ()))
+
+    def users_in_room(self, room: int) -> list[int]:
+        return list(dict.fromkeys(conn.user_id for conn in self.rooms.get(room, ())))
+
+    def __iter__(self) -> Iterator[Connection]:
+        for conns in self.users.values():
+            yield from conns
@@ -0,0 +1,153 @@
+"""Память и скорость реестра WebSocket-соединений.
+
+    python connections_bench.py
+    python connections_bench.py --connections 100000 --room-size 2
+    python connections_bench.py --room-size 500
+
+Сравнивает прежнюю раскладку ConnectionManager (списки WebSocket по
+строковым комнатам "dm_<id>", множества комнат по пользователям,
+отдельное множество онлайн) с ConnectionRegistry: байт на соединение
+(tracemalloc, без самих сокетов) и добавлений/удалений в секунду.
+Удаления идут в случайном порядке, как отключаются реальные клиенты.
+"""
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+
+from connections import Connection, ConnectionRegistry
+
+
+class FakeSocket:
+    __slots__ = ()
+
+
+class LegacyRegistry:
+    """Структуры ConnectionManager до ConnectionRegistry"""
+
+    def __init__(self):
+        self.active_connections: dict[str, list] = {}
+        self.user_connections: dict[int, set[str]] = {}
+        self.online_users: set[int] = set()
+        self.deflate_connections: set = set()
+
+    def add(self, websocket, chat_id: int, user_id: int, deflate: bool):
+        room_id = f"dm_{chat_id}"
+        if deflate:
+            self.deflate_connections.add(websocket)
+        if room_id not in self.active_connections:
+            self.active_connections[room_id] = []
+        self.active_connections[room_id].append(websocket)
+        if user_id not in self.user_connections:
+            self.user_connections[user_id] = set()
+        self.user_connections[user_id].add(room_id)
+        self.online_users.add(user_id)
+
+    def remove(self, websocket, chat_id: int, user_id: int):
+        room_id = f"dm_{chat_id}"
+        self.deflate_connections.discard(websocket)
+        if room_id in self.active_connections:
+            if websocket in self.active_connections[room_id]:
+                self.active_connections[room_id].remove(websocket)
+            if not self.active_connections[room_id]:
+                del self.active_connections[room_id]
+        if user_id in self.user_connections:
+            self.user_connections[user_id].discard(room_id)
+            if not self.user_connections[user_id]:
+                del self.user_connections[user_id]
+                self.online_users.discard(user_id)
+
+
+def plan(count: int, room_size: int) -> list[tuple]:
+    """(сокет, чат, пользователь, deflate): в каждой комнате room_size разных пользователей"""
+    rng = random.Random(1)
+    users = max(room_size, count // 2)  # В среднем по два соединения на пользователя
+    return [
+        (FakeSocket(), i // room_size, (i // room_size * 7919 + i % room_size) % users, rng.random() < 0.5)
+        for i in range(count)
+    ]
+
+
+def fill_legacy(items: list[tuple]) -> LegacyRegistry:
+    reg = LegacyRegistry()
+    for websocket, chat_id, user_id, deflate in items:
+        reg.add(websocket, chat_id, user_id, deflate)
+    return reg
+
+
+def drain_legacy(reg: LegacyRegistry, items: list[tuple], order: list[int]):
+    for i in order:
+        websocket, chat_id, user_id, _ = items[i]
+        reg.remove(websocket, chat_id, user_id)
+    assert not reg.active_connections and not reg.online_users
+
+
+def fill_registry(items: list[tuple]) -> tuple[ConnectionRegistry, list[Connection]]:
+    reg = ConnectionRegistry()
+    # Список conns держит записи вместо обработчиков /ws/dm
+    conns = []
+    for websocket, chat_id, user_id, deflate in items:
+        conn = Connection(websocket, user_id, chat_id, deflate)
+        reg.add(conn)
+        conns.append(conn)
+    return reg, conns
+
+
+def drain_registry(state: tuple[ConnectionRegistry, list[Connection]], items: list[tuple], order: list[int]):
+    reg, conns = state
+    for i in order:
+        reg.remove(conns[i])
+    assert not reg.rooms and not reg.users and reg.count == 0
+
+
+def footprint(fill, items: list[tuple]) -> int:
+    """Байт, занятых реестром (сами сокеты созданы заранее и не считаются)"""
+    gc.collect()
+    tracemalloc.start()
+    state = fill(items)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    if isinstance(state, tuple):
+        size -= state[1].__sizeof__()  # Список conns — не часть реестра
+    return size
+
+
+def throughput(fill, drain, items: list[tuple], order: list[int]) -> tuple[float, float]:
+    """Секунды на добавление всех соединений и на их удаление (без tracemalloc)"""
+    gc.collect()
+    started = time.perf_counter()
+    state = fill(items)
+    added = time.perf_counter() - started
+    started = time.perf_counter()
+    drain(state, items, order)
+    return added, time.perf_counter() - started
+
+
+def row(name: str, count: int, size: float, added: float, removed: float):
+    print(
+        f"  {name:<20} {size / count:8.1f} байт/соед.  "
+        f"добавление {count / added / 1000:8.1f} тыс/с  удаление {count / removed / 1000:8.1f} тыс/с"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк реестра соединений")
+    parser.add_argument("--connections", type=int, default=100_000, help="соединений")
+    parser.add_argument("--room-size", type=int, default=2, help="соединений в комнате")
+    args = parser.parse_args()
+
+    items = plan(args.connections, args.room_size)
+    order = list(range(len(items)))
+    random.Random(2).shuffle(order)
+
+    print(f"\n{args.connections} соединений, по {args.room_size} в комнате")
+    for name, fill, drain in (
+        ("прежняя раскладка", fill_legacy, drain_legacy),
+        ("ConnectionRegistry", fill_registry, drain_registry),
+    ):
+        row(name, args.connections, footprint(fill, items), *throughput(fill, drain, items, order))
+
+
+if __name__ == "__main__":
+    main()
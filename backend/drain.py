@@ -0,0 +1,107 @@
+import asyncio
+import json
+import math
+import os
+import random
+from datetime import datetime
+from typing import Awaitable, Callable, Optional
+
+from connections import Connection, ConnectionRegistry
+from metrics import ws_drained
+
+
+# За сколько секунд закрыть все сокеты воркера
+DRAIN_SECONDS = float(os.getenv("DRAIN_SECONDS", "30"))
+# Клиент переподключается через случайную задержку из этого окна
+DRAIN_RECONNECT_MIN_MS = int(os.getenv("DRAIN_RECONNECT_MIN_MS", "500"))
+DRAIN_RECONNECT_MAX_MS = int(os.getenv("DRAIN_RECONNECT_MAX_MS", "10000"))
+# Не вернувшийся за окно переподключения и этот запас пользователь уходит в офлайн
+DRAIN_OFFLINE_GRACE_SECONDS = float(os.getenv("DRAIN_OFFLINE_GRACE_SECONDS", "5"))
+DRAIN_OFFLINE_DELAY = DRAIN_RECONNECT_MAX_MS / 1000 + DRAIN_OFFLINE_GRACE_SECONDS
+# Код закрытия "Service Restart" (RFC 6455)
+DRAIN_CLOSE_CODE = 1012
+# Закрываем пачками раз в столько секунд
+DRAIN_TICK = 0.1
+
+
+class Drainer:
+    """Плавный вывод воркера перед перезапуском.
+
+    Новые сокеты не принимаются (закрываются кодом 1012 до accept),
+    открытые закрываются не разом, а равномерно за DRAIN_SECONDS в
+    случайном порядке. Перед закрытием клиент получает
+    {"type": "reconnect", "after_ms": N} со случайным N (если подключился
+    с reconnect_hint=1); то же N — в причине закрытия. Переподключения
+    расходятся во времени, и БД не получает разом реплей истории и запись
+    онлайн-статуса от каждого клиента. Закрытое так соединение не пишет
+    офлайн сразу: только через DRAIN_OFFLINE_DELAY и только если
+    пользователь не вернулся (см. ConnectionManager.disconnect).
+    """
+
+    def __init__(
+        self,
+        seconds: float = DRAIN_SECONDS,
+        min_ms: int = DRAIN_RECONNECT_MIN_MS,
+        max_ms: int = DRAIN_RECONNECT_MAX_MS
+    ):
+        self.seconds = seconds
+        self.min_ms = min_ms
+        self.max_ms = max(min_ms, max_ms)
+        self.draining = False
+        self.started_at: Optional[datetime] = None
+        self.closed = 0
+        self.registry: Optional[ConnectionRegistry] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, registry: ConnectionRegistry, send: Callable[[Connection, str], Awaitable]) -> bool:
+        """Начать вывод. False — уже выводится"""
+        if self.draining:
+            return False
+        self.draining = True
+        self.started_at = datetime.utcnow()
+        self.registry = registry
+        self._task = asyncio.create_task(self._run(registry, send))
+        return True
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self, registry: ConnectionRegistry, send):
+        conns = list(registry)
+        random.shuffle(conns)
+        ticks = max(1, int(self.seconds / DRAIN_TICK))
+        batch = max(1, math.ceil(len(conns) / ticks))
+        for start in range(0, len(conns), batch):
+            await asyncio.gather(*(self._close(conn, send) for conn in conns[start:start + batch]))
+            await asyncio.sleep(DRAIN_TICK)
+        # Кто успел подключиться, пока мы начинали, — закрываем сразу
+        await asyncio.gather(*(self._close(conn, send) for conn in list(registry)))
+
+    async def _close(self, conn: Connection, send):
+        if conn.user_slot < 0 or conn.draining:
+            return  # Уже отключился сам
+        conn.draining = True
+        after_ms = random.randint(self.min_ms, self.max_ms)
+        try:
+            if conn.reconnect_hint:
+                await send(conn, json.dumps({"type": "reconnect", "after_ms": after_ms}))
+            await conn.websocket.close(code=DRAIN_CLOSE_CODE, reason=json.dumps({"after_ms": after_ms}))
+        except Exception:
+            pass  # Сокет уже мёртв — disconnect уберёт его сам
+        self.closed += 1
+        ws_drained.inc()
+
+    def report(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "draining": self.draining,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "closed": self.closed,
+            "open": self.registry.count if self.registry else None,
+        }
+
+
+drainer = Drainer()
@@ -0,0 +1,100 @@
+import asyncio
+import json
+import os
+import zlib
+from itertools import islice
+from typing import AsyncIterator
+
+from sqlalchemy import select, and_
+
+from models import Message, MessageArchive, User, DirectChat
+from archive import iter_segment
+
+
+# Сообщений за одно обращение к БД; между пачками соединение возвращается в пул
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+# Сколько строк серверный курсор отдаёт за раз внутри пачки
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "200"))
+
+
+def _line(message_id: int, seq, chat_id: int, sender_id: int, text, image_url, created_at, usernames: dict) -> str:
+    return json.dumps({
+        "id": message_id,
+        "seq": seq,
+        "chat_id": chat_id,
+        "sender_id": sender_id,
+        "username": usernames.get(sender_id),
+        "text": text,
+        "image": image_url,
+        "created_at": created_at.isoformat() if created_at else None
+    }, ensure_ascii=False) + "\n"
+
+
+async def export_chat(session_factory, chat: DirectChat, chunk_size: int = EXPORT_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Вся история чата в NDJSON, от старых к новым: сначала архив, потом горячая таблица.
+
+    Память — одна пачка, сколько бы ни было сообщений.
+    Соединение берётся только на время выборки пачки: пока медленный клиент
+    качает, оно свободно для остальных. session_factory — обычно read_session,
+    чтобы выгрузка шла с реплики.
+    """
+    async with session_factory() as session:
+        query = select(User.id, User.username).where(User.id.in_([chat.user1_id, chat.user2_id]))
+        usernames = {row.id: row.username for row in (await session.execute(query)).all()}
+
+        query = (
+            select(MessageArchive.path)
+            .where(MessageArchive.chat_id == chat.id)
+            .order_by(MessageArchive.period)
+        )
+        segment_paths = (await session.execute(query)).scalars().all()
+
+    for path in segment_paths:
+        # Файл читаем пачками в потоке — в памяти одна пачка, а не весь месяц
+        rows_iter = iter_segment(path)
+        try:
+            while True:
+                rows = await asyncio.to_thread(lambda: list(islice(rows_iter, chunk_size)))
+                if not rows:
+                    break
+                yield "".join(
+                    _line(row["id"], row.get("seq"), row["chat_id"], row["sender_id"],
+                          row["text"], row["image_url"], row["created_at"], usernames)
+                    for row in rows
+                ).encode("utf-8")
+        finally:
+            rows_iter.close()
+
+    last_seq = 0
+    while True:
+        lines = []
+        async with session_factory() as session:
+            query = (
+                select(Message)
+                .where(and_(Message.chat_id == chat.id, Message.seq > last_seq))
+                .order_by(Message.seq)
+                .limit(chunk_size)
+                .execution_options(yield_per=EXPORT_FETCH_SIZE)
+            )
+            result = await session.stream(query)
+            async for msg in result.scalars():
+                lines.append(_line(
+                    msg.id, msg.seq, msg.chat_id, msg.sender_id, msg.text, msg.image_url, msg.created_at, usernames
+                ))
+                last_seq = msg.seq
+
+        if not lines:
+            break
+        yield "".join(lines).encode("utf-8")
+        if len(lines) < chunk_size:
+            break
+
+
+async def gzip_stream(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Сжимать поток на лету, не собирая его целиком"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 — формат gzip
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
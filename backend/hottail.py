@@ -0,0 +1,182 @@
+import itertools
+import os
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Optional
+
+from metrics import hot_tail_lookups
+from readstate import is_read_by_other
+
+
+# Сколько последних сообщений держать на чат (реплей /ws/dm — 50)
+HOT_TAIL_SIZE = int(os.getenv("HOT_TAIL_SIZE", "50"))
+# Сколько чатов держать в памяти; самые давно не тронутые вытесняются. 0 — выключить
+HOT_TAIL_CHATS = int(os.getenv("HOT_TAIL_CHATS", "10000"))
+# Сколько последних записей в незакэшированные чаты помнить (см. HotTails.fill)
+HOT_TAIL_MISSES = 4096
+
+
+class ChatTail:
+    """Последние сообщения одного чата и отметки прочтения в нём.
+
+    user1_id/user2_id — как у DirectChat, поэтому хвост подходит вместо чата
+    в is_read_by_other и проверке участника.
+    """
+
+    __slots__ = ("user1_id", "user2_id", "messages", "watermarks", "all_hot")
+
+    def __init__(self, user1_id: int, user2_id: int, size: int):
+        self.user1_id = user1_id
+        self.user2_id = user2_id
+        self.messages: deque[dict] = deque(maxlen=size)
+        self.watermarks: dict[int, int] = {}
+        # При загрузке в горячей таблице было меньше size сообщений — все они здесь
+        self.all_hot = False
+
+    def is_member(self, user_id: int) -> bool:
+        return user_id in (self.user1_id, self.user2_id)
+
+    def covers(self, limit: int) -> bool:
+        """Хватит ли хвоста, чтобы отдать последние limit сообщений горячей таблицы"""
+        return limit <= len(self.messages) or (self.all_hot and len(self.messages) < self.messages.maxlen)
+
+    @property
+    def last_seq(self) -> int:
+        return self.messages[-1]["seq"] if self.messages else 0
+
+
+class HotTails:
+    """Хвосты активных чатов в памяти процесса: реплей истории без обращения к БД.
+
+    Хвост заполняется из БД при первом чтении чата и дальше пополняется
+    при каждой записи сообщения. Чаты вытесняются по LRU. Как и комнаты
+    ConnectionManager, всё живёт в одном процессе: сообщения, записанные
+    другим воркером, сюда не попадут — с несколькими воркерами хвост
+    нужно выключить (HOT_TAIL_CHATS=0).
+    """
+
+    def __init__(self, size: int = HOT_TAIL_SIZE, max_chats: int = HOT_TAIL_CHATS):
+        self.size = size
+        self.max_chats = max_chats
+        self.tails: OrderedDict[int, ChatTail] = OrderedDict()
+        # user_id -> (username, avatar_url) авторов сообщений в хвостах. Живёт, пока
+        # пользователь участник хотя бы одного хвоста: _members — в скольких
+        self.profiles: dict[int, tuple[str, Optional[str]]] = {}
+        self._members: dict[int, int] = {}
+        self._writes = itertools.count(1)
+        self._misses: OrderedDict[int, int] = OrderedDict()
+
+    def get(self, chat_id: int) -> Optional[ChatTail]:
+        tail = self.tails.get(chat_id)
+        if tail is None:
+            hot_tail_lookups.inc("miss")
+            return None
+        self.tails.move_to_end(chat_id)
+        hot_tail_lookups.inc("hit")
+        return tail
+
+    def begin_load(self) -> int:
+        """Метка перед чтением хвоста из БД — передаётся в fill"""
+        return next(self._writes)
+
+    def fill(self, chat_id: int, chat, rows: list, watermarks: dict[int, int], started: int):
+        """Положить в память прочитанное из БД: rows — (Message, User) от старых к новым.
+
+        Если пока шло чтение, в чат кто-то писал, прочитанное могло устареть —
+        тогда не кладём ничего, хвост загрузится при следующем чтении.
+        """
+        if self.max_chats <= 0 or chat_id in self.tails or self._misses.get(chat_id, 0) >= started:
+            return
+        tail = ChatTail(chat.user1_id, chat.user2_id, self.size)
+        for msg, user in rows[-self.size:]:
+            tail.messages.append(_entry(msg.id, msg.seq, msg.sender_id, msg.text, msg.image_url, msg.created_at))
+            self.profiles[user.id] = (user.username, user.avatar_url)
+        tail.watermarks = dict(watermarks)
+        tail.all_hot = len(rows) < self.size
+        self.tails[chat_id] = tail
+        for user_id in (tail.user1_id, tail.user2_id):
+            self._members[user_id] = self._members.get(user_id, 0) + 1
+        while len(self.tails) > self.max_chats:
+            self._drop(next(iter(self.tails)))
+
+    def _drop(self, chat_id: int):
+        """Убрать хвост; профили тех, кого больше нет ни в одном хвосте, — тоже"""
+        tail = self.tails.pop(chat_id)
+        for user_id in (tail.user1_id, tail.user2_id):
+            left = self._members[user_id] - 1
+            if left:
+                self._members[user_id] = left
+            else:
+                del self._members[user_id]
+                self.profiles.pop(user_id, None)
+
+    def _missed(self, chat_id: int):
+        self._misses[chat_id] = next(self._writes)
+        self._misses.move_to_end(chat_id)
+        while len(self._misses) > HOT_TAIL_MISSES:
+            self._misses.popitem(last=False)
+
+    def append(self, chat_id: int, msg, username: str, avatar_url: Optional[str]):
+        """Новое сообщение (уже закоммиченное) — в хвост чата"""
+        tail = self.tails.get(chat_id)
+        if tail is None:
+            self._missed(chat_id)
+            return
+        if tail.messages and msg.seq <= tail.last_seq:
+            return  # Уже попало в хвост при загрузке из БД
+        if tail.messages and msg.seq != tail.last_seq + 1:
+            # Пропустили сообщение — такому хвосту верить нельзя
+            self._drop(chat_id)
+            self._missed(chat_id)
+            return
+        tail.messages.append(_entry(msg.id, msg.seq, msg.sender_id, msg.text, msg.image_url, msg.created_at))
+        self.profiles[msg.sender_id] = (username, avatar_url)
+        self.tails.move_to_end(chat_id)
+
+    def mark_read(self, chat_id: int, user_id: int, last_read_id: Optional[int]):
+        if last_read_id is None:
+            return
+        tail = self.tails.get(chat_id)
+        if tail is None:
+            self._missed(chat_id)
+            return
+        if last_read_id > tail.watermarks.get(user_id, 0):
+            tail.watermarks[user_id] = last_read_id
+
+    def update_profile(self, user_id: int, username: str, avatar_url: Optional[str]):
+        if user_id in self.profiles:
+            self.profiles[user_id] = (username, avatar_url)
+
+    def history(self, tail: ChatTail, chat_id: int, limit: int) -> list[dict]:
+        """Последние limit сообщений в формате истории /ws/dm и /chats/{id}/messages"""
+        start = max(0, len(tail.messages) - limit)
+        history = []
+        for entry in itertools.islice(tail.messages, start, None):
+            username, avatar_url = self.profiles.get(entry["sender_id"], (None, None))
+            history.append({
+                "id": entry["id"],
+                "seq": entry["seq"],
+                "chat_id": chat_id,
+                "sender_id": entry["sender_id"],
+                "username": username,
+                "user_avatar": avatar_url,
+                "text": entry["text"],
+                "image": entry["image"],
+                "time": entry["created_at"].strftime("%H:%M"),
+                "is_read": is_read_by_other(entry["id"], entry["sender_id"], tail, tail.watermarks)
+            })
+        return history
+
+
+def _entry(message_id: int, seq: int, sender_id: int, text, image_url, created_at: datetime) -> dict:
+    return {
+        "id": message_id,
+        "seq": seq,
+        "sender_id": sender_id,
+        "text": text,
+        "image": image_url,
+        "created_at": created_at,
+    }
+
+
+hot_tails = HotTails()
@@ -0,0 +1,58 @@
+import os
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional
+
+
+# Сколько последних отправок помнить в памяти (за ними — уникальный индекс в БД)
+IDEMPOTENCY_WINDOW = int(os.getenv("IDEMPOTENCY_WINDOW", "10000"))
+CLIENT_MSG_ID_MAX_LENGTH = 64
+
+
+def parse_client_msg_id(value) -> Optional[str]:
+    """client_msg_id из кадра клиента (None, если его нет или он некорректный)"""
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    if not value or len(value) > CLIENT_MSG_ID_MAX_LENGTH:
+        return None
+    return value
+
+
+class RecentSends:
+    """Окно последних отправок: (sender_id, client_msg_id) -> (chat_id, id, seq, created_at).
+
+    Повтор из окна подтверждается без обращения к БД. Если повтор пришёл
+    позже (или в другой воркер), его остановит уникальный индекс.
+    """
+
+    def __init__(self, max_entries: int = IDEMPOTENCY_WINDOW):
+        self.entries: OrderedDict[tuple[int, str], tuple[int, int, int, datetime]] = OrderedDict()
+        self.max_entries = max_entries
+
+    def get(self, sender_id: int, client_msg_id: str) -> Optional[tuple[int, int, int, datetime]]:
+        return self.entries.get((sender_id, client_msg_id))
+
+    def remember(self, sender_id: int, client_msg_id: str, chat_id: int, message_id: int, seq: int,
+                 created_at: datetime):
+        # Чат исходного сообщения: тот же client_msg_id мог прийти из другого чата
+        self.entries[(sender_id, client_msg_id)] = (chat_id, message_id, seq, created_at)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+def ack_frame(client_msg_id: str, chat_id: int, message_id: int, seq: int, created_at: datetime) -> dict:
+    """Подтверждение повторной отправки: сообщение уже сохранено, вот его id и время"""
+    return {
+        "type": "ack",
+        "client_msg_id": client_msg_id,
+        "chat_id": chat_id,
+        "id": message_id,
+        "seq": seq,
+        "time": created_at.strftime("%H:%M"),
+        "created_at": created_at.isoformat(),
+        "duplicate": True
+    }
+
+
+recent_sends = RecentSends()
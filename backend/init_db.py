@@ -1,12 +1,12 @@
 import asyncio
-from database import engine, Base
-from models import Message, User
+from database import engine
+from migrations import apply_migrations
 
 async def create_tables():
-    print("Подключаюсь к базе и создаю таблицы...")
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-    print("ВСЁ! Таблицы созданы. Ура")
+    print("Подключаюсь к базе и применяю миграции...")
+    version = await apply_migrations(engine)
+    print(f"ВСЁ! Схема версии {version}. Ура")
+    await engine.dispose()
 
 if __name__ == "__main__":
     asyncio.run(create_tables())
\ No newline at end of file
@@ -0,0 +1,139 @@
+import asyncio
+from typing import Optional
+
+from sortedcontainers import SortedList
+from sqlalchemy import select
+
+from models import GameStats
+
+
+LEADERBOARD_METRICS = ("wins", "win_rate", "best_score")
+
+
+def _win_rate(games_won: int, games_played: int) -> float:
+    return round(games_won / games_played * 100, 1) if games_played > 0 else 0
+
+
+class Leaderboard:
+    """Рейтинг игроков по одному типу игры.
+
+    Для каждой метрики держим SortedList ключей (-значение, user_id),
+    поэтому вставка, удаление и поиск места игрока — O(log n).
+    """
+
+    def __init__(self):
+        self.entries: dict[int, dict] = {}  # user_id -> статистика
+        self.rankings: dict[str, SortedList] = {m: SortedList() for m in LEADERBOARD_METRICS}
+
+    @staticmethod
+    def _keys(user_id: int, entry: dict) -> dict[str, tuple]:
+        return {
+            "wins": (-entry["games_won"], -entry["games_played"], user_id),
+            "win_rate": (-entry["win_rate"], -entry["games_played"], user_id),
+            "best_score": (-entry["best_score"], user_id),
+        }
+
+    def update(self, user_id: int, games_played: int, games_won: int, best_score: int):
+        """Обновить (или добавить) игрока"""
+        old = self.entries.get(user_id)
+        if old:
+            for metric, key in self._keys(user_id, old).items():
+                self.rankings[metric].discard(key)
+
+        entry = {
+            "games_played": games_played,
+            "games_won": games_won,
+            "win_rate": _win_rate(games_won, games_played),
+            "best_score": best_score,
+        }
+        self.entries[user_id] = entry
+        for metric, key in self._keys(user_id, entry).items():
+            self.rankings[metric].add(key)
+
+    def top(self, metric: str, limit: int = 10, offset: int = 0) -> list[dict]:
+        """Первые limit игроков по метрике"""
+        ranking = self.rankings[metric]
+        result = []
+        # Позиционный срез SortedList: начало страницы ищется за O(log n), без прохода с начала
+        for place, key in enumerate(ranking.islice(offset, offset + limit), start=offset + 1):
+            user_id = key[-1]
+            result.append({"rank": place, "user_id": user_id, **self.entries[user_id]})
+        return result
+
+    def rank(self, user_id: int, metric: str) -> Optional[dict]:
+        """Место игрока по метрике (None, если он ещё не играл)"""
+        entry = self.entries.get(user_id)
+        if not entry:
+            return None
+        key = self._keys(user_id, entry)[metric]
+        return {"rank": self.rankings[metric].index(key) + 1, "user_id": user_id, **entry}
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class LeaderboardRegistry:
+    """Рейтинги по всем типам игр.
+
+    Загружаются из БД при первом обращении, а не при старте воркера.
+    """
+
+    def __init__(self):
+        self.boards: dict[str, Leaderboard] = {}
+        self.loaded = False
+        self._loading: Optional[asyncio.Task] = None
+        self._pending: list[tuple] = []  # обновления, пришедшие во время загрузки
+
+    def get(self, game_type: str) -> Leaderboard:
+        if game_type not in self.boards:
+            self.boards[game_type] = Leaderboard()
+        return self.boards[game_type]
+
+    def update_from_stats(self, stats: GameStats):
+        """Применить обновлённую строку GameStats"""
+        row = (stats.game_type, stats.user_id, stats.games_played or 0, stats.games_won or 0, stats.best_score or 0)
+        if self.loaded:
+            self._apply(self.boards, row)
+        elif self._loading is not None:
+            self._pending.append(row)
+        # Иначе рейтинги ещё не загружались — эта строка и так придёт из БД
+
+    @staticmethod
+    def _apply(boards: dict[str, Leaderboard], row: tuple):
+        game_type, user_id, games_played, games_won, best_score = row
+        if game_type not in boards:
+            boards[game_type] = Leaderboard()
+        boards[game_type].update(user_id, games_played, games_won, best_score)
+
+    async def rebuild(self, session):
+        """Пересобрать все рейтинги из БД"""
+        boards: dict[str, Leaderboard] = {}
+        result = await session.execute(select(GameStats))
+        for stats in result.scalars():
+            self._apply(boards, (
+                stats.game_type, stats.user_id,
+                stats.games_played or 0, stats.games_won or 0, stats.best_score or 0
+            ))
+
+        for row in self._pending:
+            self._apply(boards, row)
+        self._pending = []
+        self.boards = boards
+        self.loaded = True
+
+    async def ensure_loaded(self, session_factory):
+        if self.loaded:
+            return
+        if self._loading is None:
+            self._loading = asyncio.create_task(self._load(session_factory))
+        await asyncio.shield(self._loading)
+
+    async def _load(self, session_factory):
+        try:
+            async with session_factory() as session:
+                await self.rebuild(session)
+        finally:
+            self._loading = None
+
+
+leaderboards = LeaderboardRegistry()
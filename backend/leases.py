@@ -0,0 +1,53 @@
+import os
+import socket
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, or_, and_
+from sqlalchemy.exc import IntegrityError
+
+from models import JobLease
+
+
+# Кто держит аренду: уникально для воркера, в том числе на разных хостах
+HOLDER = f"{socket.gethostname()}:{os.getpid()}"
+
+
+async def acquire_lease(session_factory, name: str, ttl: float) -> bool:
+    """Взять (или продлить свою) аренду задачи на ttl секунд. False — её держит другой воркер.
+
+    Один UPDATE по строке задачи: с БД согласны все воркеры, в том числе
+    на SQLite, где нет advisory-блокировок.
+    """
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=ttl)
+    async with session_factory() as session:
+        result = await session.execute(
+            update(JobLease)
+            .where(and_(JobLease.name == name, or_(JobLease.expires_at < now, JobLease.holder == HOLDER)))
+            .values(holder=HOLDER, expires_at=expires_at)
+        )
+        if result.rowcount:
+            await session.commit()
+            return True
+
+        exists = (await session.execute(select(JobLease.name).where(JobLease.name == name))).scalar_one_or_none()
+        if exists is not None:
+            return False
+        # Строки ещё нет — первый вставивший и получает аренду
+        session.add(JobLease(name=name, holder=HOLDER, expires_at=expires_at))
+        try:
+            await session.commit()
+        except IntegrityError:
+            return False
+        return True
+
+
+async def release_lease(session_factory, name: str):
+    """Отпустить аренду, чтобы следующий проход мог взять любой воркер"""
+    async with session_factory() as session:
+        await session.execute(
+            update(JobLease)
+            .where(and_(JobLease.name == name, JobLease.holder == HOLDER))
+            .values(expires_at=datetime.utcnow())
+        )
+        await session.commit()
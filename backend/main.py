@@ -1,36 +1,116 @@
+import asyncio
+import hashlib
+import heapq
+import hmac
 import json
+import math
 import random
 import os
 import shutil
+import signal
+import time
 import uuid
 from datetime import datetime
 from typing import Optional
 
 import jwt
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Query, UploadFile, File, Depends
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Query, UploadFile, File, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
-from sqlalchemy import select, or_, and_, func
+from sqlalchemy import select, update, or_, and_, func
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from database import engine, Base, async_session_factory
-from models import Message, User, DirectChat, GroupChat, GroupMember, GameSession, GamePlayer, GameStats
+from database import engine, read_engine, async_session_factory, read_session, mark_written
+from migrations import apply_migrations, check_schema
+from models import Message, User, DirectChat, ChatReadState, GroupChat, GroupMember, GameSession, GamePlayer, GameStats, UploadSession
 from schemas import (
     UserCreate, UserResponse, UserLogin, Token,
     UpdateAvatar, UpdateProfile, DirectChatResponse
 )
 from security import get_password_hash, verify_password, create_access_token, SECRET_KEY, ALGORITHM
+from leaderboard import leaderboards, LEADERBOARD_METRICS
+from wordgames import WORD_GAMES, WordGameError, word_decks, play as play_word_game
+from archive import archive_loop, read_archived_messages
+from ratelimit import rate_limiter, slow_down_frame
+from admission import admission, Overloaded, overloaded_frame
+from querylog import QueryCountMiddleware, track_queries
+from cache import response_cache
+from compression import (
+    WS_DEFLATE_SUBPROTOCOL, HTTP_GZIP_MIN_SIZE, HTTP_GZIP_LEVEL, wants_deflate, deflate, should_compress
+)
+from outbox import outbox, outbox_entry, OUTBOX_ENABLED
+from idempotency import recent_sends, parse_client_msg_id, ack_frame
+from export import export_chat, gzip_stream
+from uploads import (
+    ALLOWED_UPLOAD_TYPES, UPLOAD_MAX_SIZE, UPLOAD_CHUNK_MAX, upload_locks,
+    create_temp_file, write_chunk, finalize, discard, file_extension
+)
+from maintenance import sweep_loop, SWEEP_ENABLED
+from presence import presence, PRESENCE_ENABLED
+from connections import Connection, ConnectionRegistry
+from drain import drainer, DRAIN_CLOSE_CODE, DRAIN_OFFLINE_DELAY
+from profiler import (
+    profiler, loop_monitor, ProfilerMiddleware, ProfilerBusy, PROFILER_MAX_SECONDS, LOOP_MONITOR_ENABLED
+)
+from sync import next_seq, collect_changes, save_cursor, SYNC_MAX_MESSAGES
+from readstate import mark_read, get_chat_watermarks, is_read_by_other
+from hottail import hot_tails, HOT_TAIL_SIZE
+from metrics import (
+    METRICS_ENABLED, MetricsMiddleware, Gauge, registry,
+    ws_connects, ws_disconnects, ws_dead_connections, ws_broadcast_duration
+)
 
 
 #ИНИЦИАЛИЗАЦИЯ
 
 os.makedirs("uploads", exist_ok=True)
 
+# Для разработки и тестов: применять миграции при старте
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "false").lower() in ("1", "true", "yes", "on")
+# Кому доступны /admin/*: id пользователей через запятую
+ADMIN_USER_IDS = {int(x) for x in os.getenv("ADMIN_USER_IDS", "").split(",") if x.strip()}
+# Токен для сборщика метрик: Authorization: Bearer <METRICS_TOKEN>. Без него /metrics — только администраторам
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
 
 async def lifespan(app: FastAPI):
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    # Схему меняет только `python migrate.py`; здесь — один дешёвый SELECT
+    if AUTO_MIGRATE:
+        await apply_migrations(engine)
+    else:
+        await check_schema(engine)
+    
+    # Колоды словесных игр — один раз на процесс, общие для всех сессий
+    word_decks.load()
+    
+    background_tasks = [asyncio.create_task(archive_loop(async_session_factory))]
+    if SWEEP_ENABLED:
+        background_tasks.append(asyncio.create_task(sweep_loop(async_session_factory)))
+    if OUTBOX_ENABLED:
+        outbox.start(async_session_factory)
+    if PRESENCE_ENABLED:
+        presence.start(async_session_factory, manager.send, manager.is_user_online)
+    if LOOP_MONITOR_ENABLED:
+        loop_monitor.start()
+    # kill -USR2 <pid воркера> перед перезапуском — плавный вывод, как POST /admin/drain
+    try:
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGUSR2, lambda: drainer.start(manager.registry, manager.send)
+        )
+    except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+        pass  # Windows или loop не в главном потоке
     yield
+    await drainer.stop()
+    await manager.flush_drained()
+    await loop_monitor.stop()
+    for task in background_tasks:
+        task.cancel()
+    await outbox.stop()
+    await presence.stop()
+    await response_cache.close()
 
 
 app = FastAPI(
@@ -47,6 +127,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(GZipMiddleware, minimum_size=HTTP_GZIP_MIN_SIZE, compresslevel=HTTP_GZIP_LEVEL)
+app.add_middleware(QueryCountMiddleware)
+app.add_middleware(ProfilerMiddleware)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
 GAME_TYPES = ["dice", "wheel", "rps", "random", "who_am_i", "alias", "codenames"]
@@ -68,6 +154,34 @@ async def get_current_user(token: str = Query(...)) -> dict:
         raise HTTPException(status_code=401, detail="Invalid token")
 
 
+async def get_admin_user(current_user: dict = Depends(get_current_user)) -> dict:
+    """Только для пользователей из ADMIN_USER_IDS"""
+    if current_user["id"] not in ADMIN_USER_IDS:
+        raise HTTPException(status_code=403, detail="Доступ запрещён")
+    return current_user
+
+
+async def enforce_rate_limit(name: str, key):
+    """Ответить 429, если лимит исчерпан"""
+    retry_after = await rate_limiter.check(name, key)
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail="Слишком много запросов, попробуйте позже",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    """БД перегружена — быстрый отказ с подсказкой, когда повторить"""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Сервер перегружен, попробуйте позже"},
+        headers={"Retry-After": str(math.ceil(exc.retry_after))}
+    )
+
+
 def format_time(dt: datetime) -> str:
     """Форматирование времени для отображения"""
     now = datetime.utcnow()
@@ -84,89 +198,284 @@ def format_time(dt: datetime) -> str:
         return dt.strftime("%d.%m.%Y")
 
 
+async def archived_history(session, chat, archived: list[dict], watermarks: dict[int, int]) -> list[dict]:
+    """Сообщения из read_archived_messages (от новых к старым) в формате истории, от старых к новым"""
+    if not archived:
+        return []
+    senders_query = select(User).where(User.id.in_({m["sender_id"] for m in archived}))
+    senders = {u.id: u for u in (await session.execute(senders_query)).scalars()}
+    return [
+        {
+            "id": m["id"],
+            "seq": m.get("seq"),
+            "chat_id": m["chat_id"],
+            "sender_id": m["sender_id"],
+            "username": senders[m["sender_id"]].username if m["sender_id"] in senders else None,
+            "user_avatar": senders[m["sender_id"]].avatar_url if m["sender_id"] in senders else None,
+            "text": m["text"],
+            "image": m["image_url"],
+            "time": m["created_at"].strftime("%H:%M"),
+            "is_read": is_read_by_other(m["id"], m["sender_id"], chat, watermarks)
+        }
+        for m in reversed(archived)
+    ]
+
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: dict[str, list[WebSocket]] = {}
-        self.user_connections: dict[int, set[str]] = {}  # user_id -> set of room_ids
-        self.online_users: set[int] = set()  # Множество онлайн пользователей
+        self.registry = ConnectionRegistry()  # Комнаты — id чатов, онлайн — у кого есть соединения
+        self.drained_users: set[int] = set()  # Ждут отложенной записи офлайна после вывода воркера
 
-    async def connect(self, websocket: WebSocket, room_id: str, user_id: int):
-        await websocket.accept()
+    async def connect(self, websocket: WebSocket, chat_id: int, user_id: int, reconnect_hint: bool = False) -> Connection:
+        deflate_ok = wants_deflate(websocket)
+        if deflate_ok:
+            await websocket.accept(subprotocol=WS_DEFLATE_SUBPROTOCOL)
+        else:
+            await websocket.accept()
         
-        if room_id not in self.active_connections:
-            self.active_connections[room_id] = []
-        self.active_connections[room_id].append(websocket)
-        
-        if user_id not in self.user_connections:
-            self.user_connections[user_id] = set()
-        self.user_connections[user_id].add(room_id)
+        conn = Connection(websocket, user_id, chat_id, deflate_ok, reconnect_hint)
+        ws_connects.inc()
         
         # Пользователь онлайн
-        self.online_users.add(user_id)
-        await self._update_user_online_status(user_id, True)
-
-    def disconnect(self, websocket: WebSocket, room_id: str, user_id: int):
-        if room_id in self.active_connections:
-            if websocket in self.active_connections[room_id]:
-                self.active_connections[room_id].remove(websocket)
-            if not self.active_connections[room_id]:
-                del self.active_connections[room_id]
-        
-        if user_id in self.user_connections:
-            self.user_connections[user_id].discard(room_id)
-            
-            if not self.user_connections[user_id]:
-                del self.user_connections[user_id]
-                self.online_users.discard(user_id)
-                import asyncio
-                asyncio.create_task(self._update_user_online_status(user_id, False))
-
-    async def _update_user_online_status(self, user_id: int, is_online: bool):
-        """Обновить статус пользователя в БД"""
-        async with async_session_factory() as session:
-            query = select(User).where(User.id == user_id)
-            result = await session.execute(query)
-            user = result.scalar_one_or_none()
-            
-            if user:
-                user.is_online = is_online
-                if not is_online:
-                    user.last_seen = datetime.utcnow()
+        if self.registry.add(conn):
+            presence.changed(user_id, True)
+        try:
+            await response_cache.invalidate(f"presence:{user_id}")
+            if not await self._update_user_online_status(user_id, True):
+                # В БД уже онлайн — возможно, это переподключение после вывода другого воркера,
+                # и тот скоро запишет офлайн. Проверим ещё раз после его отложенной записи
+                asyncio.create_task(self._reassert_online(user_id))
+        except BaseException:
+            # Отмена посреди подключения: иначе запись так и осталась бы в реестре
+            self.disconnect(conn)
+            raise
+        return conn
+
+    def disconnect(self, conn: Connection):
+        ws_disconnects.inc()
+        presence.unsubscribe(conn)
+        if not self.registry.remove(conn):
+            return
+        if conn.draining:
+            # Закрыто при выводе воркера: пользователь уже переподключается, офлайн сразу не пишем.
+            # Не вернулся за окно переподключения — тогда офлайн
+            self.drained_users.add(conn.user_id)
+            asyncio.create_task(self._offline_after_drain(conn.user_id))
+            return
+        presence.changed(conn.user_id, False)
+        asyncio.create_task(self._update_user_online_status(conn.user_id, False))
+
+    async def _offline_after_drain(self, user_id: int):
+        await asyncio.sleep(DRAIN_OFFLINE_DELAY)
+        if user_id in self.drained_users:
+            self.drained_users.discard(user_id)
+            if not self.is_user_online(user_id):
+                await self._update_user_online_status(user_id, False)
+
+    async def _reassert_online(self, user_id: int):
+        # Условный UPDATE: пишет, только если офлайн успел записать выведенный воркер
+        await asyncio.sleep(DRAIN_OFFLINE_DELAY + 1)
+        if self.is_user_online(user_id):
+            await self._update_user_online_status(user_id, True)
+
+    async def flush_drained(self):
+        """При остановке воркера отложенный офлайн пишется сразу — иначе он бы потерялся.
+
+        Если пользователь уже на другом воркере, тот вернёт онлайн через _reassert_online.
+        """
+        users, self.drained_users = self.drained_users, set()
+        for user_id in users:
+            if not self.is_user_online(user_id):
+                await self._update_user_online_status(user_id, False)
+
+    async def _update_user_online_status(self, user_id: int, is_online: bool) -> bool:
+        """Обновить статус пользователя в БД. False — строка не изменилась (уже онлайн или БД занята)"""
+        try:
+            async with admission.admit("presence"), async_session_factory() as session:
+                # Один UPDATE без предварительного SELECT — переподключение не читает из БД
+                query = update(User).where(User.id == user_id)
+                if is_online:
+                    # Уже онлайн (второе соединение, другой воркер) — строку не переписываем
+                    query = query.where(User.is_online.isnot(True)).values(is_online=True)
+                else:
+                    query = query.values(is_online=False, last_seen=datetime.utcnow())
+                result = await session.execute(query)
                 await session.commit()
-
-    async def broadcast(self, message: str, room_id: str):
-        if room_id in self.active_connections:
+        except Overloaded:
+            # Под нагрузкой статус в БД пропускаем: онлайн считается по сокетам в памяти
+            return False
+        
+        await response_cache.invalidate(f"presence:{user_id}")
+        return bool(result.rowcount)
+
+    async def send(self, conn: Connection, message: str):
+        """Отправить одному клиенту, сжав, если он это поддерживает"""
+        if conn.deflate and should_compress(message):
+            await conn.websocket.send_bytes(deflate(message))
+        else:
+            await conn.websocket.send_text(message)
+
+    async def broadcast(self, message: str, chat_id: int):
+        # Копия: пока идут отправки, в комнату могут войти или выйти
+        connections = tuple(self.registry.in_room(chat_id))
+        if connections:
+            started = time.perf_counter()
             dead_connections = []
-            for connection in self.active_connections[room_id]:
+            compressed = None  # Сжимаем один раз на всю комнату
+            for conn in connections:
                 try:
-                    await connection.send_text(message)
+                    if conn.deflate and should_compress(message):
+                        if compressed is None:
+                            compressed = deflate(message)
+                        await conn.websocket.send_bytes(compressed)
+                    else:
+                        await conn.websocket.send_text(message)
                 except Exception:
-                    dead_connections.append(connection)
+                    dead_connections.append(conn)
             
+            # Из рассылки убираем сразу, онлайн-статус снимет disconnect
             for conn in dead_connections:
-                if conn in self.active_connections[room_id]:
-                    self.active_connections[room_id].remove(conn)
+                self.registry.leave_room(conn)
+            
+            if dead_connections:
+                ws_dead_connections.inc(amount=len(dead_connections))
+            ws_broadcast_duration.observe(time.perf_counter() - started)
 
     def is_user_online(self, user_id: int) -> bool:
-        return user_id in self.online_users
+        return self.registry.is_online(user_id)
 
-    def get_online_users_in_room(self, room_id: str) -> list[int]:
+    def is_user_in_room(self, user_id: int, chat_id: int) -> bool:
+        return self.registry.is_user_in_room(user_id, chat_id)
+
+    def get_online_users_in_room(self, chat_id: int) -> list[int]:
         """Получить список онлайн пользователей в комнате"""
-        online = []
-        for user_id, rooms in self.user_connections.items():
-            if room_id in rooms:
-                online.append(user_id)
-        return online
+        return self.registry.users_in_room(chat_id)
 
 
 manager = ConnectionManager()
 
 
+def _ws_gauges() -> dict:
+    return {(): manager.registry.count}
+
+
+def _busiest_rooms() -> dict:
+    """Только 20 самых загруженных комнат — иначе меток будет столько же, сколько чатов"""
+    rooms = heapq.nlargest(20, manager.registry.rooms.items(), key=lambda item: len(item[1]))
+    return {(f"dm_{chat_id}",): len(conns) for chat_id, conns in rooms}
+
+
+def _pool_checked_out() -> dict:
+    engines = {"primary": engine}
+    if read_engine is not engine:
+        engines["replica"] = read_engine
+    return {
+        (name,): eng.sync_engine.pool.checkedout()
+        for name, eng in engines.items()
+        if hasattr(eng.sync_engine.pool, "checkedout")
+    }
+
+
+registry.register(Gauge("omega_ws_connections", "Открытые WebSocket", callback=_ws_gauges))
+registry.register(Gauge(
+    "omega_ws_rooms", "Комнаты с открытыми WebSocket",
+    callback=lambda: {(): len(manager.registry.rooms)}
+))
+registry.register(Gauge(
+    "omega_ws_room_connections", "Соединения в самых загруженных комнатах", ("room",),
+    callback=_busiest_rooms
+))
+registry.register(Gauge(
+    "omega_online_users", "Пользователи онлайн",
+    callback=lambda: {(): len(manager.registry.users)}
+))
+registry.register(Gauge(
+    "omega_db_pool_checked_out", "Занятые соединения пула", ("engine",),
+    callback=_pool_checked_out
+))
+registry.register(Gauge(
+    "omega_db_admission_queue_depth", "Запросы в очереди на допуск к БД", ("priority",),
+    callback=lambda: {(name,): count for name, count in admission.queued.items()}
+))
+registry.register(Gauge(
+    "omega_db_admission_in_use", "Допущенные к БД запросы",
+    callback=lambda: {(): admission.in_use}
+))
+registry.register(Gauge(
+    "omega_hot_tail_chats", "Чаты, чьи последние сообщения лежат в памяти",
+    callback=lambda: {(): len(hot_tails.tails)}
+))
+
+
+
+async def require_metrics_access(request: Request, token: Optional[str] = None):
+    """/metrics: сборщик с METRICS_TOKEN или администратор со своим токеном"""
+    if METRICS_TOKEN:
+        presented = request.headers.get("authorization", "").encode()
+        if hmac.compare_digest(presented, f"Bearer {METRICS_TOKEN}".encode()):
+            return
+    if token is None:
+        raise HTTPException(status_code=401, detail="Нужна авторизация", headers={"WWW-Authenticate": "Bearer"})
+    await get_admin_user(await get_current_user(token))
+
+
+@app.get("/metrics", response_class=PlainTextResponse, dependencies=[Depends(require_metrics_access)])
+async def get_metrics():
+    """Метрики в формате Prometheus"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+# ============ ДИАГНОСТИКА ============
+# Всё про текущий воркер: при нескольких воркерах ответ приходит от того, к кому попал запрос (см. pid)
+
+@app.get("/admin/profile", response_class=PlainTextResponse)
+async def profile_worker(
+    seconds: float = 10,
+    fraction: float = 1.0,
+    admin: dict = Depends(get_admin_user)
+):
+    """Профиль воркера за seconds секунд: свёрнутые стеки для flamegraph.pl / speedscope.
+
+    fraction < 1 — профилировать только такую долю запросов (корень стека — маршрут).
+    """
+    if not 0 < seconds <= PROFILER_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds: от 0 до {PROFILER_MAX_SECONDS:g}")
+    if not 0 < fraction <= 1:
+        raise HTTPException(status_code=400, detail="fraction: от 0 до 1")
+    
+    try:
+        folded = await profiler.profile(seconds, fraction)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    return PlainTextResponse(folded, headers={
+        "X-Profiler-Pid": str(os.getpid()),
+        "X-Profiler-Samples": str(profiler.samples)
+    })
+
+
+@app.get("/admin/loop")
+async def get_loop_status(admin: dict = Depends(get_admin_user)):
+    """Задержка event loop и последние блокировки со стеками"""
+    return loop_monitor.report()
+
+
+@app.post("/admin/drain")
+async def drain_worker(admin: dict = Depends(get_admin_user)):
+    """Вывести воркер из работы перед перезапуском: новые сокеты не принимать, открытые закрыть за DRAIN_SECONDS"""
+    drainer.start(manager.registry, manager.send)
+    return drainer.report()
+
+
+@app.get("/admin/drain")
+async def get_drain_status(admin: dict = Depends(get_admin_user)):
+    return drainer.report()
+
 
 @app.post("/register", response_model=UserResponse)
 async def register_user(user_data: UserCreate):
     """Регистрация нового пользователя"""
-    async with async_session_factory() as session:
+    async with admission.admit("default"), async_session_factory() as session:
         # Проверяем существование
         query = select(User).where(
             or_(
@@ -191,6 +500,7 @@ async def register_user(user_data: UserCreate):
         session.add(new_user)
         await session.commit()
         await session.refresh(new_user)
+        await response_cache.invalidate("users")
         
         return new_user
 
@@ -198,7 +508,7 @@ async def register_user(user_data: UserCreate):
 @app.post("/login", response_model=Token)
 async def login(login_data: UserLogin):
     """Вход в аккаунт"""
-    async with async_session_factory() as session:
+    async with admission.admit("default"), async_session_factory() as session:
         query = select(User).where(User.email == login_data.email)
         result = await session.execute(query)
         user = result.scalar_one_or_none()
@@ -209,6 +519,7 @@ async def login(login_data: UserLogin):
         user.is_online = True
         user.last_seen = datetime.utcnow()
         await session.commit()
+        await response_cache.invalidate(f"presence:{user.id}")
         
         access_token = create_access_token(data={
             "sub": str(user.id),
@@ -222,7 +533,7 @@ async def login(login_data: UserLogin):
 @app.get("/me", response_model=UserResponse)
 async def get_me(current_user: dict = Depends(get_current_user)):
     """Получить свой профиль"""
-    async with async_session_factory() as session:
+    async with admission.admit("default"), async_session_factory() as session:
         query = select(User).where(User.id == current_user["id"])
         result = await session.execute(query)
         user = result.scalar_one_or_none()
@@ -239,7 +550,7 @@ async def update_avatar(
     current_user: dict = Depends(get_current_user)
 ):
     """Обновить аватар"""
-    async with async_session_factory() as session:
+    async with admission.admit("default"), async_session_factory() as session:
         query = select(User).where(User.id == current_user["id"])
         result = await session.execute(query)
         user = result.scalar_one_or_none()
@@ -249,6 +560,9 @@ async def update_avatar(
         
         user.avatar_url = data.avatar_url
         await session.commit()
+        mark_written(user.id)
+        hot_tails.update_profile(user.id, user.username, user.avatar_url)
+        await response_cache.invalidate(f"profile:{user.id}")
         
         return {"status": "ok", "avatar_url": user.avatar_url}
 
@@ -259,7 +573,7 @@ async def update_profile(
     current_user: dict = Depends(get_current_user)
 ):
     """Обновить профиль"""
-    async with async_session_factory() as session:
+    async with admission.admit("default"), async_session_factory() as session:
         query = select(User).where(User.id == current_user["id"])
         result = await session.execute(query)
         user = result.scalar_one_or_none()
@@ -279,10 +593,14 @@ async def update_profile(
             user.status = data.status
         
         await session.commit()
+        mark_written(user.id)
+        hot_tails.update_profile(user.id, user.username, user.avatar_url)
+        await response_cache.invalidate(f"profile:{user.id}")
         
         return {"status": "ok"}
 
 @app.get("/users/{user_id}/status")
+@response_cache.cached(ttl=30, tags=lambda result, user_id, **_: [f"presence:{user_id}"])
 async def get_user_status(
     user_id: int,
     current_user: dict = Depends(get_current_user)
@@ -293,7 +611,7 @@ async def get_user_status(
     if is_online:
         return {"is_online": True, "last_seen": None}
     
-    async with async_session_factory() as session:
+    async with admission.admit("default"), read_session(current_user["id"]) as session:
         query = select(User).where(User.id == user_id)
         result = await session.execute(query)
         user = result.scalar_one_or_none()
@@ -306,15 +624,94 @@ async def get_user_status(
             "last_seen": user.last_seen.isoformat() if user.last_seen else None
         }
 
+
+# Сколько пользователей можно запросить в /users/batch за раз
+USERS_BATCH_MAX = int(os.getenv("USERS_BATCH_MAX", "200"))
+
+
+def _profile_version(profile: dict) -> str:
+    """Версия карточки: меняется вместе с любым её полем"""
+    raw = json.dumps(profile, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+
+def _if_none_match(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # Слабое сравнение: W/"x" и "x" — одна версия
+    return etag.removeprefix("W/") in {tag.strip().removeprefix("W/") for tag in header.split(",")}
+
+
+@app.get("/users/batch")
+async def get_users_batch(
+    request: Request,
+    ids: str = Query(..., description="id через запятую"),
+    current_user: dict = Depends(get_current_user)
+):
+    """Публичные профили и статусы нескольких пользователей одним запросом.
+
+    У каждой карточки есть version, у всего ответа — ETag: с If-None-Match
+    неизменившийся набор отдаётся как 304 без тела.
+    """
+    try:
+        user_ids = sorted({int(x) for x in ids.split(",") if x.strip()})
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids: целые числа через запятую")
+    if not user_ids:
+        raise HTTPException(status_code=400, detail="ids: укажите хотя бы одного пользователя")
+    if len(user_ids) > USERS_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"ids: не больше {USERS_BATCH_MAX} за раз")
+    
+    await enforce_rate_limit("users_batch", current_user["id"])
+    
+    async with admission.admit("default"), read_session(current_user["id"]) as session:
+        # Один запрос по первичному ключу, только публичные поля
+        query = select(
+            User.id, User.username, User.avatar_url, User.status, User.last_seen
+        ).where(User.id.in_(user_ids))
+        rows = (await session.execute(query)).all()
+    
+    users = []
+    for row in sorted(rows, key=lambda r: r.id):
+        is_online = manager.is_user_online(row.id)
+        profile = {
+            "id": row.id,
+            "username": row.username,
+            "avatar_url": row.avatar_url,
+            "status": row.status,
+            "is_online": is_online,
+            "last_seen": None if is_online or not row.last_seen else row.last_seen.isoformat()
+        }
+        profile["version"] = _profile_version(profile)
+        users.append(profile)
+    
+    found = {u["id"] for u in users}
+    missing = [user_id for user_id in user_ids if user_id not in found]
+    
+    digest = hashlib.sha1(
+        ";".join(f"{u['id']}:{u['version']}" for u in users).encode() + f"|{missing}".encode()
+    ).hexdigest()[:20]
+    etag = f'W/"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if _if_none_match(request, etag):
+        return Response(status_code=304, headers=headers)
+    
+    return JSONResponse({"users": users, "missing": missing}, headers=headers)
+
+
 @app.post("/chats/{chat_id}/read")
 async def mark_messages_read(
     chat_id: int,
+    message_id: Optional[int] = None,
     current_user: dict = Depends(get_current_user)
 ):
-    """Отметить сообщения как прочитанные"""
+    """Отметить сообщения как прочитанные (до message_id или все)"""
     my_id = current_user["id"]
     
-    async with async_session_factory() as session:
+    async with admission.admit("write"), async_session_factory() as session:
         chat_query = select(DirectChat).where(
             and_(
                 DirectChat.id == chat_id,
@@ -330,38 +727,39 @@ async def mark_messages_read(
         if not chat:
             raise HTTPException(status_code=404, detail="Чат не найден")
         
-        await session.execute(
-            Message.__table__.update()
-            .where(
-                and_(
-                    Message.chat_id == chat_id,
-                    Message.sender_id != my_id,
-                    Message.is_read == False
-                )
-            )
-            .values(is_read=True)
-        )
+        last_read_id = await mark_read(session, chat_id, my_id, message_id)
         await session.commit()
-        
-        room_id = f"dm_{chat_id}"
+    mark_written(my_id)
+    hot_tails.mark_read(chat_id, my_id, last_read_id)
+    
+    # Рассылка — после того, как слот записи и соединение с БД отпущены
+    if last_read_id is not None:
         read_notification = json.dumps({
             "type": "messages_read",
             "chat_id": chat_id,
-            "reader_id": my_id
+            "reader_id": my_id,
+            "last_read_message_id": last_read_id
         })
-        await manager.broadcast(read_notification, room_id)
-        
-        return {"status": "ok"}
+        await manager.broadcast(read_notification, chat_id)
+    
+    return {"status": "ok", "last_read_message_id": last_read_id}
     
 
 
 @app.get("/users/search")
+@response_cache.cached(
+    ttl=30,
+    per_user=True,
+    tags=lambda result, **_: ["users"] + [t for u in result for t in (f"profile:{u['id']}", f"presence:{u['id']}")]
+)
 async def search_users(
     q: str,
     current_user: dict = Depends(get_current_user)
 ):
     """Поиск пользователей по никнейму"""
-    async with async_session_factory() as session:
+    await enforce_rate_limit("search_user", current_user["id"])
+    
+    async with admission.admit("default"), read_session(current_user["id"]) as session:
         query = select(User).where(
             and_(
                 User.username.ilike(f"%{q}%"),
@@ -388,7 +786,7 @@ async def get_my_direct_chats(current_user: dict = Depends(get_current_user)):
     """Получить список личных чатов"""
     my_id = current_user["id"]
     
-    async with async_session_factory() as session:
+    async with admission.admit("default"), read_session(my_id) as session:
         query = select(DirectChat).where(
             or_(
                 DirectChat.user1_id == my_id,
@@ -397,30 +795,56 @@ async def get_my_direct_chats(current_user: dict = Depends(get_current_user)):
         )
         result = await session.execute(query)
         chats = result.scalars().all()
-        
-        response = []
-        for chat in chats:
-            friend_id = chat.user2_id if chat.user1_id == my_id else chat.user1_id
-            
-            friend_query = select(User).where(User.id == friend_id)
-            friend_result = await session.execute(friend_query)
-            friend = friend_result.scalar_one()
-            
-            last_msg_query = select(Message).where(
-                Message.chat_id == chat.id
-            ).order_by(Message.created_at.desc()).limit(1)
-            last_msg_result = await session.execute(last_msg_query)
-            last_msg = last_msg_result.scalar_one_or_none()
-            
-            unread_query = select(func.count(Message.id)).where(
-                and_(
-                    Message.chat_id == chat.id,
-                    Message.sender_id != my_id,
-                    Message.is_read == False
+        chat_ids = [chat.id for chat in chats]
+        friend_ids = [chat.user2_id if chat.user1_id == my_id else chat.user1_id for chat in chats]
+
+        # По одному запросу на всё, а не на каждый чат: собеседники, последние сообщения, непрочитанные
+        friends = {}
+        last_messages = {}
+        unread_counts = {}
+        if chats:
+            friends_result = await session.execute(select(User).where(User.id.in_(friend_ids)))
+            friends = {u.id: u for u in friends_result.scalars().all()}
+
+            last_seq = (
+                select(Message.chat_id, func.max(Message.seq).label("seq"))
+                .where(Message.chat_id.in_(chat_ids))
+                .group_by(Message.chat_id)
+                .subquery()
+            )
+            last_msg_result = await session.execute(
+                select(Message).join(last_seq, and_(Message.chat_id == last_seq.c.chat_id, Message.seq == last_seq.c.seq))
+            )
+            last_messages = {m.chat_id: m for m in last_msg_result.scalars().all()}
+
+            unread_query = (
+                select(Message.chat_id, func.count(Message.id))
+                .outerjoin(
+                    ChatReadState,
+                    and_(ChatReadState.chat_id == Message.chat_id, ChatReadState.user_id == my_id)
                 )
+                .where(
+                    and_(
+                        Message.chat_id.in_(chat_ids),
+                        Message.sender_id != my_id,
+                        Message.id > func.coalesce(ChatReadState.last_read_message_id, 0)
+                    )
+                )
+                .group_by(Message.chat_id)
             )
-            unread_result = await session.execute(unread_query)
-            unread_count = unread_result.scalar() or 0
+            unread_counts = dict((await session.execute(unread_query)).all())
+
+        response = []
+        for chat, friend_id in zip(chats, friend_ids):
+            friend = friends[friend_id]
+            last_msg = last_messages.get(chat.id)
+            last_text, last_at = (last_msg.text, last_msg.created_at) if last_msg else (None, None)
+            if last_msg is None:
+                # Чат молчит дольше горячего окна — последнее сообщение уже в архиве
+                archived = await read_archived_messages(session, chat.id, 0, 1)
+                if archived:
+                    last_text, last_at = archived[0]["text"], archived[0]["created_at"]
+            unread_count = unread_counts.get(chat.id, 0)
             
             response.append({
                 "id": chat.id,
@@ -428,8 +852,8 @@ async def get_my_direct_chats(current_user: dict = Depends(get_current_user)):
                 "username": friend.username,
                 "avatar_url": friend.avatar_url,
                 "is_online": manager.is_user_online(friend_id),
-                "last_message": last_msg.text if last_msg else None,
-                "time": format_time(last_msg.created_at) if last_msg else None,
+                "last_message": last_text,
+                "time": format_time(last_at) if last_at else None,
                 "unread_count": unread_count
             })
         
@@ -441,6 +865,34 @@ async def get_my_direct_chats(current_user: dict = Depends(get_current_user)):
         return response
 
 
+@app.get("/sync")
+async def sync_changes(
+    cursor: Optional[str] = None,
+    limit: int = Query(SYNC_MAX_MESSAGES, ge=1, le=SYNC_MAX_MESSAGES),
+    current_user: dict = Depends(get_current_user)
+):
+    """Все изменения во всех чатах с прошлого курсора: новые сообщения, прочтения, новые чаты.
+
+    Заменяет /me/directs + /chats/{id}/messages по каждому чату при возврате в приложение.
+    Пока has_more — вызывать снова с новым курсором. Курсор — короткий id, сколько бы ни было чатов;
+    400 на курсор — он истёк (SYNC_CURSOR_TTL_DAYS), начать заново без курсора.
+    """
+    user_id = current_user["id"]
+    async with admission.admit("history"), read_session(user_id) as session:
+        try:
+            changes = await collect_changes(session, user_id, cursor, limit)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Некорректный курсор")
+
+    state = changes.pop("state")
+    # Ничего не изменилось — тот же курсор, без записи в БД на каждый опрос
+    if not changes.pop("unchanged"):
+        async with admission.admit("write"):
+            cursor = await save_cursor(async_session_factory, user_id, state)
+        mark_written(user_id)  # Следующий /sync прочитает курсор из основной БД, а не с отстающей реплики
+    return {"cursor": cursor, **changes}
+
+
 @app.post("/direct/start")
 async def start_direct_chat(
     target_user_id: int,
@@ -452,7 +904,7 @@ async def start_direct_chat(
     if target_user_id == my_id:
         raise HTTPException(status_code=400, detail="Нельзя создать чат с собой")
     
-    async with async_session_factory() as session:
+    async with admission.admit("default"), async_session_factory() as session:
         target_query = select(User).where(User.id == target_user_id)
         target_result = await session.execute(target_query)
         target_user = target_result.scalar_one_or_none()
@@ -481,6 +933,8 @@ async def start_direct_chat(
         session.add(new_chat)
         await session.commit()
         await session.refresh(new_chat)
+        mark_written(my_id, target_user_id)
+        presence.chat_created(my_id, target_user_id)
         
         return {
             "id": new_chat.id,
@@ -500,7 +954,13 @@ async def get_chat_messages(
     """Получить историю сообщений чата"""
     my_id = current_user["id"]
     
-    async with async_session_factory() as session:
+    # Первая страница активного чата — из памяти; за архивом и старыми страницами идём в БД
+    tail = hot_tails.get(chat_id) if offset == 0 else None
+    if tail is not None and tail.is_member(my_id) and 0 < limit <= len(tail.messages):
+        return hot_tails.history(tail, chat_id, limit)
+    
+    started = hot_tails.begin_load()
+    async with admission.admit("history"), read_session(my_id) as session:
         chat_query = select(DirectChat).where(
             and_(
                 DirectChat.id == chat_id,
@@ -520,17 +980,21 @@ async def get_chat_messages(
             select(Message, User)
             .join(User, Message.sender_id == User.id)
             .where(Message.chat_id == chat_id)
-            .order_by(Message.created_at.desc())
+            .order_by(Message.seq.desc())
             .limit(limit)
             .offset(offset)
         )
         
         result = await session.execute(messages_query)
         messages = result.all()
+        watermarks = await get_chat_watermarks(session, chat_id)
+        if offset == 0 and limit >= HOT_TAIL_SIZE:
+            hot_tails.fill(chat_id, chat, list(reversed(messages)), watermarks, started)
         
-        return [
+        response = [
             {
                 "id": msg.id,
+                "seq": msg.seq,
                 "chat_id": msg.chat_id,
                 "sender_id": msg.sender_id,
                 "username": user.username,
@@ -538,10 +1002,65 @@ async def get_chat_messages(
                 "text": msg.text,
                 "image": msg.image_url,
                 "time": msg.created_at.strftime("%H:%M"),
-                "is_read": msg.is_read
+                "is_read": is_read_by_other(msg.id, msg.sender_id, chat, watermarks)
             }
             for msg, user in reversed(messages)
         ]
+        
+        # Горячая таблица закончилась — дочитываем из архива
+        if len(messages) < limit:
+            hot_count = offset + len(messages)
+            if not messages and offset:
+                count_query = select(func.count(Message.id)).where(Message.chat_id == chat_id)
+                hot_count = (await session.execute(count_query)).scalar() or 0
+            
+            archived = await read_archived_messages(
+                session, chat_id, max(0, offset - hot_count), limit - len(messages)
+            )
+            response = await archived_history(session, chat, archived, watermarks) + response
+        
+        return response
+
+@app.get("/chats/{chat_id}/export")
+async def export_chat_history(
+    chat_id: int,
+    gzip: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """Выгрузить всю историю чата потоком NDJSON (gzip=true — сразу сжатым файлом)"""
+    my_id = current_user["id"]
+    await enforce_rate_limit("export_user", my_id)
+    
+    async with admission.admit("default"), read_session(my_id) as session:
+        chat_query = select(DirectChat).where(
+            and_(
+                DirectChat.id == chat_id,
+                or_(
+                    DirectChat.user1_id == my_id,
+                    DirectChat.user2_id == my_id
+                )
+            )
+        )
+        chat = (await session.execute(chat_query)).scalar_one_or_none()
+        
+        if not chat:
+            raise HTTPException(status_code=404, detail="Чат не найден")
+    
+    # Выгрузка — длинное чтение: на реплику, основная БД остаётся чату
+    body = export_chat(lambda: read_session(my_id), chat)
+    filename = f"chat_{chat_id}.ndjson"
+    media_type = "application/x-ndjson"
+    if gzip:
+        body = gzip_stream(body)
+        filename += ".gz"
+        media_type = "application/gzip"
+    
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 
 @app.post("/games/create")
 async def create_game(
@@ -557,7 +1076,7 @@ async def create_game(
     if not chat_id and not group_id:
         raise HTTPException(status_code=400, detail="Укажите chat_id или group_id")
     
-    async with async_session_factory() as session:
+    async with admission.admit("default"), async_session_factory() as session:
         new_game = GameSession(
             game_type=game_type,
             chat_id=chat_id,
@@ -590,7 +1109,7 @@ async def join_game(
     current_user: dict = Depends(get_current_user)
 ):
     """Присоединиться к игре"""
-    async with async_session_factory() as session:
+    async with admission.admit("default"), async_session_factory() as session:
         query = select(GameSession).where(GameSession.id == session_id)
         result = await session.execute(query)
         game = result.scalar_one_or_none()
@@ -615,6 +1134,7 @@ async def join_game(
             user_id=current_user["id"]
         )
         session.add(player)
+        game.updated_at = datetime.utcnow()  # игра жива — не считать её брошенной
         await session.commit()
         
         return {"status": "joined", "session_id": session_id}
@@ -626,7 +1146,7 @@ async def start_game(
     current_user: dict = Depends(get_current_user)
 ):
     """Начать игру"""
-    async with async_session_factory() as session:
+    async with admission.admit("default"), async_session_factory() as session:
         query = select(GameSession).where(GameSession.id == session_id)
         result = await session.execute(query)
         game = result.scalar_one_or_none()
@@ -651,7 +1171,7 @@ async def game_action(
     current_user: dict = Depends(get_current_user)
 ):
     """Действие в игре (бросить кубик, выбрать вариант и т.д.)"""
-    async with async_session_factory() as session:
+    async with admission.admit("default"), async_session_factory() as session:
         query = select(GameSession).where(GameSession.id == session_id)
         result = await session.execute(query)
         game = result.scalar_one_or_none()
@@ -663,6 +1183,7 @@ async def game_action(
             raise HTTPException(status_code=400, detail="Игра не активна")
         
         response = {}
+        game.updated_at = datetime.utcnow()  # игра жива — не считать её брошенной
         
         if game.game_type == "dice" and action == "roll":
             roll_result = random.randint(1, 6)
@@ -721,6 +1242,28 @@ async def game_action(
                     "result": winner[1].username
                 }
         
+        elif game.game_type in WORD_GAMES:
+            players_query = select(GamePlayer).where(
+                GamePlayer.session_id == session_id
+            ).order_by(GamePlayer.id)
+            players = (await session.execute(players_query)).scalars().all()
+            
+            state = json.loads(game.data) if game.data else {}
+            try:
+                response, scores = play_word_game(
+                    game.game_type, state, action, data or {},
+                    current_user["id"], [p.user_id for p in players]
+                )
+            except WordGameError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            
+            for player in players:
+                player.score = (player.score or 0) + scores.get(player.user_id, 0)
+                if player.user_id in state.get("winner_ids", ()):
+                    player.is_winner = True
+            game.data = json.dumps(state, ensure_ascii=False)
+        
+        await session.commit()
         return response
 
 
@@ -731,7 +1274,7 @@ async def end_game(
     current_user: dict = Depends(get_current_user)
 ):
     """Завершить игру"""
-    async with async_session_factory() as session:
+    async with admission.admit("default"), async_session_factory() as session:
         query = select(GameSession).where(GameSession.id == session_id)
         result = await session.execute(query)
         game = result.scalar_one_or_none()
@@ -746,6 +1289,7 @@ async def end_game(
         players_result = await session.execute(players_query)
         players = players_result.scalars().all()
         
+        updated_stats = []
         for player in players:
             stats_query = select(GameStats).where(
                 and_(
@@ -759,7 +1303,11 @@ async def end_game(
             if not stats:
                 stats = GameStats(
                     user_id=player.user_id,
-                    game_type=game.game_type
+                    game_type=game.game_type,
+                    games_played=0,
+                    games_won=0,
+                    total_score=0,
+                    best_score=0
                 )
                 session.add(stats)
             
@@ -769,19 +1317,27 @@ async def end_game(
             if player.score > stats.best_score:
                 stats.best_score = player.score
             
-            if winner_id and player.user_id == winner_id:
+            if (winner_id and player.user_id == winner_id) or player.is_winner:
                 player.is_winner = True
                 stats.games_won += 1
+            
+            updated_stats.append(stats)
         
         await session.commit()
+        mark_written(*(player.user_id for player in players))
+        await response_cache.invalidate(*(f"game_stats:{player.user_id}" for player in players))
+        
+        for stats in updated_stats:
+            leaderboards.update_from_stats(stats)
         
         return {"status": "finished", "session_id": session_id}
 
 
 @app.get("/games/stats")
+@response_cache.cached(ttl=60, per_user=True, tags=lambda result, current_user, **_: [f"game_stats:{current_user['id']}"])
 async def get_my_game_stats(current_user: dict = Depends(get_current_user)):
     """Получить свою статистику"""
-    async with async_session_factory() as session:
+    async with admission.admit("default"), read_session(current_user["id"]) as session:
         query = select(GameStats).where(GameStats.user_id == current_user["id"])
         result = await session.execute(query)
         stats = result.scalars().all()
@@ -800,12 +1356,13 @@ async def get_my_game_stats(current_user: dict = Depends(get_current_user)):
 
 
 @app.get("/games/stats/{user_id}")
+@response_cache.cached(ttl=60, tags=lambda result, user_id, **_: [f"game_stats:{user_id}"])
 async def get_user_game_stats(
     user_id: int,
     current_user: dict = Depends(get_current_user)
 ):
     """Получить статистику пользователя"""
-    async with async_session_factory() as session:
+    async with admission.admit("default"), read_session(current_user["id"]) as session:
         query = select(GameStats).where(GameStats.user_id == user_id)
         result = await session.execute(query)
         stats = result.scalars().all()
@@ -822,19 +1379,76 @@ async def get_user_game_stats(
         ]
 
 
+@app.get("/games/leaderboard/{game_type}")
+async def get_leaderboard(
+    game_type: str,
+    by: str = "wins",
+    limit: int = Query(10, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    current_user: dict = Depends(get_current_user)
+):
+    """Топ игроков по типу игры"""
+    if game_type not in GAME_TYPES:
+        raise HTTPException(status_code=400, detail="Неизвестный тип игры")
+    if by not in LEADERBOARD_METRICS:
+        raise HTTPException(status_code=400, detail="Неизвестная метрика рейтинга")
+    
+    await leaderboards.ensure_loaded(async_session_factory)
+    top = leaderboards.get(game_type).top(by, limit, offset)
+    if not top:
+        return []
+    
+    async with admission.admit("default"), read_session(current_user["id"]) as session:
+        query = select(User.id, User.username, User.avatar_url).where(
+            User.id.in_([row["user_id"] for row in top])
+        )
+        users = {row.id: row for row in (await session.execute(query)).all()}
+    
+    return [
+        {
+            **row,
+            "username": users[row["user_id"]].username if row["user_id"] in users else None,
+            "avatar_url": users[row["user_id"]].avatar_url if row["user_id"] in users else None
+        }
+        for row in top
+    ]
+
+
+@app.get("/games/leaderboard/{game_type}/me")
+async def get_my_rank(
+    game_type: str,
+    by: str = "wins",
+    current_user: dict = Depends(get_current_user)
+):
+    """Своё место в рейтинге"""
+    if game_type not in GAME_TYPES:
+        raise HTTPException(status_code=400, detail="Неизвестный тип игры")
+    if by not in LEADERBOARD_METRICS:
+        raise HTTPException(status_code=400, detail="Неизвестная метрика рейтинга")
+    
+    await leaderboards.ensure_loaded(async_session_factory)
+    board = leaderboards.get(game_type)
+    rank = board.rank(current_user["id"], by)
+    if not rank:
+        raise HTTPException(status_code=404, detail="Вы ещё не играли в эту игру")
+    
+    return {**rank, "total_players": len(board)}
+
+
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(request: Request, file: UploadFile = File(...)):
     """Загрузить файл (изображение)"""
-    allowed_types = ["image/jpeg", "image/png", "image/gif", "image/webp"]
-    if file.content_type not in allowed_types:
+    await enforce_rate_limit("upload_client", request.client.host if request.client else "unknown")
+    
+    extension = file_extension(file.filename or "")
+    if file.content_type not in ALLOWED_UPLOAD_TYPES or extension is None:
         raise HTTPException(status_code=400, detail="Разрешены только изображения")
         
     contents = await file.read()
     if len(contents) > 10 * 1024 * 1024:
         raise HTTPException(status_code=400, detail="Файл слишком большой (макс. 10MB)")
     
-    file_extension = file.filename.split(".")[-1] if "." in file.filename else "jpg"
-    unique_filename = f"{uuid.uuid4()}.{file_extension}"
+    unique_filename = f"{uuid.uuid4()}.{extension}"
     file_path = f"uploads/{unique_filename}"
     
     with open(file_path, "wb") as buffer:
@@ -843,14 +1457,148 @@ async def upload_file(file: UploadFile = File(...)):
     return {"url": f"/uploads/{unique_filename}"}
 
 
+# ============ ДОКАЧИВАЕМЫЕ ЗАГРУЗКИ ============
+# POST /upload/sessions -> PUT куски по offset -> GET текущий offset после обрыва -> POST .../complete
+
+async def get_upload_session(session, upload_id: str, user_id: int) -> UploadSession:
+    upload = await session.get(UploadSession, upload_id)
+    if not upload or upload.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Загрузка не найдена")
+    if upload.status != "active":
+        raise HTTPException(status_code=409, detail="Загрузка уже завершена")
+    return upload
+
+
+@app.post("/upload/sessions")
+async def create_upload_session(
+    request: Request,
+    filename: str,
+    content_type: str,
+    size: int = Query(..., gt=0),
+    current_user: dict = Depends(get_current_user)
+):
+    """Начать докачиваемую загрузку"""
+    await enforce_rate_limit("upload_client", request.client.host if request.client else "unknown")
+    
+    if content_type not in ALLOWED_UPLOAD_TYPES or file_extension(filename) is None:
+        raise HTTPException(status_code=400, detail="Разрешены только изображения")
+    if size > UPLOAD_MAX_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Файл слишком большой (макс. {UPLOAD_MAX_SIZE // (1024 * 1024)}MB)"
+        )
+    
+    upload_id = str(uuid.uuid4())
+    create_temp_file(upload_id)
+    async with admission.admit("default"), async_session_factory() as session:
+        session.add(UploadSession(
+            id=upload_id,
+            user_id=current_user["id"],
+            filename=filename[:255],
+            content_type=content_type,
+            size=size,
+            received=0
+        ))
+        await session.commit()
+    
+    return {"upload_id": upload_id, "offset": 0, "size": size, "chunk_max": UPLOAD_CHUNK_MAX}
+
+
+@app.get("/upload/sessions/{upload_id}")
+async def get_upload_offset(upload_id: str, current_user: dict = Depends(get_current_user)):
+    """Сколько байт сервер уже получил — с этого места продолжать"""
+    async with admission.admit("default"), async_session_factory() as session:
+        upload = await get_upload_session(session, upload_id, current_user["id"])
+        return {"upload_id": upload.id, "offset": upload.received, "size": upload.size}
+
+
+@app.put("/upload/sessions/{upload_id}")
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0),
+    current_user: dict = Depends(get_current_user)
+):
+    """Дописать кусок (тело запроса как есть) с позиции offset"""
+    async with admission.admit("default"), async_session_factory() as session:
+        upload = await get_upload_session(session, upload_id, current_user["id"])
+    
+    if offset != upload.received:
+        raise HTTPException(
+            status_code=409,
+            detail="Неверное смещение",
+            headers={"Upload-Offset": str(upload.received)}
+        )
+    
+    lock = upload_locks.setdefault(upload_id, asyncio.Lock())
+    if lock.locked():
+        raise HTTPException(status_code=409, detail="Кусок уже загружается")
+    
+    try:
+        async with lock:
+            # Соединение с БД на время передачи не держим — клиент может быть медленным
+            max_bytes = min(UPLOAD_CHUNK_MAX, upload.size - offset)
+            written, too_large = await write_chunk(upload_id, offset, request.stream(), max_bytes)
+            
+            async with admission.admit("default"), async_session_factory() as session:
+                upload = await get_upload_session(session, upload_id, current_user["id"])
+                upload.received = offset + written
+                upload.updated_at = datetime.utcnow()
+                await session.commit()
+    finally:
+        # Замок нужен только на время куска: у брошенной загрузки он иначе остался бы навсегда
+        if upload_locks.get(upload_id) is lock and not lock.locked():
+            del upload_locks[upload_id]
+    
+    if too_large:
+        raise HTTPException(
+            status_code=413,
+            detail="Кусок больше допустимого",
+            headers={"Upload-Offset": str(offset + written)}
+        )
+    
+    return {"upload_id": upload_id, "offset": offset + written, "size": upload.size}
+
+
+@app.post("/upload/sessions/{upload_id}/complete")
+async def complete_upload(upload_id: str, current_user: dict = Depends(get_current_user)):
+    """Завершить загрузку: файл переносится к остальным без перечитывания"""
+    async with admission.admit("default"), async_session_factory() as session:
+        upload = await get_upload_session(session, upload_id, current_user["id"])
+        if upload.received != upload.size:
+            raise HTTPException(
+                status_code=409,
+                detail="Файл загружен не полностью",
+                headers={"Upload-Offset": str(upload.received)}
+            )
+        
+        url = await asyncio.to_thread(finalize, upload_id, upload.filename)
+        upload.status = "complete"
+        upload.updated_at = datetime.utcnow()
+        await session.commit()
+    
+    discard(upload_id)
+    return {"url": url}
+
+
+# Сколько последних сообщений отдаётся при подключении к /ws/dm
+WS_HISTORY_LIMIT = 50
+
+
 @app.websocket("/ws/dm/{chat_id}")
 async def websocket_dm(
     websocket: WebSocket,
     chat_id: int,
-    token: str = Query(...)
+    token: str = Query(...),
+    reconnect_hint: bool = Query(False)
 ):
     """WebSocket для личных сообщений"""
     
+    if drainer.draining:
+        # Воркер выводится из работы: клиент переподключится к другому
+        await websocket.close(code=DRAIN_CLOSE_CODE)
+        return
+    
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id = int(payload.get("sub"))
@@ -859,121 +1607,264 @@ async def websocket_dm(
         await websocket.close(code=4001)
         return
     
-    async with async_session_factory() as session:
-        chat_query = select(DirectChat).where(
-            and_(
-                DirectChat.id == chat_id,
-                or_(
-                    DirectChat.user1_id == user_id,
-                    DirectChat.user2_id == user_id
+    # Участники активного чата известны из его хвоста в памяти
+    chat = hot_tails.get(chat_id)
+    try:
+        if chat is None:
+            async with admission.admit("history"), async_session_factory() as session:
+                chat_query = select(DirectChat).where(
+                    and_(
+                        DirectChat.id == chat_id,
+                        or_(
+                            DirectChat.user1_id == user_id,
+                            DirectChat.user2_id == user_id
+                        )
+                    )
                 )
-            )
-        )
-        result = await session.execute(chat_query)
-        chat = result.scalar_one_or_none()
+                result = await session.execute(chat_query)
+                chat = result.scalar_one_or_none()
         
-        if not chat:
+        if not chat or user_id not in (chat.user1_id, chat.user2_id):
             await websocket.close(code=4003)
             return
+    except Overloaded:
+        # Не пускаем новое соединение, пока БД перегружена: клиент переподключится позже
+        await websocket.close(code=1013)
+        return
     
-    room_id = f"dm_{chat_id}"
-    await manager.connect(websocket, room_id, user_id)
+    friend_id = chat.user2_id if chat.user1_id == user_id else chat.user1_id
+    conn = await manager.connect(websocket, chat_id, user_id, reconnect_hint)
     
     try:
-        async with async_session_factory() as session:
-            query = (
-                select(Message, User)
-                .join(User, Message.sender_id == User.id)
-                .where(Message.chat_id == chat_id)
-                .order_by(Message.created_at.desc())
-                .limit(50)
-            )
-            result = await session.execute(query)
-            messages = list(reversed(result.all()))
+        with track_queries("WS /ws/dm/{chat_id} history"):
+            tail = hot_tails.get(chat_id)
+            if tail is not None and tail.covers(WS_HISTORY_LIMIT):
+                history = hot_tails.history(tail, chat_id, WS_HISTORY_LIMIT)
+            else:
+                older = []
+                try:
+                    started = hot_tails.begin_load()
+                    async with admission.admit("history"), read_session(user_id) as session:
+                        query = (
+                            select(Message, User)
+                            .join(User, Message.sender_id == User.id)
+                            .where(Message.chat_id == chat_id)
+                            .order_by(Message.seq.desc())
+                            .limit(max(WS_HISTORY_LIMIT, HOT_TAIL_SIZE))
+                        )
+                        result = await session.execute(query)
+                        messages = list(reversed(result.all()))
+                        watermarks = await get_chat_watermarks(session, chat_id)
+                        if len(messages) < WS_HISTORY_LIMIT:
+                            # Горячая таблица кончилась — остаток реплея из архива
+                            archived = await read_archived_messages(
+                                session, chat_id, 0, WS_HISTORY_LIMIT - len(messages)
+                            )
+                            older = await archived_history(session, chat, archived, watermarks)
+                    if not older:
+                        # Хвост с архивными сообщениями не совпал бы с горячей таблицей — не кладём
+                        hot_tails.fill(chat_id, chat, messages, watermarks, started)
+                    messages = messages[-WS_HISTORY_LIMIT:]
+                except Overloaded as e:
+                    # Историю клиент догрузит через /sync, когда нагрузка спадёт
+                    messages, watermarks = [], {}
+                    await manager.send(conn, json.dumps(overloaded_frame(e.retry_after)))
+                
+                history = older + [
+                    {
+                        "id": msg.id,
+                        "seq": msg.seq,
+                        "username": user.username,
+                        "user_avatar": user.avatar_url,
+                        "text": msg.text,
+                        "image": msg.image_url,
+                        "time": msg.created_at.strftime("%H:%M"),
+                        "chat_id": chat_id,
+                        "sender_id": msg.sender_id,
+                        "is_read": is_read_by_other(msg.id, msg.sender_id, chat, watermarks)
+                    }
+                    for msg, user in messages
+                ]
             
-            for msg, user in messages:
-                history_data = json.dumps({
-                    "id": msg.id,
-                    "username": user.username,
-                    "user_avatar": user.avatar_url,
-                    "text": msg.text,
-                    "image": msg.image_url,
-                    "time": msg.created_at.strftime("%H:%M"),
+            if conn.deflate:
+                # Клиенту со сжатием отдаём историю одним кадром — так она жмётся гораздо лучше
+                await manager.send(conn, json.dumps({
+                    "type": "history",
                     "chat_id": chat_id,
-                    "sender_id": msg.sender_id,
-                    "is_read": msg.is_read
-                })
-                await websocket.send_text(history_data)
+                    "messages": history
+                }))
+            else:
+                for item in history:
+                    await websocket.send_text(json.dumps(item))
         
         
         while True:
             data = await websocket.receive_text()
-            message_data = json.loads(data)
+            try:
+                with track_queries("WS /ws/dm/{chat_id} message"):
+                    message_data = json.loads(data)
             
-            msg_type = message_data.get("type", "message")
+                    msg_type = message_data.get("type", "message")
             
-            if msg_type == "read":
-                async with async_session_factory() as session:
-                    await session.execute(
-                        Message.__table__.update()
-                        .where(
-                            and_(
-                                Message.chat_id == chat_id,
-                                Message.sender_id != user_id,
-                                Message.is_read == False
-                            )
-                        )
-                        .values(is_read=True)
-                    )
-                    await session.commit()
-                
-                read_notification = json.dumps({
-                    "type": "messages_read",
-                    "chat_id": chat_id,
-                    "reader_id": user_id
-                })
-                await manager.broadcast(read_notification, room_id)
-                continue
+                    if msg_type == "subscribe_presence":
+                        # Дальше статусы собеседников приходят сами — опрашивать /users/{id}/status не нужно
+                        if PRESENCE_ENABLED:
+                            retry_after = await rate_limiter.check("ws_presence_user", user_id)
+                            if retry_after:
+                                await websocket.send_text(json.dumps(slow_down_frame(retry_after)))
+                                continue
+                            snapshot = await presence.subscribe(conn)
+                            if snapshot is not None:
+                                await manager.send(conn, json.dumps(snapshot))
+                        continue
             
-            text = message_data.get("text", "").strip()
-            image_url = message_data.get("image")
+                    if msg_type == "read":
+                        read_up_to = message_data.get("message_id")
+                        # bool — тоже int, а строка дошла бы до SQL: "abc" на SQLite читает весь чат
+                        if read_up_to is not None and (not isinstance(read_up_to, int) or isinstance(read_up_to, bool)):
+                            await websocket.send_text(json.dumps({
+                                "type": "error",
+                                "code": "bad_request",
+                                "detail": "message_id должен быть целым числом"
+                            }))
+                            continue
+
+                        retry_after = await rate_limiter.check("ws_read_user", user_id)
+                        if retry_after:
+                            await websocket.send_text(json.dumps(slow_down_frame(retry_after)))
+                            continue
+                
+                        async with admission.admit("write"), async_session_factory() as session:
+                            last_read_id = await mark_read(session, chat_id, user_id, read_up_to)
+                            await session.commit()
+                        mark_written(user_id)
+                        hot_tails.mark_read(chat_id, user_id, last_read_id)
+                
+                        if last_read_id is not None:
+                            read_notification = json.dumps({
+                                "type": "messages_read",
+                                "chat_id": chat_id,
+                                "reader_id": user_id,
+                                "last_read_message_id": last_read_id
+                            })
+                            await manager.broadcast(read_notification, chat_id)
+                        continue
             
-            if not text and not image_url:
-                continue
+                    text = message_data.get("text", "").strip()
+                    image_url = message_data.get("image")
             
-            async with async_session_factory() as session:
-                user_query = select(User).where(User.id == user_id)
-                user_result = await session.execute(user_query)
-                sender = user_result.scalar_one()
+                    if not text and not image_url:
+                        continue
                 
-                new_msg = Message(
-                    chat_id=chat_id,
-                    sender_id=user_id,
-                    text=text if text else None,
-                    image_url=image_url,
-                    is_read=False
-                )
-                session.add(new_msg)
-                await session.commit()
-                await session.refresh(new_msg)
+                    # Повтор отправки: подтверждаем исходное сообщение, ничего не пишем
+                    client_msg_id = parse_client_msg_id(message_data.get("client_msg_id"))
+                    if client_msg_id:
+                        sent = recent_sends.get(user_id, client_msg_id)
+                        if sent:
+                            await manager.send(conn, json.dumps(ack_frame(client_msg_id, *sent)))
+                            continue
+            
+                    retry_after = await rate_limiter.check_all(
+                        ("ws_message_user", user_id), ("ws_message_chat", chat_id)
+                    )
+                    if retry_after:
+                        await websocket.send_text(json.dumps(slow_down_frame(retry_after)))
+                        continue
+            
+                    reply = None  # Ответ только отправителю: подтверждение повтора или ошибка
+                    async with admission.admit("write"), async_session_factory() as session:
+                        user_query = select(User).where(User.id == user_id)
+                        user_result = await session.execute(user_query)
+                        sender = user_result.scalar_one()
                 
-                response_data = json.dumps({
-                    "id": new_msg.id,
-                    "username": sender.username,
-                    "user_avatar": sender.avatar_url,
-                    "text": text,
-                    "image": image_url,
-                    "time": datetime.utcnow().strftime("%H:%M"),
-                    "chat_id": chat_id,
-                    "sender_id": user_id,
-                    "is_read": False
-                })
-                await manager.broadcast(response_data, room_id)
+                        new_msg = Message(
+                            chat_id=chat_id,
+                            sender_id=user_id,
+                            seq=await next_seq(session, chat_id),
+                            text=text if text else None,
+                            image_url=image_url,
+                            is_read=False,
+                            client_msg_id=client_msg_id
+                        )
+                        session.add(new_msg)
+                    
+                        # Собеседника нет в чате — кладём уведомление в outbox той же транзакцией.
+                        # Без воркеров outbox строки никто бы не разбирал
+                        notify_offline = OUTBOX_ENABLED and not manager.is_user_in_room(friend_id, chat_id)
+                        try:
+                            if notify_offline:
+                                await session.flush()
+                                session.add(outbox_entry(
+                                    friend_id, chat_id, new_msg.id, user_id, sender.username, new_msg.text, image_url
+                                ))
+                            await session.commit()
+                        except IntegrityError:
+                            # Повтор, который выпал из окна в памяти: сообщение уже есть в БД
+                            await session.rollback()
+                            original = None
+                            if client_msg_id:
+                                original = (await session.execute(
+                                    select(Message).where(and_(
+                                        Message.sender_id == user_id,
+                                        Message.client_msg_id == client_msg_id
+                                    ))
+                                )).scalar_one_or_none()
+                            if original is None:
+                                # Нарушено другое ограничение — сообщение не сохранено, сокет не закрываем
+                                reply = {
+                                    "type": "error",
+                                    "code": "not_saved",
+                                    "detail": "Сообщение не сохранено, попробуйте ещё раз",
+                                    "client_msg_id": client_msg_id
+                                }
+                            else:
+                                recent_sends.remember(
+                                    user_id, client_msg_id, original.chat_id, original.id, original.seq, original.created_at
+                                )
+                                reply = ack_frame(
+                                    client_msg_id, original.chat_id, original.id, original.seq, original.created_at
+                                )
+                        else:
+                            await session.refresh(new_msg)
+                            if client_msg_id:
+                                recent_sends.remember(
+                                    user_id, client_msg_id, chat_id, new_msg.id, new_msg.seq, new_msg.created_at
+                                )
+
+                    # Слот записи и соединение с БД уже отпущены: медленный получатель их не держит
+                    if reply is not None:
+                        await manager.send(conn, json.dumps(reply))
+                        continue
+
+                    mark_written(user_id)
+                    hot_tails.append(chat_id, new_msg, sender.username, sender.avatar_url)
+                    if notify_offline:
+                        outbox.notify()
+            
+                    response_data = json.dumps({
+                        "id": new_msg.id,
+                        "seq": new_msg.seq,
+                        "username": sender.username,
+                        "user_avatar": sender.avatar_url,
+                        "text": text,
+                        "image": image_url,
+                        "time": datetime.utcnow().strftime("%H:%M"),
+                        "chat_id": chat_id,
+                        "sender_id": user_id,
+                        "is_read": False,
+                        "client_msg_id": client_msg_id
+                    })
+                    await manager.broadcast(response_data, chat_id)
+            except Overloaded as e:
+                await websocket.send_text(json.dumps(overloaded_frame(e.retry_after)))
     
     except WebSocketDisconnect:
-        manager.disconnect(websocket, room_id, user_id)
+        pass
     except Exception as e:
-        print(f"WebSocket error: {e}")
-        manager.disconnect(websocket, room_id, user_id)
+        if not conn.draining:  # При выводе воркера сокет закрыт нами — это не ошибка
+            print(f"WebSocket error: {e}")
+    finally:
+        # И при отмене задачи: соединение, забытое в реестре, держало бы пользователя онлайн
+        manager.disconnect(conn)
 
 
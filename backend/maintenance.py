@@ -0,0 +1,316 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+from typing import AsyncIterator
+
+from sqlalchemy import select, update, delete, and_, or_
+
+from models import (
+    Message, User, GroupChat, GameSession, GamePlayer, UploadSession, MessageArchive, SyncCursor, NotificationOutbox
+)
+from admission import admission, Overloaded
+from archive import read_segment
+from leases import acquire_lease, release_lease
+from metrics import sweep_items, sweep_skipped
+from outbox import OUTBOX_RETENTION_DAYS
+from ratelimit import parse_limit
+from sync import SYNC_CURSOR_TTL_DAYS
+from uploads import UPLOAD_DIR, UPLOAD_TMP_DIR, upload_locks, discard
+
+
+SWEEP_ENABLED = os.getenv("SWEEP_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+SWEEP_INTERVAL_SECONDS = int(os.getenv("SWEEP_INTERVAL_SECONDS", "600"))
+# Аренда очистки: проход выполняет один воркер, остальные его пропускают
+SWEEP_LEASE_SECONDS = int(os.getenv("SWEEP_LEASE_SECONDS", "600"))
+
+# Игра без единого хода дольше TTL считается брошенной
+GAME_WAITING_TTL_SECONDS = int(os.getenv("GAME_WAITING_TTL_SECONDS", str(60 * 60)))
+GAME_ACTIVE_TTL_SECONDS = int(os.getenv("GAME_ACTIVE_TTL_SECONDS", str(6 * 60 * 60)))
+# Завершённые игры хранятся столько дней, потом удаляются (итоги уже в GameStats)
+GAME_RETENTION_DAYS = int(os.getenv("GAME_RETENTION_DAYS", "30"))
+# Незавершённая загрузка без новых кусков дольше этого — брошена
+UPLOAD_SESSION_TTL_SECONDS = int(os.getenv("UPLOAD_SESSION_TTL_SECONDS", str(24 * 60 * 60)))
+# Файл в uploads/ моложе этого не трогаем: его могли загрузить, но ещё не отправить
+UPLOAD_ORPHAN_GRACE_SECONDS = int(os.getenv("UPLOAD_ORPHAN_GRACE_SECONDS", str(24 * 60 * 60)))
+
+# Лимиты задач: "строк/секунд" — пачка такого размера, затем пауза.
+# Переопределяются через SWEEP_LIMIT_<ИМЯ>, например SWEEP_LIMIT_UPLOAD_FILES=1000/60
+DEFAULT_SWEEP_LIMITS = {
+    "games_expire": "200/1",
+    "games_purge": "200/1",
+    "upload_sessions": "100/1",
+    "upload_files": "1000/1",
+    "sync_cursors": "1000/1",
+    "outbox": "1000/1",
+}
+
+SWEEP_LIMITS = {
+    name: parse_limit(os.getenv(f"SWEEP_LIMIT_{name.upper()}", default))
+    for name, default in DEFAULT_SWEEP_LIMITS.items()
+}
+
+
+# ============ ИГРЫ ============
+
+def _idle_before(cutoff: datetime):
+    # updated_at пуст у игр, созданных до миграции v0008
+    return or_(
+        GameSession.updated_at < cutoff,
+        and_(GameSession.updated_at.is_(None), GameSession.created_at < cutoff)
+    )
+
+
+async def expire_games(session_factory, batch: int) -> AsyncIterator[int]:
+    """Брошенные игры (waiting/active без ходов дольше TTL) -> expired"""
+    while True:
+        now = datetime.utcnow()
+        async with admission.admit("maintenance"), session_factory() as session:
+            query = select(GameSession.id).where(or_(
+                and_(GameSession.status == "waiting",
+                     _idle_before(now - timedelta(seconds=GAME_WAITING_TTL_SECONDS))),
+                and_(GameSession.status == "active",
+                     _idle_before(now - timedelta(seconds=GAME_ACTIVE_TTL_SECONDS))),
+            )).limit(batch)
+            ids = (await session.execute(query)).scalars().all()
+            if ids:
+                await session.execute(
+                    update(GameSession)
+                    .where(and_(GameSession.id.in_(ids), GameSession.status.in_(("waiting", "active"))))
+                    .values(status="expired", finished_at=now)
+                )
+                await session.commit()
+        yield len(ids)
+        if len(ids) < batch:
+            return
+
+
+async def purge_games(session_factory, batch: int) -> AsyncIterator[int]:
+    """Удалить завершённые и просроченные игры старше GAME_RETENTION_DAYS вместе с игроками"""
+    while True:
+        cutoff = datetime.utcnow() - timedelta(days=GAME_RETENTION_DAYS)
+        async with admission.admit("maintenance"), session_factory() as session:
+            query = select(GameSession.id).where(and_(
+                GameSession.status.in_(("finished", "expired")),
+                GameSession.finished_at < cutoff
+            )).limit(batch)
+            ids = (await session.execute(query)).scalars().all()
+            if ids:
+                await session.execute(delete(GamePlayer).where(GamePlayer.session_id.in_(ids)))
+                await session.execute(delete(GameSession).where(GameSession.id.in_(ids)))
+                await session.commit()
+        yield len(ids)
+        if len(ids) < batch:
+            return
+
+
+# ============ ЗАГРУЗКИ ============
+
+def _old_files(directory: str, cutoff: float) -> dict[str, float]:
+    """Файлы каталога, не менявшиеся с cutoff (time.time()): имя -> mtime"""
+    files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file():
+                mtime = entry.stat().st_mtime
+                if mtime < cutoff:
+                    files[entry.name] = mtime
+    return files
+
+
+def _remove_files(directory: str, names: list[str]):
+    for name in names:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+
+
+async def expire_upload_sessions(session_factory, batch: int) -> AsyncIterator[int]:
+    """Брошенные докачиваемые загрузки: строки upload_sessions и их временные файлы"""
+    while True:
+        cutoff = datetime.utcnow() - timedelta(seconds=UPLOAD_SESSION_TTL_SECONDS)
+        async with admission.admit("maintenance"), session_factory() as session:
+            query = select(UploadSession.id).where(UploadSession.updated_at < cutoff).limit(batch)
+            # Кусок, который пишется прямо сейчас, не трогаем
+            ids = [i for i in (await session.execute(query)).scalars().all()
+                   if not (i in upload_locks and upload_locks[i].locked())]
+            if ids:
+                await session.execute(delete(UploadSession).where(UploadSession.id.in_(ids)))
+                await session.commit()
+        for upload_id in ids:
+            discard(upload_id)
+        yield len(ids)
+        if len(ids) < batch:
+            break
+
+    # Временные файлы без строки в upload_sessions (например, после сбоя)
+    names = list(await asyncio.to_thread(_old_files, UPLOAD_TMP_DIR, time.time() - UPLOAD_SESSION_TTL_SECONDS))
+    for start in range(0, len(names), batch):
+        chunk = {name.removesuffix(".part"): name for name in names[start:start + batch]}
+        async with admission.admit("maintenance"), session_factory() as session:
+            query = select(UploadSession.id).where(UploadSession.id.in_(list(chunk)))
+            alive = set((await session.execute(query)).scalars().all())
+        stray = [name for upload_id, name in chunk.items() if upload_id not in alive]
+        await asyncio.to_thread(_remove_files, UPLOAD_TMP_DIR, stray)
+        yield len(stray)
+
+
+def _file_name(url: str) -> str:
+    # Клиент сохраняет полный адрес (http://host/uploads/<имя>), сервер отдаёт /uploads/<имя>
+    return url.rsplit("/", 1)[-1]
+
+
+async def collect_orphan_uploads(session_factory, batch: int) -> AsyncIterator[int]:
+    """Удалить файлы uploads/, на которые не ссылается ни сообщение, ни аватар.
+
+    Ссылки собираются пачками по batch строк (сообщения — по id, без OFFSET);
+    в архив заглядываем только за месяцы не раньше самого старого кандидата —
+    более ранние сообщения не могут ссылаться на файл, загруженный позже.
+    """
+    files = await asyncio.to_thread(_old_files, UPLOAD_DIR, time.time() - UPLOAD_ORPHAN_GRACE_SECONDS)
+    if not files:
+        return
+    orphans = set(files)
+    oldest = min(files.values())
+
+    for model, column in ((User, User.avatar_url), (GroupChat, GroupChat.avatar_url), (Message, Message.image_url)):
+        last_id = 0
+        while orphans:
+            async with admission.admit("maintenance"), session_factory() as session:
+                query = (
+                    select(model.id, column)
+                    .where(and_(model.id > last_id, column.isnot(None)))
+                    .order_by(model.id)
+                    .limit(batch)
+                )
+                rows = (await session.execute(query)).all()
+            for row in rows:
+                orphans.discard(_file_name(row[1]))
+            yield 0
+            if len(rows) < batch:
+                break
+            last_id = rows[-1][0]
+
+    if orphans:
+        period = datetime.utcfromtimestamp(oldest).strftime("%Y-%m")
+        async with admission.admit("maintenance"), session_factory() as session:
+            query = select(MessageArchive.path).where(MessageArchive.period >= period)
+            segment_paths = (await session.execute(query)).scalars().all()
+        for path in segment_paths:
+            if not orphans:
+                break
+            rows = await asyncio.to_thread(read_segment, path)
+            orphans.difference_update(_file_name(row["image_url"]) for row in rows if row["image_url"])
+            yield 0
+
+    orphans = sorted(orphans)
+    for start in range(0, len(orphans), batch):
+        chunk = orphans[start:start + batch]
+        await asyncio.to_thread(_remove_files, UPLOAD_DIR, chunk)
+        yield len(chunk)
+
+
+# ============ КУРСОРЫ /sync ============
+
+async def purge_sync_cursors(session_factory, batch: int) -> AsyncIterator[int]:
+    """Удалить курсоры /sync старше SYNC_CURSOR_TTL_DAYS"""
+    while True:
+        cutoff = datetime.utcnow() - timedelta(days=SYNC_CURSOR_TTL_DAYS)
+        async with admission.admit("maintenance"), session_factory() as session:
+            query = select(SyncCursor.id).where(SyncCursor.created_at < cutoff).limit(batch)
+            ids = (await session.execute(query)).scalars().all()
+            if ids:
+                await session.execute(delete(SyncCursor).where(SyncCursor.id.in_(ids)))
+                await session.commit()
+        yield len(ids)
+        if len(ids) < batch:
+            return
+
+
+# ============ OUTBOX ============
+
+async def purge_outbox(session_factory, batch: int) -> AsyncIterator[int]:
+    """Удалить уведомления со статусом failed и зависшие в pending дольше OUTBOX_RETENTION_DAYS"""
+    while True:
+        cutoff = datetime.utcnow() - timedelta(days=OUTBOX_RETENTION_DAYS)
+        async with admission.admit("maintenance"), session_factory() as session:
+            query = (
+                select(NotificationOutbox.id)
+                .where(or_(NotificationOutbox.status == "failed", NotificationOutbox.created_at < cutoff))
+                .limit(batch)
+            )
+            ids = (await session.execute(query)).scalars().all()
+            if ids:
+                await session.execute(delete(NotificationOutbox).where(NotificationOutbox.id.in_(ids)))
+                await session.commit()
+        yield len(ids)
+        if len(ids) < batch:
+            return
+
+
+# ============ ЗАПУСК ============
+
+SWEEP_JOBS = {
+    "games_expire": expire_games,
+    "games_purge": purge_games,
+    "upload_sessions": expire_upload_sessions,
+    "upload_files": collect_orphan_uploads,
+    "sync_cursors": purge_sync_cursors,
+    "outbox": purge_outbox,
+}
+
+
+async def run_job(name: str, session_factory) -> int:
+    """Прогнать одну задачу до конца с паузами между пачками. Возвращает число обработанного"""
+    batch, pause = SWEEP_LIMITS[name]
+    total = 0
+    steps = SWEEP_JOBS[name](session_factory, batch)
+    try:
+        async for done in steps:
+            total += done
+            sweep_items.inc(name, amount=done)
+            # Пауза после каждой пачки: не больше batch строк (или запросов) за pause секунд
+            await asyncio.sleep(pause)
+    except Overloaded:
+        # БД занята чатом — доделаем в следующий проход
+        sweep_skipped.inc(name)
+    except Exception as e:
+        # Ошибка одной задачи не отменяет остальные
+        print(f"Sweep job {name} error: {e}")
+    finally:
+        await steps.aclose()
+    return total
+
+
+async def run_sweep(session_factory) -> dict[str, int]:
+    """Все задачи по очереди — одна за раз, чтобы очистка держала не больше одного соединения.
+
+    Перед каждой задачей аренда продлевается; истекла и досталась другому — проход прерывается.
+    """
+    done = {}
+    for name in SWEEP_JOBS:
+        if not await acquire_lease(session_factory, "sweep", SWEEP_LEASE_SECONDS):
+            break
+        done[name] = await run_job(name, session_factory)
+    return done
+
+
+async def sweep_loop(session_factory):
+    """Фоновая задача: периодическая очистка.
+
+    Запускается в каждом воркере, но чистит только тот, кто взял аренду:
+    иначе каждый воркер гонял бы те же удаления и нагрузка на БД множилась.
+    """
+    while True:
+        try:
+            if await acquire_lease(session_factory, "sweep", SWEEP_LEASE_SECONDS):
+                try:
+                    await run_sweep(session_factory)
+                finally:
+                    await release_lease(session_factory, "sweep")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Sweep error: {e}")
+        await asyncio.sleep(SWEEP_INTERVAL_SECONDS)
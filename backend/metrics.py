@@ -0,0 +1,254 @@
+import os
+import time
+from bisect import bisect_left
+from typing import Callable, Optional
+
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+
+# Больше стольких наборов меток на одну метрику не заводим — остальное идёт в "other"
+MAX_LABEL_SETS = 500
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = labels
+        self.series: dict[tuple, object] = {}
+
+    def _key(self, labels: tuple) -> tuple:
+        if labels in self.series or len(self.series) < MAX_LABEL_SETS:
+            return labels
+        return ("other",) * len(self.label_names)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        key = self._key(labels)
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for labels, value in self.series.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Значение считается функцией в момент сбора: callback() -> {labels: value}"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), callback: Optional[Callable] = None):
+        super().__init__(name, help_text, labels)
+        self.callback = callback
+
+    def set(self, value: float, *labels):
+        self.series[self._key(labels)] = value
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        series = self.callback() if self.callback else self.series
+        for labels, value in series.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        key = self._key(labels)
+        state = self.series.get(key)
+        if state is None:
+            # [счётчики по корзинам..., +Inf], сумма
+            state = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = _format_labels(self.label_names, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            cumulative += counts[-1]
+            le = _format_labels(self.label_names, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[_Metric] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# ============ HTTP ============
+
+http_requests = registry.register(Counter(
+    "omega_http_requests_total", "HTTP-запросы", ("method", "route", "status")
+))
+http_duration = registry.register(Histogram(
+    "omega_http_request_duration_seconds", "Длительность HTTP-запроса", ("method", "route")
+))
+
+# ============ WEBSOCKET ============
+
+ws_connects = registry.register(Counter("omega_ws_connects_total", "Подключения WebSocket"))
+ws_disconnects = registry.register(Counter("omega_ws_disconnects_total", "Отключения WebSocket"))
+ws_dead_connections = registry.register(Counter(
+    "omega_ws_dead_connections_total", "Соединения, отвалившиеся при рассылке"
+))
+ws_broadcast_duration = registry.register(Histogram(
+    "omega_ws_broadcast_duration_seconds", "Длительность рассылки в комнату"
+))
+ws_drained = registry.register(Counter(
+    "omega_ws_drained_total", "Соединения, закрытые при выводе воркера"
+))
+presence_events = registry.register(Counter(
+    "omega_presence_events_total", "События присутствия, отправленные подписанным сокетам"
+))
+hot_tail_lookups = registry.register(Counter(
+    "omega_hot_tail_lookups_total", "Чтения истории из хвоста чата в памяти", ("result",)
+))
+
+# ============ EVENT LOOP ============
+
+loop_lag = registry.register(Histogram(
+    "omega_event_loop_lag_seconds", "Насколько позже назначенного просыпается event loop"
+))
+loop_blocks = registry.register(Counter(
+    "omega_event_loop_blocks_total", "Колбэки, занявшие event loop дольше LOOP_BLOCK_MS"
+))
+
+# ============ БД ============
+
+db_query_duration = registry.register(Histogram(
+    "omega_db_query_duration_seconds", "Длительность SQL-запроса", ("operation",)
+))
+db_pool_wait = registry.register(Histogram(
+    "omega_db_pool_checkout_wait_seconds", "Ожидание соединения из пула"
+))
+admission_wait = registry.register(Histogram(
+    "omega_db_admission_wait_seconds", "Ожидание допуска к БД", ("priority",)
+))
+admission_rejected = registry.register(Counter(
+    "omega_db_admission_rejected_total", "Отказы в допуске к БД", ("priority", "reason")
+))
+
+# ============ УВЕДОМЛЕНИЯ ============
+
+outbox_notifications = registry.register(Counter(
+    "omega_outbox_notifications_total", "Уведомления из outbox", ("result",)
+))
+outbox_send_duration = registry.register(Histogram(
+    "omega_outbox_send_duration_seconds", "Отправка одного уведомления"
+))
+
+# ============ ОБСЛУЖИВАНИЕ ============
+
+sweep_items = registry.register(Counter(
+    "omega_sweep_items_total", "Строки и файлы, обработанные фоновой очисткой", ("job",)
+))
+sweep_skipped = registry.register(Counter(
+    "omega_sweep_skipped_total", "Проходы очистки, отложенные из-за нагрузки на БД", ("job",)
+))
+
+_SQL_OPERATIONS = ("SELECT", "INSERT", "UPDATE", "DELETE")
+
+
+def _operation(statement: str) -> str:
+    head = statement.lstrip()[:6].upper()
+    return head if head in _SQL_OPERATIONS else "OTHER"
+
+
+def observe_query(statement: str, duration: float):
+    """Учесть запрос в гистограмме (вызывается из хуков querylog — замер общий)"""
+    db_query_duration.observe(duration, _operation(statement))
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Пул, который замеряет ожидание свободного соединения"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool_wait.observe(time.perf_counter() - started)
+
+
+def route_label(scope: dict) -> str:
+    """Шаблон пути вместо реального URL — чтобы число меток было ограничено"""
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    if scope.get("path", "").startswith("/uploads/"):
+        return "/uploads"
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """ASGI-мидлварь: время и статусы HTTP-запросов"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_holder = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status_holder[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = route_label(scope)
+            method = scope["method"]
+            http_duration.observe(time.perf_counter() - started, method, route)
+            http_requests.inc(method, route, status_holder[0])
@@ -0,0 +1,33 @@
+"""Применить миграции схемы БД.
+
+    python migrate.py           # довести схему до последней версии
+    python migrate.py --check   # только показать версию (код 1, если отстаёт)
+"""
+import argparse
+import asyncio
+import sys
+
+from database import engine
+from migrations import LATEST_VERSION, apply_migrations, current_version
+
+
+async def main(check_only: bool) -> int:
+    try:
+        if check_only:
+            async with engine.connect() as conn:
+                version = await current_version(conn)
+            print(f"Версия схемы: {version}, последняя: {LATEST_VERSION}")
+            return 0 if version >= LATEST_VERSION else 1
+
+        version = await apply_migrations(engine)
+        print(f"Схема БД актуальна (версия {version})")
+        return 0
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Миграции схемы Omega Chat")
+    parser.add_argument("--check", action="store_true", help="только проверить версию")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.check)))
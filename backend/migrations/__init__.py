@@ -0,0 +1,105 @@
+"""Версионные миграции схемы БД.
+
+Применяются отдельной командой `python migrate.py`, приложение при старте
+только сверяет версию. Новая миграция — модуль vNNNN_*.py с функцией
+`async def upgrade(conn)` и строка в MIGRATIONS. Миграции пишутся
+идемпотентно (через хелперы ниже), чтобы одинаково проходить и на пустой
+БД, и на БД, созданной раньше через create_all. Таблицы и индексы
+миграция описывает сама, а не берёт из models: модели потом меняются,
+а повтор старой миграции на пустой БД должен дать ту же схему.
+"""
+from datetime import datetime
+from importlib import import_module
+
+from sqlalchemy import Table, Column, Integer, String, DateTime, MetaData, select, func, inspect
+from sqlalchemy.schema import CreateColumn
+
+
+MIGRATIONS = [
+    "v0001_baseline",
+    "v0002_message_archive",
+    "v0003_read_watermarks",
+    "v0004_message_seq",
+    "v0005_notification_outbox",
+    "v0006_client_msg_id",
+    "v0007_upload_sessions",
+    "v0008_game_activity",
+    "v0009_job_leases",
+    "v0010_sync_cursors",
+]
+
+LATEST_VERSION = len(MIGRATIONS)
+
+_meta = MetaData()
+
+schema_version = Table(
+    "schema_version", _meta,
+    Column("version", Integer, primary_key=True),
+    Column("name", String(100), nullable=False),
+    Column("applied_at", DateTime, default=datetime.utcnow),
+)
+
+
+class SchemaOutdated(RuntimeError):
+    pass
+
+
+# ============ ХЕЛПЕРЫ ДЛЯ МИГРАЦИЙ ============
+
+async def create_table(conn, table: Table):
+    await conn.run_sync(lambda sync_conn: table.create(sync_conn, checkfirst=True))
+
+
+async def create_index(conn, index):
+    await conn.run_sync(lambda sync_conn: index.create(sync_conn, checkfirst=True))
+
+
+async def add_column(conn, table_name: str, column: Column):
+    """ALTER TABLE ... ADD COLUMN, если колонки ещё нет"""
+    def _add(sync_conn):
+        existing = {c["name"] for c in inspect(sync_conn).get_columns(table_name)}
+        if column.name in existing:
+            return
+        spec = CreateColumn(column).compile(dialect=sync_conn.dialect)
+        sync_conn.exec_driver_sql(f"ALTER TABLE {table_name} ADD COLUMN {spec}")
+    await conn.run_sync(_add)
+
+
+# ============ ЗАПУСК ============
+
+async def current_version(conn) -> int:
+    has_table = await conn.run_sync(lambda sync_conn: inspect(sync_conn).has_table("schema_version"))
+    if not has_table:
+        return 0
+    return (await conn.execute(select(func.max(schema_version.c.version)))).scalar() or 0
+
+
+async def apply_migrations(engine, log=print) -> int:
+    """Применить недостающие миграции. Возвращает итоговую версию"""
+    async with engine.begin() as conn:
+        await create_table(conn, schema_version)
+        version = await current_version(conn)
+
+    for number, name in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        module = import_module(f"migrations.{name}")
+        async with engine.begin() as conn:
+            await module.upgrade(conn)
+            await conn.execute(schema_version.insert().values(version=number, name=name))
+        log(f"Миграция {number:04d} {name} применена")
+        version = number
+
+    return version
+
+
+async def check_schema(engine):
+    """Дешёвая проверка при старте: пара запросов вместо create_all"""
+    # Нет таблицы schema_version — версия 0; ошибки подключения и прав не глотаем
+    async with engine.connect() as conn:
+        version = await current_version(conn)
+
+    if version < LATEST_VERSION:
+        raise SchemaOutdated(
+            f"Схема БД версии {version}, нужна {LATEST_VERSION}. Запустите: python migrate.py"
+        )
@@ -0,0 +1,104 @@
+"""Исходные таблицы (то, что раньше создавал create_all).
+
+Схема заморожена на момент перехода на миграции: таблицы описаны здесь, а
+не берутся из models. Иначе на пустой БД v0001 создавала бы и колонки из
+поздних миграций (messages.seq, client_msg_id, game_sessions.updated_at).
+"""
+from datetime import datetime
+
+from sqlalchemy import Table, Column, Integer, String, DateTime, ForeignKey, Boolean, Text, MetaData
+
+from migrations import create_table
+
+
+_meta = MetaData()
+
+users = Table(
+    "users", _meta,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("username", String(50), unique=True, index=True, nullable=False),
+    Column("email", String(255), unique=True, index=True, nullable=False),
+    Column("hashed_password", String(255), nullable=False),
+    Column("avatar_url", String(500), nullable=True),
+    Column("status", String(100), nullable=True),
+    Column("is_online", Boolean, default=False),
+    Column("last_seen", DateTime, nullable=True),
+    Column("created_at", DateTime, default=datetime.utcnow),
+)
+
+direct_chats = Table(
+    "direct_chats", _meta,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("user1_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("user2_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("created_at", DateTime, default=datetime.utcnow),
+)
+
+messages = Table(
+    "messages", _meta,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("chat_id", Integer, ForeignKey("direct_chats.id"), nullable=False),
+    Column("sender_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("text", Text, nullable=True),
+    Column("image_url", String(500), nullable=True),
+    Column("created_at", DateTime, default=datetime.utcnow),
+    Column("is_read", Boolean, default=False),
+)
+
+group_chats = Table(
+    "group_chats", _meta,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("name", String(100), nullable=False),
+    Column("avatar_url", String(500), nullable=True),
+    Column("owner_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("created_at", DateTime, default=datetime.utcnow),
+)
+
+group_members = Table(
+    "group_members", _meta,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("group_id", Integer, ForeignKey("group_chats.id"), nullable=False),
+    Column("user_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("joined_at", DateTime, default=datetime.utcnow),
+    Column("is_admin", Boolean, default=False),
+)
+
+game_sessions = Table(
+    "game_sessions", _meta,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("game_type", String(50), nullable=False),
+    Column("chat_id", Integer, ForeignKey("direct_chats.id"), nullable=True),
+    Column("group_id", Integer, ForeignKey("group_chats.id"), nullable=True),
+    Column("creator_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("status", String(20), default="waiting"),
+    Column("data", Text, nullable=True),
+    Column("created_at", DateTime, default=datetime.utcnow),
+    Column("finished_at", DateTime, nullable=True),
+)
+
+game_players = Table(
+    "game_players", _meta,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("session_id", Integer, ForeignKey("game_sessions.id"), nullable=False),
+    Column("user_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("score", Integer, default=0),
+    Column("is_winner", Boolean, default=False),
+)
+
+game_stats = Table(
+    "game_stats", _meta,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("user_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("game_type", String(50), nullable=False),
+    Column("games_played", Integer, default=0),
+    Column("games_won", Integer, default=0),
+    Column("total_score", Integer, default=0),
+    Column("best_score", Integer, default=0),
+)
+
+TABLES = [users, direct_chats, messages, group_chats, group_members, game_sessions, game_players, game_stats]
+
+
+async def upgrade(conn):
+    for table in TABLES:
+        await create_table(conn, table)
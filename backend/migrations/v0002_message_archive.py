@@ -0,0 +1,30 @@
+"""Архив сообщений и индекс (chat_id, created_at) для истории"""
+from datetime import datetime
+
+from sqlalchemy import Table, Column, Integer, String, DateTime, ForeignKey, Index, MetaData
+
+from migrations import create_table, create_index
+from migrations.v0001_baseline import direct_chats, messages
+
+
+_meta = MetaData()
+
+message_archives = Table(
+    "message_archives", _meta,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("chat_id", Integer, ForeignKey(direct_chats.c.id), nullable=False),
+    Column("period", String(7), nullable=False),
+    Column("path", String(500), nullable=False),
+    Column("messages_count", Integer, default=0),
+    Column("first_message_at", DateTime, nullable=True),
+    Column("last_message_at", DateTime, nullable=True),
+    Column("created_at", DateTime, default=datetime.utcnow),
+    Index("ix_message_archives_chat_period", "chat_id", "period", unique=True),
+)
+
+ix_messages_chat_created = Index("ix_messages_chat_created", messages.c.chat_id, messages.c.created_at)
+
+
+async def upgrade(conn):
+    await create_table(conn, message_archives)
+    await create_index(conn, ix_messages_chat_created)
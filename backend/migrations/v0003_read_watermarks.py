@@ -0,0 +1,46 @@
+"""Отметки прочтения вместо флагов is_read"""
+from datetime import datetime
+
+from sqlalchemy import Table, Column, Integer, DateTime, ForeignKey, Index, MetaData, select, insert, func, and_
+
+from migrations import create_table
+from migrations.v0001_baseline import users, direct_chats, messages
+
+
+_meta = MetaData()
+
+chat_read_states = Table(
+    "chat_read_states", _meta,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("chat_id", Integer, ForeignKey(direct_chats.c.id), nullable=False),
+    Column("user_id", Integer, ForeignKey(users.c.id), nullable=False),
+    Column("last_read_message_id", Integer, nullable=False, default=0),
+    Column("updated_at", DateTime, default=datetime.utcnow),
+    Index("ix_chat_read_states_chat_user", "chat_id", "user_id", unique=True),
+)
+
+
+async def upgrade(conn):
+    await create_table(conn, chat_read_states)
+
+    # Перенос старых флагов is_read: отметка — последнее прочитанное чужое сообщение.
+    # Пары, у которых отметка уже есть (повторный запуск), не трогаем
+    existing = set((await conn.execute(select(chat_read_states.c.chat_id, chat_read_states.c.user_id))).all())
+    chats = (await conn.execute(select(direct_chats.c.id, direct_chats.c.user1_id, direct_chats.c.user2_id))).all()
+    now = datetime.utcnow()
+    for chat in chats:
+        for reader_id in (chat.user1_id, chat.user2_id):
+            if (chat.id, reader_id) in existing:
+                continue
+            query = select(func.max(messages.c.id)).where(
+                and_(
+                    messages.c.chat_id == chat.id,
+                    messages.c.sender_id != reader_id,
+                    messages.c.is_read == True
+                )
+            )
+            last_id = (await conn.execute(query)).scalar()
+            if last_id:
+                await conn.execute(insert(chat_read_states).values(
+                    chat_id=chat.id, user_id=reader_id, last_read_message_id=last_id, updated_at=now
+                ))
@@ -0,0 +1,46 @@
+"""Порядковые номера сообщений внутри чата (для /sync)"""
+from sqlalchemy import Table, Column, Integer, Index, MetaData, select, update, func
+
+from migrations import add_column, create_index
+
+
+# Таблицы в том виде, в каком они есть после этой миграции (не модели — те меняются дальше)
+_meta = MetaData()
+
+messages = Table(
+    "messages", _meta,
+    Column("id", Integer, primary_key=True),
+    Column("chat_id", Integer),
+    Column("seq", Integer),
+)
+
+direct_chats = Table(
+    "direct_chats", _meta,
+    Column("id", Integer, primary_key=True),
+    Column("last_seq", Integer),
+)
+
+ix_messages_chat_seq = Index("ix_messages_chat_seq", messages.c.chat_id, messages.c.seq, unique=True)
+
+
+async def upgrade(conn):
+    await add_column(conn, "direct_chats", Column("last_seq", Integer, nullable=False, server_default="0"))
+    await add_column(conn, "messages", Column("seq", Integer, nullable=True))
+
+    # Нумеруем существующие сообщения в порядке id
+    numbered = select(
+        messages.c.id,
+        func.row_number().over(partition_by=messages.c.chat_id, order_by=messages.c.id).label("seq")
+    ).subquery()
+    await conn.execute(
+        update(messages).where(messages.c.id == numbered.c.id).values(seq=numbered.c.seq)
+    )
+    await conn.execute(
+        update(direct_chats).values(
+            last_seq=select(func.coalesce(func.max(messages.c.seq), 0))
+            .where(messages.c.chat_id == direct_chats.c.id)
+            .scalar_subquery()
+        )
+    )
+
+    await create_index(conn, ix_messages_chat_seq)
@@ -0,0 +1,29 @@
+"""Очередь уведомлений для офлайн-получателей"""
+from datetime import datetime
+
+from sqlalchemy import Table, Column, Integer, String, DateTime, Text, ForeignKey, Index, MetaData
+
+from migrations import create_table
+from migrations.v0001_baseline import users, direct_chats
+
+
+_meta = MetaData()
+
+notification_outbox = Table(
+    "notification_outbox", _meta,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("user_id", Integer, ForeignKey(users.c.id), nullable=False),
+    Column("chat_id", Integer, ForeignKey(direct_chats.c.id), nullable=False),
+    Column("message_id", Integer, nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("status", String(20), default="pending"),
+    Column("attempts", Integer, default=0),
+    Column("next_attempt_at", DateTime, default=datetime.utcnow),
+    Column("last_error", String(500), nullable=True),
+    Column("created_at", DateTime, default=datetime.utcnow),
+    Index("ix_notification_outbox_due", "status", "next_attempt_at"),
+)
+
+
+async def upgrade(conn):
+    await create_table(conn, notification_outbox)
@@ -0,0 +1,22 @@
+"""Ключ идемпотентности client_msg_id у сообщений"""
+from sqlalchemy import Table, Column, Integer, String, Index, MetaData
+
+from migrations import add_column, create_index
+
+
+_meta = MetaData()
+
+messages = Table(
+    "messages", _meta,
+    Column("sender_id", Integer),
+    Column("client_msg_id", String(64)),
+)
+
+ix_messages_sender_client_msg = Index(
+    "ix_messages_sender_client_msg", messages.c.sender_id, messages.c.client_msg_id, unique=True
+)
+
+
+async def upgrade(conn):
+    await add_column(conn, "messages", Column("client_msg_id", String(64), nullable=True))
+    await create_index(conn, ix_messages_sender_client_msg)
@@ -0,0 +1,27 @@
+"""Докачиваемые загрузки"""
+from datetime import datetime
+
+from sqlalchemy import Table, Column, Integer, String, DateTime, ForeignKey, MetaData
+
+from migrations import create_table
+from migrations.v0001_baseline import users
+
+
+_meta = MetaData()
+
+upload_sessions = Table(
+    "upload_sessions", _meta,
+    Column("id", String(36), primary_key=True),
+    Column("user_id", Integer, ForeignKey(users.c.id), nullable=False),
+    Column("filename", String(255), nullable=False),
+    Column("content_type", String(100), nullable=False),
+    Column("size", Integer, nullable=False),
+    Column("received", Integer, nullable=False, default=0),
+    Column("status", String(20), default="active"),
+    Column("created_at", DateTime, default=datetime.utcnow),
+    Column("updated_at", DateTime, default=datetime.utcnow),
+)
+
+
+async def upgrade(conn):
+    await create_table(conn, upload_sessions)
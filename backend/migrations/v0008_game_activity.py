@@ -0,0 +1,27 @@
+"""Время последнего хода у игр и индексы для фоновой очистки"""
+from sqlalchemy import Table, Column, Integer, String, DateTime, Index, MetaData
+
+from migrations import add_column, create_index
+from migrations.v0001_baseline import game_sessions, game_players
+
+
+_meta = MetaData()
+
+# game_sessions с колонкой updated_at — только для индекса
+game_sessions_activity = Table(
+    "game_sessions", _meta,
+    Column("status", String(20)),
+    Column("updated_at", DateTime),
+)
+
+INDEXES = [
+    Index("ix_game_sessions_status_updated", game_sessions_activity.c.status, game_sessions_activity.c.updated_at),
+    Index("ix_game_sessions_status_finished", game_sessions.c.status, game_sessions.c.finished_at),
+    Index("ix_game_players_session", game_players.c.session_id),
+]
+
+
+async def upgrade(conn):
+    await add_column(conn, "game_sessions", Column("updated_at", DateTime, nullable=True))
+    for index in INDEXES:
+        await create_index(conn, index)
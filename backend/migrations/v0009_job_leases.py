@@ -0,0 +1,18 @@
+"""Аренды фоновых задач (архивация — одним воркером)"""
+from sqlalchemy import Table, Column, String, DateTime, MetaData
+
+from migrations import create_table
+
+
+_meta = MetaData()
+
+job_leases = Table(
+    "job_leases", _meta,
+    Column("name", String(50), primary_key=True),
+    Column("holder", String(100), nullable=False),
+    Column("expires_at", DateTime, nullable=False),
+)
+
+
+async def upgrade(conn):
+    await create_table(conn, job_leases)
@@ -0,0 +1,23 @@
+"""Курсоры /sync на сервере вместо состояния всех чатов в строке запроса"""
+from datetime import datetime
+
+from sqlalchemy import Table, Column, Integer, String, DateTime, Text, ForeignKey, Index, MetaData
+
+from migrations import create_table
+from migrations.v0001_baseline import users
+
+
+_meta = MetaData()
+
+sync_cursors = Table(
+    "sync_cursors", _meta,
+    Column("id", String(32), primary_key=True),
+    Column("user_id", Integer, ForeignKey(users.c.id), nullable=False),
+    Column("state", Text, nullable=False),
+    Column("created_at", DateTime, default=datetime.utcnow),
+    Index("ix_sync_cursors_created", "created_at"),
+)
+
+
+async def upgrade(conn):
+    await create_table(conn, sync_cursors)
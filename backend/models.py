@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean, Text
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean, Text, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from database import Base
@@ -31,6 +31,7 @@ class DirectChat(Base):
     user1_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     user2_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    last_seq = Column(Integer, nullable=False, default=0, server_default="0")  # номер последнего сообщения
     
     # Связи
     user1 = relationship("User", foreign_keys=[user1_id])
@@ -45,15 +46,114 @@ class Message(Base):
     id = Column(Integer, primary_key=True, index=True)
     chat_id = Column(Integer, ForeignKey("direct_chats.id"), nullable=False)
     sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    seq = Column(Integer, nullable=True)  # порядковый номер в чате: 1, 2, 3...
     text = Column(Text, nullable=True)
     image_url = Column(String(500), nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     is_read = Column(Boolean, default=False)
+    client_msg_id = Column(String(64), nullable=True)  # ключ идемпотентности от клиента
     
     # Связи
     chat = relationship("DirectChat", back_populates="messages")
     sender = relationship("User", back_populates="sent_messages", foreign_keys=[sender_id])
 
+    __table_args__ = (
+        Index("ix_messages_chat_created", "chat_id", "created_at"),
+        Index("ix_messages_chat_seq", "chat_id", "seq", unique=True),
+        Index("ix_messages_sender_client_msg", "sender_id", "client_msg_id", unique=True),
+    )
+
+
+class ChatReadState(Base):
+    """Докуда пользователь прочитал чат (вместо флага is_read у каждого сообщения)"""
+    __tablename__ = 'chat_read_states'
+
+    id = Column(Integer, primary_key=True, index=True)
+    chat_id = Column(Integer, ForeignKey("direct_chats.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    last_read_message_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_chat_read_states_chat_user", "chat_id", "user_id", unique=True),
+    )
+
+
+class MessageArchive(Base):
+    """Архивный сегмент: сообщения одного чата за месяц в сжатом файле"""
+    __tablename__ = 'message_archives'
+
+    id = Column(Integer, primary_key=True, index=True)
+    chat_id = Column(Integer, ForeignKey("direct_chats.id"), nullable=False)
+    period = Column(String(7), nullable=False)  # "2025-01"
+    path = Column(String(500), nullable=False)
+    messages_count = Column(Integer, default=0)
+    first_message_at = Column(DateTime, nullable=True)
+    last_message_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_message_archives_chat_period", "chat_id", "period", unique=True),
+    )
+
+
+class NotificationOutbox(Base):
+    """Уведомление для офлайн-получателя; пишется в одной транзакции с сообщением"""
+    __tablename__ = 'notification_outbox'
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)  # получатель
+    chat_id = Column(Integer, ForeignKey("direct_chats.id"), nullable=False)
+    message_id = Column(Integer, nullable=False)
+    payload = Column(Text, nullable=False)  # JSON: отправитель, превью текста
+    status = Column(String(20), default="pending")  # pending / failed
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    last_error = Column(String(500), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_notification_outbox_due", "status", "next_attempt_at"),
+    )
+
+
+class UploadSession(Base):
+    """Докачиваемая загрузка файла: куски пишутся во временный файл по смещению"""
+    __tablename__ = 'upload_sessions'
+
+    id = Column(String(36), primary_key=True)  # uuid — его знает только владелец
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    filename = Column(String(255), nullable=False)
+    content_type = Column(String(100), nullable=False)
+    size = Column(Integer, nullable=False)  # заявленный размер
+    received = Column(Integer, nullable=False, default=0)  # сколько байт уже записано
+    status = Column(String(20), default="active")  # active / complete
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class SyncCursor(Base):
+    """Курсор /sync: что клиент уже видел в каждом чате. Клиенту отдаётся только id"""
+    __tablename__ = 'sync_cursors'
+
+    id = Column(String(32), primary_key=True)  # uuid4().hex
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    state = Column(Text, nullable=False)  # JSON: {chat_id: [seq, моя отметка, отметка собеседника]}
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_sync_cursors_created", "created_at"),
+    )
+
+
+class JobLease(Base):
+    """Аренда фоновой задачи: её выполняет только один воркер, пока аренда не истекла"""
+    __tablename__ = 'job_leases'
+
+    name = Column(String(50), primary_key=True)
+    holder = Column(String(100), nullable=False)  # "хост:pid" воркера
+    expires_at = Column(DateTime, nullable=False)
+
 
 class GroupChat(Base):
     """Групповой чат"""
@@ -96,14 +196,20 @@ class GameSession(Base):
     chat_id = Column(Integer, ForeignKey("direct_chats.id"), nullable=True)
     group_id = Column(Integer, ForeignKey("group_chats.id"), nullable=True)
     creator_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    status = Column(String(20), default="waiting")
+    status = Column(String(20), default="waiting")  # waiting / active / finished / expired
     data = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # последний ход
     finished_at = Column(DateTime, nullable=True)
     
     # Связи
     creator = relationship("User", foreign_keys=[creator_id])
     players = relationship("GamePlayer", back_populates="session", cascade="all, delete-orphan")
+    
+    __table_args__ = (
+        Index("ix_game_sessions_status_updated", "status", "updated_at"),
+        Index("ix_game_sessions_status_finished", "status", "finished_at"),
+    )
 
 
 class GamePlayer(Base):
@@ -119,6 +225,10 @@ class GamePlayer(Base):
     # Связи
     session = relationship("GameSession", back_populates="players")
     user = relationship("User")
+    
+    __table_args__ = (
+        Index("ix_game_players_session", "session_id"),
+    )
 
 
 class GameStats(Base):
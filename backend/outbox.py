@@ -0,0 +1,260 @@
+import asyncio
+import json
+import os
+import random
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import select, update, delete, and_
+
+from models import NotificationOutbox
+from metrics import outbox_notifications, outbox_send_duration
+
+
+OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+OUTBOX_SENDER = os.getenv("OUTBOX_SENDER", "log")
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "200"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "1"))
+# Сколько подождать после пробуждения, чтобы серия сообщений ушла одним уведомлением
+OUTBOX_COALESCE_SECONDS = float(os.getenv("OUTBOX_COALESCE_SECONDS", "0.5"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "2"))
+OUTBOX_RETRY_MAX_SECONDS = float(os.getenv("OUTBOX_RETRY_MAX_SECONDS", "600"))
+# На столько взятая пачка скрыта от других воркеров; упавший воркер — строки снова в очереди.
+# Должно быть больше самой долгой отправки, иначе пачку возьмут повторно
+OUTBOX_CLAIM_SECONDS = float(os.getenv("OUTBOX_CLAIM_SECONDS", "60"))
+# Неотправленное уведомление старше этого уже не нужно — его удаляет очистка (maintenance.py)
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "3"))
+
+PREVIEW_LENGTH = 100
+
+
+def outbox_entry(recipient_id: int, chat_id: int, message_id: int, sender_id: int,
+                 sender_name: str, text: Optional[str], image_url: Optional[str]) -> NotificationOutbox:
+    """Строка outbox для сообщения — добавляется в ту же сессию, что и само сообщение"""
+    payload = {
+        "sender_id": sender_id,
+        "sender_name": sender_name,
+        "text": (text or "")[:PREVIEW_LENGTH],
+        "has_image": bool(image_url),
+    }
+    return NotificationOutbox(
+        user_id=recipient_id,
+        chat_id=chat_id,
+        message_id=message_id,
+        payload=json.dumps(payload, ensure_ascii=False),
+        status="pending",
+        attempts=0,
+        next_attempt_at=datetime.utcnow()
+    )
+
+
+def coalesce(user_id: int, rows: list[NotificationOutbox]) -> dict:
+    """Пачку уведомлений одному получателю — в одно: сколько новых и в каких чатах"""
+    chats: dict[int, dict] = {}
+    for row in rows:
+        payload = json.loads(row.payload)
+        chat = chats.setdefault(row.chat_id, {
+            "chat_id": row.chat_id,
+            "sender_id": payload["sender_id"],
+            "sender_name": payload["sender_name"],
+            "count": 0,
+        })
+        chat["count"] += 1
+        chat["last_message_id"] = row.message_id
+        chat["last_text"] = payload["text"]
+        chat["has_image"] = payload["has_image"]
+    return {"user_id": user_id, "total": len(rows), "chats": list(chats.values())}
+
+
+# ============ ОТПРАВКА ============
+
+class NotificationSender(ABC):
+    """Куда уходят уведомления (FCM, APNs, ...).
+
+    send() бросает исключение — пачка получателя уйдёт на повтор с задержкой.
+    """
+
+    @abstractmethod
+    async def send(self, notification: dict):
+        ...
+
+
+class LogSender(NotificationSender):
+    """Просто печатает уведомления (пока нет настоящего push-провайдера)"""
+
+    async def send(self, notification: dict):
+        print(f"Notification for user {notification['user_id']}: {notification['total']} new message(s)")
+
+
+class FakeSender(NotificationSender):
+    """Для тестов: копит отправленное, первые fail_times вызовов падают"""
+
+    def __init__(self, fail_times: int = 0):
+        self.sent: list[dict] = []
+        self.fail_times = fail_times
+
+    async def send(self, notification: dict):
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise RuntimeError("fake sender failure")
+        self.sent.append(notification)
+
+
+SENDERS = {"log": LogSender, "fake": FakeSender}
+
+
+def retry_delay(attempts: int) -> float:
+    """Экспоненциальная задержка с разбросом, чтобы повторы не шли волной"""
+    delay = min(OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1), OUTBOX_RETRY_MAX_SECONDS)
+    return delay * random.uniform(0.5, 1.0)
+
+
+# ============ ВОРКЕРЫ ============
+
+class OutboxWorkerPool:
+    """Воркеры, разбирающие outbox пачками.
+
+    Получатели поделены между воркерами по user_id % workers, поэтому
+    уведомления одному пользователю не уходят параллельно и не дублируются.
+    Между процессами строки делит FOR UPDATE SKIP LOCKED (PostgreSQL).
+    Отправка идёт вне транзакции: пачка сначала берётся в аренду
+    (next_attempt_at сдвигается на OUTBOX_CLAIM_SECONDS, commit), а итог
+    записывается второй короткой транзакцией.
+    """
+
+    def __init__(self, sender: NotificationSender, workers: int = OUTBOX_WORKERS, batch_size: int = OUTBOX_BATCH_SIZE):
+        self.sender = sender
+        self.workers = workers
+        self.batch_size = batch_size
+        self.session_factory = None
+        self.tasks: list[asyncio.Task] = []
+        self.wakeups: list[asyncio.Event] = []
+
+    def start(self, session_factory):
+        self.session_factory = session_factory
+        self.wakeups = [asyncio.Event() for _ in range(self.workers)]
+        self.tasks = [asyncio.create_task(self._run(worker)) for worker in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def notify(self):
+        """Разбудить воркеры после commit — без ожидания, чат не тормозит"""
+        for wakeup in self.wakeups:
+            wakeup.set()
+
+    async def _run(self, worker: int):
+        wakeup = self.wakeups[worker]
+        while True:
+            wakeup.clear()
+            try:
+                while await self.drain_once(worker) >= self.batch_size:
+                    await asyncio.sleep(0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Outbox worker {worker} error: {e}")
+
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=OUTBOX_POLL_SECONDS)
+                await asyncio.sleep(OUTBOX_COALESCE_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def drain_once(self, worker: int = 0) -> int:
+        """Отправить одну пачку. Возвращает число взятых строк"""
+        rows = await self._claim(worker)
+        if not rows:
+            return 0
+
+        by_user: dict[int, list[NotificationOutbox]] = {}
+        for row in rows:
+            by_user.setdefault(row.user_id, []).append(row)
+
+        # Соединение с БД здесь не держим: провайдер может отвечать секундами
+        results = await asyncio.gather(
+            *(self._send(user_id, items) for user_id, items in by_user.items()),
+            return_exceptions=True
+        )
+
+        sent_ids = []
+        retries: dict[tuple[int, str], list[int]] = {}  # (номер попытки, ошибка) -> id строк
+        for items, error in zip(by_user.values(), results):
+            if error is None:
+                sent_ids.extend(row.id for row in items)
+                outbox_notifications.inc("sent", amount=len(items))
+                continue
+            for row in items:
+                retries.setdefault(((row.attempts or 0) + 1, str(error)[:500]), []).append(row.id)
+        await self._ack(sent_ids, retries)
+        return len(rows)
+
+    async def _claim(self, worker: int) -> list[NotificationOutbox]:
+        """Взять пачку в аренду и сразу закоммитить"""
+        now = datetime.utcnow()
+        async with self.session_factory() as session:
+            query = (
+                select(NotificationOutbox)
+                .where(and_(
+                    NotificationOutbox.status == "pending",
+                    NotificationOutbox.next_attempt_at <= now,
+                    NotificationOutbox.user_id % self.workers == worker
+                ))
+                .order_by(NotificationOutbox.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            rows = (await session.execute(query)).scalars().all()
+            if not rows:
+                return []
+            # Условный UPDATE: без SKIP LOCKED (SQLite) ту же строку мог выбрать другой воркер —
+            # достаётся она тому, чей UPDATE прошёл первым
+            claimed = set((await session.execute(
+                update(NotificationOutbox)
+                .where(and_(
+                    NotificationOutbox.id.in_([row.id for row in rows]),
+                    NotificationOutbox.next_attempt_at <= now
+                ))
+                .values(next_attempt_at=now + timedelta(seconds=OUTBOX_CLAIM_SECONDS))
+                .returning(NotificationOutbox.id)
+                .execution_options(synchronize_session=False)
+            )).scalars().all())
+            await session.commit()
+            return [row for row in rows if row.id in claimed]
+
+    async def _ack(self, sent_ids: list[int], retries: dict[tuple[int, str], list[int]]):
+        """Итог отправки: отправленные удалить, остальные — на повтор или в failed"""
+        now = datetime.utcnow()
+        async with self.session_factory() as session:
+            if sent_ids:
+                await session.execute(delete(NotificationOutbox).where(NotificationOutbox.id.in_(sent_ids)))
+            for (attempts, error), ids in retries.items():
+                if attempts >= OUTBOX_MAX_ATTEMPTS:
+                    values = {"status": "failed"}
+                    outbox_notifications.inc("failed", amount=len(ids))
+                else:
+                    values = {"next_attempt_at": now + timedelta(seconds=retry_delay(attempts))}
+                    outbox_notifications.inc("retry", amount=len(ids))
+                await session.execute(
+                    update(NotificationOutbox)
+                    .where(NotificationOutbox.id.in_(ids))
+                    .values(attempts=attempts, last_error=error, **values)
+                )
+            await session.commit()
+
+    async def _send(self, user_id: int, items: list[NotificationOutbox]):
+        started = time.perf_counter()
+        try:
+            await self.sender.send(coalesce(user_id, items))
+        finally:
+            outbox_send_duration.observe(time.perf_counter() - started)
+
+
+outbox = OutboxWorkerPool(SENDERS[OUTBOX_SENDER]())
@@ -0,0 +1,177 @@
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from datetime import datetime
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy import select, or_
+
+from models import DirectChat, User
+from connections import Connection
+from admission import admission, Overloaded
+from metrics import presence_events
+
+
+PRESENCE_ENABLED = os.getenv("PRESENCE_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+# Не чаще одного события о пользователе за интервал: мигающее соединение даёт одно событие (или ни одного)
+PRESENCE_COALESCE_SECONDS = float(os.getenv("PRESENCE_COALESCE_SECONDS", "2"))
+# Для скольких пользователей помнить список собеседников
+PRESENCE_PARTNERS_CACHE = int(os.getenv("PRESENCE_PARTNERS_CACHE", "10000"))
+
+
+class PresenceHub:
+    """Рассылает смену онлайн-статуса подписанным сокетам собеседников.
+
+    Сокет подписывается кадром {"type": "subscribe_presence"} и получает
+    снимок статусов всех собеседников, дальше — только изменения
+    {"type": "presence", ...}. Изменения копятся и раз в интервал
+    сравниваются с последним разосланным состоянием: вошёл и вышел
+    в пределах интервала — события нет.
+    """
+
+    def __init__(self, interval: float = PRESENCE_COALESCE_SECONDS, max_cached: int = PRESENCE_PARTNERS_CACHE):
+        self.interval = interval
+        self.max_cached = max_cached
+        self.subscribers: dict[int, set[Connection]] = {}
+        self.pending: dict[int, tuple[bool, datetime]] = {}
+        self.published: set[int] = set()  # кто онлайн по последним разосланным событиям
+        self.partners: OrderedDict[int, set[int]] = OrderedDict()
+        self.session_factory = None
+        self.send: Optional[Callable[[Connection, str], Awaitable]] = None
+        self.is_online: Callable[[int], bool] = lambda user_id: user_id in self.published
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, session_factory, send: Callable[[Connection, str], Awaitable],
+              is_online: Optional[Callable[[int], bool]] = None):
+        """is_online — текущий статус для снимка (published отстаёт на интервал)"""
+        self.session_factory = session_factory
+        self.send = send
+        if is_online is not None:
+            self.is_online = is_online
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def changed(self, user_id: int, is_online: bool):
+        """Пользователь появился или пропал (вызывается ConnectionManager, без ожидания)"""
+        if self._wakeup is None:
+            return  # Рассылка выключена
+        self.pending[user_id] = (is_online, datetime.utcnow())
+        self._wakeup.set()
+
+    def chat_created(self, user1_id: int, user2_id: int):
+        for user_id, partner_id in ((user1_id, user2_id), (user2_id, user1_id)):
+            if user_id in self.partners:
+                self.partners[user_id].add(partner_id)
+
+    async def _partners_of(self, user_id: int) -> set[int]:
+        partners = self.partners.get(user_id)
+        if partners is not None:
+            self.partners.move_to_end(user_id)
+            return partners
+
+        async with admission.admit("presence"), self.session_factory() as session:
+            query = select(DirectChat.user1_id, DirectChat.user2_id).where(
+                or_(DirectChat.user1_id == user_id, DirectChat.user2_id == user_id)
+            )
+            rows = (await session.execute(query)).all()
+        partners = {row.user2_id if row.user1_id == user_id else row.user1_id for row in rows}
+
+        self.partners[user_id] = partners
+        while len(self.partners) > self.max_cached:
+            self.partners.popitem(last=False)
+        return partners
+
+    async def subscribe(self, conn: Connection) -> Optional[dict]:
+        """Подписать сокет. Возвращает снимок: статусы всех собеседников. None — уже подписан"""
+        user_id = conn.user_id
+        if conn in self.subscribers.get(user_id, ()):
+            return None  # Снимок уже отдан, дальше идут изменения — повторный запрос в БД не нужен
+        partners = await self._partners_of(user_id)
+        online = {partner_id for partner_id in partners if self.is_online(partner_id)}
+        offline = [partner_id for partner_id in partners if partner_id not in online]
+        last_seen = {}
+        if offline:
+            async with admission.admit("presence"), self.session_factory() as session:
+                query = select(User.id, User.last_seen).where(User.id.in_(offline))
+                last_seen = {row.id: row.last_seen for row in (await session.execute(query)).all()}
+
+        self.subscribers.setdefault(user_id, set()).add(conn)
+        return {
+            "type": "presence_snapshot",
+            "users": [
+                {
+                    "user_id": partner_id,
+                    "is_online": partner_id in online,
+                    "last_seen": last_seen[partner_id].isoformat() if last_seen.get(partner_id) else None
+                }
+                for partner_id in sorted(partners)
+            ]
+        }
+
+    def unsubscribe(self, conn: Connection):
+        sockets = self.subscribers.get(conn.user_id)
+        if sockets is not None:
+            sockets.discard(conn)
+            if not sockets:
+                del self.subscribers[conn.user_id]
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            # Копим изменения интервал, потом рассылаем итог
+            await asyncio.sleep(self.interval)
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Presence error: {e}")
+
+    async def flush(self):
+        batch, self.pending = self.pending, {}
+        for user_id, (is_online, changed_at) in batch.items():
+            if (user_id in self.published) == is_online:
+                continue  # Вернулся в то же состояние — событие не нужно
+
+            recipients = []
+            if self.subscribers:
+                try:
+                    partners = await self._partners_of(user_id)
+                except Overloaded:
+                    # Без списка собеседников не разослать — попробуем в следующий интервал
+                    self.pending.setdefault(user_id, (is_online, changed_at))
+                    self._wakeup.set()
+                    continue
+                recipients = [conn for partner_id in partners for conn in self.subscribers.get(partner_id, ())]
+
+            if is_online:
+                self.published.add(user_id)
+            else:
+                self.published.discard(user_id)
+            if not recipients:
+                continue
+
+            frame = json.dumps({
+                "type": "presence",
+                "user_id": user_id,
+                "is_online": is_online,
+                "last_seen": None if is_online else changed_at.isoformat()
+            })
+            for conn in recipients:
+                try:
+                    await self.send(conn, frame)
+                except Exception:
+                    pass  # Мёртвый сокет уберёт disconnect
+            presence_events.inc(amount=len(recipients))
+
+
+presence = PresenceHub()
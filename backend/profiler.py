@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import weakref
+from collections import Counter, deque
+from datetime import datetime
+from typing import Optional
+
+from metrics import loop_lag, loop_blocks, route_label
+
+
+logger = logging.getLogger("omega.loop")
+
+# Частота выборок профилировщика; 10 мс — около 1% CPU на поток выборки
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", "10"))
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "60"))
+
+LOOP_MONITOR_ENABLED = os.getenv("LOOP_MONITOR_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+# Как часто мерить задержку event loop
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+# Колбэк дольше этого считается блокировкой loop: пишем в лог его стек
+LOOP_BLOCK_MS = float(os.getenv("LOOP_BLOCK_MS", "100"))
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    path = code.co_filename.replace("\\", "/").split("/")
+    return f"{code.co_name} ({'/'.join(path[-2:])}:{code.co_firstlineno})"
+
+
+def _stack(frame) -> list[str]:
+    """Стек от корня к листу"""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+
+class SamplingProfiler:
+    """Выборочный профилировщик потока event loop.
+
+    Отдельный поток раз в PROFILER_INTERVAL_MS снимает стек потока loop
+    (sys._current_frames) — сам loop при этом не трогается, поэтому видно
+    и async-код, и то, что его блокирует (bcrypt, json, ORM). Результат —
+    свёрнутые стеки "корень;...;лист N" для flamegraph.pl и speedscope.
+
+    С fraction < 1 выборки берутся только пока loop выполняет задачу
+    одного из отобранных запросов (доля fraction от всех), а корнем
+    стека становится маршрут запроса.
+    """
+
+    def __init__(self, interval: float = PROFILER_INTERVAL_MS / 1000):
+        self.interval = interval
+        self.running = False
+        self.fraction = 1.0
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.sampled_tasks: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()  # задача -> ASGI scope
+
+    async def profile(self, seconds: float, fraction: float = 1.0) -> str:
+        """Профилировать seconds секунд, вернуть свёрнутые стеки"""
+        if self.running:
+            raise ProfilerBusy("Профилировщик уже запущен")
+        loop = asyncio.get_running_loop()
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._sample, args=(loop, threading.get_ident(), stop), name="omega-profiler", daemon=True
+        )
+        self.stacks = Counter()
+        self.samples = 0
+        self.fraction = fraction
+        self.running = True
+        thread.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+            self.running = False
+            await asyncio.to_thread(thread.join)
+            self.sampled_tasks.clear()
+        return self.folded()
+
+    def maybe_sample(self, scope: dict):
+        """Отобрать текущий запрос с вероятностью fraction (из мидлвари)"""
+        if self.running and self.fraction < 1 and random.random() < self.fraction:
+            task = asyncio.current_task()
+            if task is not None:
+                self.sampled_tasks[task] = scope
+
+    def _sample(self, loop, thread_id: int, stop: threading.Event):
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            prefix = ()
+            if self.fraction < 1:
+                task = asyncio.current_task(loop)
+                scope = self.sampled_tasks.get(task) if task is not None else None
+                if scope is None:
+                    continue
+                prefix = (f"{scope.get('method', 'WS')} {route_label(scope)}",)
+            self.stacks[";".join((*prefix, *_stack(frame)))] += 1
+            self.samples += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class ProfilerMiddleware:
+    """ASGI-мидлварь: отбирает долю запросов для профилировщика"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if profiler.running and scope["type"] in ("http", "websocket"):
+            profiler.maybe_sample(scope)
+        await self.app(scope, receive, send)
+
+
+class LoopMonitor:
+    """Задержка event loop и поиск блокировок.
+
+    Корутина раз в LOOP_LAG_INTERVAL засыпает и меряет, насколько позже
+    проснулась — это задержка loop. Вторая корутина ставит отметку каждые
+    LOOP_BLOCK_MS / 2, поток-сторож следит за отметками: если loop не
+    отзывается дольше LOOP_BLOCK_MS, значит, какой-то колбэк занял его
+    целиком — сторож снимает стек потока loop и пишет в лог, пока колбэк
+    ещё выполняется.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold: float = LOOP_BLOCK_MS / 1000):
+        self.interval = interval
+        self.threshold = threshold
+        # Отметки чаще порога: иначе блокировка между редкими отметками не видна
+        self.beat = threshold / 2
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.heartbeat = time.monotonic()
+        self.blocks: deque[dict] = deque(maxlen=20)
+        self._tasks: list[asyncio.Task] = []
+        self._stop = threading.Event()
+
+    def start(self):
+        self.heartbeat = time.monotonic()
+        self._stop.clear()
+        self._tasks = [asyncio.create_task(self._tick()), asyncio.create_task(self._beat())]
+        threading.Thread(
+            target=self._watch, args=(threading.get_ident(),), name="omega-loop-watchdog", daemon=True
+        ).start()
+
+    async def stop(self):
+        self._stop.set()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _tick(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.lag = max(0.0, now - started - self.interval)
+            self.max_lag = max(self.max_lag, self.lag)
+            loop_lag.observe(self.lag)
+
+    async def _beat(self):
+        while True:
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.beat)
+
+    def _watch(self, thread_id: int):
+        reported = None
+        while not self._stop.wait(self.beat / 2):
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat - self.beat
+            if stalled < self.threshold or reported == heartbeat:
+                continue
+            reported = heartbeat  # Одна блокировка — одна запись
+            frame = sys._current_frames().get(thread_id)
+            stack = _stack(frame) if frame is not None else []
+            loop_blocks.inc()
+            self.blocks.append({
+                "at": datetime.utcnow().isoformat(),
+                "blocked_ms": round(stalled * 1000),
+                "stack": stack,
+            })
+            logger.warning(
+                "Event loop blocked for at least %.0f ms in:\n  %s", stalled * 1000, "\n  ".join(stack[-15:])
+            )
+
+    def report(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "lag_ms": round(self.lag * 1000, 2),
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+            "block_threshold_ms": round(self.threshold * 1000),
+            "recent_blocks": list(self.blocks),
+        }
+
+
+profiler = SamplingProfiler()
+loop_monitor = LoopMonitor()
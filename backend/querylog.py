@@ -0,0 +1,154 @@
+import logging
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+from sqlalchemy import event
+
+
+logger = logging.getLogger("omega.sql")
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+# Столько одинаковых запросов за один HTTP-запрос/WS-сообщение — подозрение на N+1
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "5"))
+# Отдавать X-DB-Queries / X-DB-Time-ms в ответах (удобно при отладке)
+QUERY_STATS_HEADERS = os.getenv("QUERY_STATS_HEADERS", "false").lower() in ("1", "true", "yes", "on")
+
+
+class QueryStats:
+    """Запросы к БД в рамках одного HTTP-запроса или WS-сообщения"""
+
+    def __init__(self, label: str):
+        self.label = label
+        self.count = 0
+        self.total_time = 0.0
+        self.shapes: Counter = Counter()
+
+    def record(self, statement: str, duration: float):
+        self.count += 1
+        self.total_time += duration
+        self.shapes[statement] += 1
+
+    def suspected_n_plus_one(self) -> list[tuple[str, int]]:
+        return [(shape, n) for shape, n in self.shapes.most_common() if n >= N_PLUS_ONE_THRESHOLD]
+
+    def report(self):
+        for shape, n in self.suspected_n_plus_one():
+            logger.warning(
+                "Possible N+1 in %s: %d x %s (%d queries, %.1f ms total)",
+                self.label, n, " ".join(shape.split()), self.count, self.total_time * 1000
+            )
+
+
+_current: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+_captures: list[QueryStats] = []
+
+
+def _param_shape(parameters) -> str:
+    """Типы параметров без значений — чтобы в лог не попадали данные пользователей"""
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in parameters.items()) + "}"
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (list, tuple, dict)):
+            return f"{len(parameters)} x {_param_shape(parameters[0])}"
+        return "(" + ", ".join(type(v).__name__ for v in parameters) + ")"
+    return type(parameters).__name__
+
+
+def install_query_hooks(engine, observe: Optional[Callable[[str, float], None]] = None):
+    """Считать запросы и логировать медленные. observe(statement, duration) — для метрик"""
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        # Одно значение, а не стек: запросы на соединении не вкладываются, а after
+        # не срабатывает, если запрос упал, — следующий before просто перезапишет
+        conn.info["querylog_start"] = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info.pop("querylog_start")
+        if observe is not None:
+            observe(statement, duration)
+
+        stats = _current.get()
+        if stats is not None:
+            stats.record(statement, duration)
+        for capture in _captures:
+            capture.record(statement, duration)
+
+        if duration * 1000 >= SLOW_QUERY_MS:
+            logger.warning(
+                "Slow query %.1f ms%s: %s params=%s",
+                duration * 1000,
+                f" in {stats.label}" if stats else "",
+                " ".join(statement.split()),
+                _param_shape(parameters)
+            )
+
+
+@contextmanager
+def track_queries(label: str):
+    """Считать запросы внутри блока (например, обработки одного WS-сообщения)"""
+    stats = QueryStats(label)
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+        stats.report()
+
+
+@contextmanager
+def assert_max_queries(limit: int, label: str = "block"):
+    """Для тестов: упасть, если в блоке больше limit запросов.
+
+    Считает все запросы движка, в том числе из потока TestClient.
+        with assert_max_queries(3):
+            client.get("/me/directs", params={"token": token})
+    """
+    capture = QueryStats(label)
+    _captures.append(capture)
+    try:
+        yield capture
+    finally:
+        _captures.remove(capture)
+
+    if capture.count > limit:
+        statements = "\n".join(f"  {n} x {' '.join(shape.split())}" for shape, n in capture.shapes.most_common())
+        raise AssertionError(f"{label}: {capture.count} queries, expected at most {limit}:\n{statements}")
+
+
+class QueryCountMiddleware:
+    """ASGI-мидлварь: считает запросы к БД на каждый HTTP-запрос"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats(f"{scope['method']} {scope['path']}")
+        token = _current.set(stats)
+
+        async def send_wrapper(message):
+            if QUERY_STATS_HEADERS and message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-db-queries", str(stats.count).encode()))
+                headers.append((b"x-db-time-ms", f"{stats.total_time * 1000:.1f}".encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            route = scope.get("route")
+            if route is not None:
+                stats.label = f"{scope['method']} {route.path}"
+            stats.report()
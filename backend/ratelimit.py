@@ -0,0 +1,137 @@
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+
+
+def parse_limit(value: str) -> tuple[int, float]:
+    """ "10/1" -> 10 запросов за 1 секунду"""
+    capacity, period = value.split("/")
+    return int(capacity), float(period)
+
+
+# Лимиты по умолчанию: "запросов/секунд". Переопределяются через
+# переменные окружения RATE_LIMIT_<ИМЯ>, например RATE_LIMIT_WS_MESSAGE_USER=20/1
+DEFAULT_LIMITS = {
+    "ws_message_user": "10/1",
+    "ws_message_chat": "30/1",
+    "ws_read_user": "5/1",
+    "ws_presence_user": "3/10",
+    "upload_client": "10/60",
+    "search_user": "10/1",
+    "users_batch": "10/1",
+    "export_user": "3/60",
+}
+
+RATE_LIMITS = {
+    name: parse_limit(os.getenv(f"RATE_LIMIT_{name.upper()}", default))
+    for name, default in DEFAULT_LIMITS.items()
+}
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimitBackend(ABC):
+    """Хранилище корзин. Для нескольких воркеров можно реализовать поверх Redis"""
+
+    @abstractmethod
+    async def take(self, key: str, capacity: int, period: float) -> float:
+        """Взять один токен. Возвращает 0, если можно, иначе сколько секунд ждать"""
+
+    @abstractmethod
+    async def refund(self, key: str, capacity: int):
+        """Вернуть взятый токен (запрос всё равно отклонён другим лимитом)"""
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    """Корзины в памяти процесса"""
+
+    def __init__(self, max_keys: int = 100_000):
+        # Порядок — по последнему обращению: в начале самые давно не тронутые
+        self.buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+        self.max_keys = max_keys
+
+    async def take(self, key: str, capacity: int, period: float) -> float:
+        now = time.monotonic()
+        rate = capacity / period
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self._evict(now)
+            bucket = self.buckets[key] = TokenBucket(capacity, now)
+        else:
+            bucket.tokens = min(capacity, bucket.tokens + (now - bucket.updated) * rate)
+            bucket.updated = now
+            self.buckets.move_to_end(key)
+
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return 0.0
+        return (1 - bucket.tokens) / rate
+
+    async def refund(self, key: str, capacity: int):
+        bucket = self.buckets.get(key)
+        if bucket is not None:
+            bucket.tokens = min(capacity, bucket.tokens + 1)
+
+    def _evict(self, now: float):
+        # Корзина, простоявшая дольше минуты, всё равно уже полная — её можно забыть.
+        # Если таких нет, уходит самая давно не тронутая (LRU), а не все разом:
+        # иначе перебором ключей можно было бы обнулить лимиты всем клиентам
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if now - bucket.updated <= 60 and len(self.buckets) < self.max_keys:
+                break
+            del self.buckets[key]
+
+
+class RateLimiter:
+    def __init__(self, backend: RateLimitBackend, limits: dict[str, tuple[int, float]]):
+        self.backend = backend
+        self.limits = limits
+
+    async def check(self, name: str, key) -> float:
+        """0 — запрос разрешён, иначе сколько секунд подождать"""
+        limit: Optional[tuple[int, float]] = self.limits.get(name)
+        if not limit:
+            return 0.0
+        capacity, period = limit
+        return await self.backend.take(f"{name}:{key}", capacity, period)
+
+    async def check_all(self, *checks: tuple[str, object]) -> float:
+        """Несколько лимитов на один запрос: (имя, ключ) по порядку.
+
+        Отказ по любому — и токены, уже взятые у предыдущих, возвращаются:
+        отклонённый запрос не расходует чужие лимиты.
+        """
+        taken = []
+        for name, key in checks:
+            retry_after = await self.check(name, key)
+            if retry_after:
+                for taken_name, taken_key in taken:
+                    await self.backend.refund(f"{taken_name}:{taken_key}", self.limits[taken_name][0])
+                return retry_after
+            if name in self.limits:
+                taken.append((name, key))
+        return 0.0
+
+
+def slow_down_frame(retry_after: float) -> dict:
+    """Ошибка для клиента WebSocket: слишком часто"""
+    return {
+        "type": "error",
+        "code": "slow_down",
+        "detail": "Слишком много запросов, попробуйте позже",
+        "retry_after_ms": int(retry_after * 1000) + 1
+    }
+
+
+rate_limiter = RateLimiter(MemoryRateLimitBackend(), RATE_LIMITS)
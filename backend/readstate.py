@@ -0,0 +1,73 @@
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import select, func, and_
+
+from models import Message, ChatReadState
+
+
+def _insert(session):
+    """INSERT с ON CONFLICT для текущего диалекта"""
+    # Импорт здесь: диалект движка уже загружен create_async_engine, а чужой не нужен
+    if session.bind.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(ChatReadState)
+
+
+async def mark_read(session, chat_id: int, user_id: int, message_id: Optional[int] = None) -> Optional[int]:
+    """Сдвинуть отметку прочтения вперёд. Возвращает новую отметку.
+
+    None — читать нечего или отметка уже дальше (старое событие): рассылать нечего.
+
+    Одна строка на (чат, пользователь) вместо UPDATE всех непрочитанных сообщений.
+    """
+    conditions = [Message.chat_id == chat_id]
+    if message_id is not None:
+        conditions.append(Message.id <= message_id)
+    last_id = (await session.execute(select(func.max(Message.id)).where(and_(*conditions)))).scalar()
+    if last_id is None:
+        return None
+
+    stmt = _insert(session).values(
+        chat_id=chat_id,
+        user_id=user_id,
+        last_read_message_id=last_id,
+        updated_at=datetime.utcnow()
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ChatReadState.chat_id, ChatReadState.user_id],
+        set_={
+            "last_read_message_id": stmt.excluded.last_read_message_id,
+            "updated_at": stmt.excluded.updated_at,
+        },
+        # Отметка только растёт: старое событие "прочитано" её не откатит
+        where=ChatReadState.last_read_message_id < stmt.excluded.last_read_message_id
+    ).returning(ChatReadState.last_read_message_id)
+    # Строка возвращается, только если вставлена или сдвинута
+    return (await session.execute(stmt)).scalar_one_or_none()
+
+
+async def get_chat_watermarks(session, chat_id: int) -> dict[int, int]:
+    """user_id -> последнее прочитанное сообщение в чате"""
+    query = select(ChatReadState.user_id, ChatReadState.last_read_message_id).where(
+        ChatReadState.chat_id == chat_id
+    )
+    return {row.user_id: row.last_read_message_id for row in (await session.execute(query)).all()}
+
+
+async def get_user_watermarks(session, user_id: int, chat_ids: list[int]) -> dict[int, int]:
+    """chat_id -> докуда пользователь прочитал каждый из чатов"""
+    if not chat_ids:
+        return {}
+    query = select(ChatReadState.chat_id, ChatReadState.last_read_message_id).where(
+        and_(ChatReadState.user_id == user_id, ChatReadState.chat_id.in_(chat_ids))
+    )
+    return {row.chat_id: row.last_read_message_id for row in (await session.execute(query)).all()}
+
+
+def is_read_by_other(message_id: int, sender_id: int, chat, watermarks: dict[int, int]) -> bool:
+    """Прочитано ли сообщение собеседником отправителя (для совместимого поля is_read)"""
+    reader_id = chat.user2_id if sender_id == chat.user1_id else chat.user1_id
+    return message_id <= watermarks.get(reader_id, 0)
@@ -0,0 +1,190 @@
+import json
+import os
+import uuid
+from typing import Optional
+
+from sqlalchemy import select, update, or_, and_
+
+from models import Message, User, DirectChat, ChatReadState, SyncCursor
+
+
+# Сколько сообщений максимум отдаёт один вызов /sync (дальше — has_more)
+SYNC_MAX_MESSAGES = int(os.getenv("SYNC_MAX_MESSAGES", "500"))
+# Курсор старше стольких дней удаляется — клиент начинает /sync заново
+SYNC_CURSOR_TTL_DAYS = int(os.getenv("SYNC_CURSOR_TTL_DAYS", "30"))
+
+
+async def next_seq(session, chat_id: int) -> int:
+    """Выдать следующий номер сообщения в чате.
+
+    UPDATE блокирует строку чата до commit, поэтому номера внутри чата
+    идут без пропусков и в том же порядке, в каком сообщения видны читателям.
+    """
+    result = await session.execute(
+        update(DirectChat)
+        .where(DirectChat.id == chat_id)
+        .values(last_seq=DirectChat.last_seq + 1)
+        .returning(DirectChat.last_seq)
+    )
+    return result.scalar_one()
+
+
+# ============ КУРСОР ============
+# Курсор — что клиент уже видел в каждом чате:
+# {chat_id: [последний seq, моя отметка прочтения, отметка собеседника]}.
+# Состояние растёт с числом чатов, поэтому лежит в sync_cursors, а клиент
+# получает только id строки — курсор фиксированной длины.
+
+def _dump_state(state: dict[int, list[int]]) -> str:
+    return json.dumps({str(chat_id): marks for chat_id, marks in state.items()}, separators=(",", ":"))
+
+
+def _load_state(raw: str) -> dict[int, list[int]]:
+    data = json.loads(raw)
+    return {int(chat_id): [int(marks[0]), int(marks[1]), int(marks[2])] for chat_id, marks in data.items()}
+
+
+async def load_cursor(session, user_id: int, cursor: str) -> dict[int, list[int]]:
+    """Состояние по id курсора (ValueError, если курсора нет, он чужой или истёк)"""
+    query = select(SyncCursor.state).where(and_(SyncCursor.id == cursor, SyncCursor.user_id == user_id))
+    raw = (await session.execute(query)).scalar_one_or_none()
+    if raw is None:
+        raise ValueError("Invalid cursor")
+    return _load_state(raw)
+
+
+async def save_cursor(session_factory, user_id: int, state: dict[int, list[int]]) -> str:
+    """Записать состояние в основную БД и вернуть id нового курсора.
+
+    Строки не меняются: клиент может повторить запрос со старым курсором.
+    """
+    cursor = uuid.uuid4().hex
+    async with session_factory() as session:
+        session.add(SyncCursor(id=cursor, user_id=user_id, state=_dump_state(state)))
+        await session.commit()
+    return cursor
+
+
+# ============ ИЗМЕНЕНИЯ ============
+
+async def collect_changes(session, user_id: int, cursor: Optional[str], limit: int = SYNC_MAX_MESSAGES) -> dict:
+    """Всё, что изменилось во всех чатах пользователя после курсора.
+
+    Без курсора отдаёт только список чатов и курсор на текущий момент
+    (историю клиент грузит как раньше, через /chats/{id}/messages).
+    Пять запросов независимо от числа чатов. Новое состояние — в "state":
+    его сохраняет вызывающий (save_cursor) и отдаёт клиенту id курсора.
+    """
+    known = await load_cursor(session, user_id, cursor) if cursor else None
+
+    chats = (await session.execute(
+        select(DirectChat).where(or_(DirectChat.user1_id == user_id, DirectChat.user2_id == user_id))
+    )).scalars().all()
+    chat_ids = [chat.id for chat in chats]
+
+    watermarks: dict[int, dict[int, int]] = {}
+    if chat_ids:
+        query = select(ChatReadState).where(ChatReadState.chat_id.in_(chat_ids))
+        for row in (await session.execute(query)).scalars():
+            watermarks.setdefault(row.chat_id, {})[row.user_id] = row.last_read_message_id
+
+    state: dict[int, list[int]] = {}
+    new_chats = []
+    reads = []
+    wanted = {}  # chat_id -> последний известный клиенту seq
+    for chat in chats:
+        friend_id = chat.user2_id if chat.user1_id == user_id else chat.user1_id
+        marks = watermarks.get(chat.id, {})
+        current = [chat.last_seq, marks.get(user_id, 0), marks.get(friend_id, 0)]
+
+        if known is None:
+            state[chat.id] = current
+            new_chats.append(chat)
+            continue
+
+        seen = known.get(chat.id)
+        if seen is None:
+            new_chats.append(chat)
+            seen = [0, 0, 0]
+        if current[0] > seen[0]:
+            wanted[chat.id] = seen[0]
+        for reader_id, before, now in ((user_id, seen[1], current[1]), (friend_id, seen[2], current[2])):
+            if now != before:
+                reads.append({"chat_id": chat.id, "reader_id": reader_id, "last_read_message_id": now})
+        # seq сдвинем ниже — по тому, что реально уместилось в ответ
+        state[chat.id] = [seen[0], current[1], current[2]]
+
+    friends = {}
+    if new_chats:
+        friend_ids = {chat.user2_id if chat.user1_id == user_id else chat.user1_id for chat in new_chats}
+        query = select(User).where(User.id.in_(friend_ids))
+        friends = {u.id: u for u in (await session.execute(query)).scalars()}
+
+    messages = []
+    has_more = False
+    resync_chats = []
+    if wanted:
+        query = (
+            select(Message, User)
+            .join(User, Message.sender_id == User.id)
+            .where(or_(*(
+                and_(Message.chat_id == chat_id, Message.seq > seq) for chat_id, seq in wanted.items()
+            )))
+            .order_by(Message.chat_id, Message.seq)
+            .limit(limit + 1)
+        )
+        rows = (await session.execute(query)).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        chats_by_id = {chat.id: chat for chat in chats}
+        for msg, sender in rows:
+            if state[msg.chat_id][0] == wanted[msg.chat_id] and msg.seq > wanted[msg.chat_id] + 1:
+                # Пропущенные сообщения уже ушли в архив — клиенту проще перезагрузить чат
+                resync_chats.append(msg.chat_id)
+            state[msg.chat_id][0] = msg.seq
+
+            chat = chats_by_id[msg.chat_id]
+            reader_id = chat.user2_id if msg.sender_id == chat.user1_id else chat.user1_id
+            messages.append({
+                "id": msg.id,
+                "seq": msg.seq,
+                "chat_id": msg.chat_id,
+                "sender_id": msg.sender_id,
+                "username": sender.username,
+                "user_avatar": sender.avatar_url,
+                "text": msg.text,
+                "image": msg.image_url,
+                "time": msg.created_at.strftime("%H:%M"),
+                "created_at": msg.created_at.isoformat(),
+                "is_read": msg.id <= watermarks.get(chat.id, {}).get(reader_id, 0)
+            })
+
+        if not has_more:
+            # Всё отдали: если сообщения целиком в архиве, всё равно догоняем last_seq
+            for chat in chats:
+                if chat.id in wanted:
+                    if state[chat.id][0] == wanted[chat.id]:
+                        resync_chats.append(chat.id)
+                    state[chat.id][0] = max(state[chat.id][0], chat.last_seq)
+
+    return {
+        "state": state,
+        "unchanged": state == known,
+        "has_more": has_more,
+        "chats": [
+            {
+                "id": chat.id,
+                "name": friends[friend_id].username if friend_id in friends else None,
+                "username": friends[friend_id].username if friend_id in friends else None,
+                "avatar_url": friends[friend_id].avatar_url if friend_id in friends else None,
+                "last_seq": chat.last_seq,
+                "created_at": chat.created_at.isoformat() if chat.created_at else None
+            }
+            for chat in new_chats
+            for friend_id in [chat.user2_id if chat.user1_id == user_id else chat.user1_id]
+        ],
+        "messages": messages,
+        "reads": reads,
+        "resync_chats": resync_chats
+    }
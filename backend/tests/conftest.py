@@ -0,0 +1,38 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+
+# Окружение задаём до импорта main: настройки читаются при импорте модулей
+_workdir = tempfile.mkdtemp(prefix="omega-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{_workdir}/test.db")
+os.environ.setdefault("AUTO_MIGRATE", "true")
+os.environ.setdefault("OUTBOX_SENDER", "fake")
+os.chdir(_workdir)  # uploads/ и archive/ создаются относительно текущего каталога
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    from main import app
+
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture(scope="session")
+def register(client):
+    """Завести пользователя и вернуть (id, token)"""
+
+    def _register(username: str) -> tuple[int, str]:
+        email = f"{username}@example.com"
+        user = client.post("/register", json={"username": username, "email": email, "password": "secret1"})
+        assert user.status_code == 200, user.text
+        login = client.post("/login", json={"email": email, "password": "secret1"})
+        assert login.status_code == 200, login.text
+        return user.json()["id"], login.json()["access_token"]
+
+    return _register
@@ -0,0 +1,24 @@
+from querylog import assert_max_queries
+
+
+def test_me_directs_query_count_does_not_grow_with_chats(client, register):
+    """/me/directs — фиксированное число запросов, сколько бы ни было чатов (нет N+1)"""
+    owner_id, owner_token = register("owner")
+    for i in range(8):
+        peer_id, peer_token = register(f"peer{i}")
+        chat = client.post("/direct/start", params={"token": owner_token, "target_user_id": peer_id}).json()
+        with client.websocket_connect(f"/ws/dm/{chat['id']}?token={peer_token}") as ws:
+            ws.send_json({"text": f"hello {i}"})
+            ws.receive_json()
+    # Офлайн-статус собеседников пишется в фоне — даём записям завершиться до замера
+    client.get("/me/directs", params={"token": owner_token})
+
+    # Чаты, собеседники, последние сообщения, непрочитанные — без запроса на каждый чат
+    with assert_max_queries(4, "GET /me/directs"):
+        response = client.get("/me/directs", params={"token": owner_token})
+
+    assert response.status_code == 200
+    chats = response.json()
+    assert len(chats) == 8
+    assert {chat["last_message"] for chat in chats} == {f"hello {i}" for i in range(8)}
+    assert all(chat["unread_count"] == 1 for chat in chats)
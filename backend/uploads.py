@@ -0,0 +1,94 @@
+import asyncio
+import os
+from typing import AsyncIterator, Optional
+
+from starlette.requests import ClientDisconnect
+
+
+UPLOAD_DIR = "uploads"
+# Недокачанные файлы лежат отдельно, чтобы их не раздавал /uploads
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR", "uploads_tmp")
+UPLOAD_MAX_SIZE = int(os.getenv("UPLOAD_MAX_SIZE", str(100 * 1024 * 1024)))
+UPLOAD_CHUNK_MAX = int(os.getenv("UPLOAD_CHUNK_MAX", str(8 * 1024 * 1024)))
+
+ALLOWED_UPLOAD_TYPES = ("image/jpeg", "image/png", "image/gif", "image/webp")
+# /uploads раздаёт файлы по расширению: .html или .svg стали бы XSS на нашем origin
+ALLOWED_UPLOAD_EXTENSIONS = ("jpg", "jpeg", "png", "gif", "webp")
+
+# Столько байт копим из тела запроса перед записью на диск (запись — в отдельном потоке)
+UPLOAD_WRITE_BUFFER = 256 * 1024
+
+os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+
+# Один PUT на загрузку за раз, иначе куски перемешаются
+upload_locks: dict[str, asyncio.Lock] = {}
+
+
+def temp_path(upload_id: str) -> str:
+    return os.path.join(UPLOAD_TMP_DIR, f"{upload_id}.part")
+
+
+def file_extension(filename: str) -> Optional[str]:
+    """Расширение для сохранённого файла. None — не из списка разрешённых"""
+    extension = filename.rsplit(".", 1)[-1].lower() if "." in filename else "jpg"
+    return extension if extension in ALLOWED_UPLOAD_EXTENSIONS else None
+
+
+def create_temp_file(upload_id: str):
+    open(temp_path(upload_id), "wb").close()
+
+
+async def write_chunk(upload_id: str, offset: int, chunks: AsyncIterator[bytes], max_bytes: int) -> tuple[int, bool]:
+    """Записать тело запроса в файл загрузки начиная с offset, не держа его в памяти.
+
+    Возвращает (сколько байт записано, превышен ли max_bytes). Если клиент
+    оборвался посреди куска, записанное сохраняется — докачка продолжится с него.
+    """
+    written = 0
+    too_large = False
+    buffer = bytearray()
+    # Файловые вызовы блокируют — уводим их с event loop
+    f = await asyncio.to_thread(open, temp_path(upload_id), "r+b")
+    try:
+        # Хвост после offset — от оборванной попытки, которую мы не засчитали
+        await asyncio.to_thread(_seek_truncate, f, offset)
+        try:
+            async for piece in chunks:
+                if written + len(piece) > max_bytes:
+                    buffer += piece[:max_bytes - written]
+                    written = max_bytes
+                    too_large = True
+                    break
+                buffer += piece
+                written += len(piece)
+                if len(buffer) >= UPLOAD_WRITE_BUFFER:
+                    await asyncio.to_thread(f.write, bytes(buffer))
+                    buffer.clear()
+        except ClientDisconnect:
+            pass
+        if buffer:
+            await asyncio.to_thread(f.write, bytes(buffer))
+    finally:
+        await asyncio.to_thread(f.close)
+    return written, too_large
+
+
+def _seek_truncate(f, offset: int):
+    f.seek(offset)
+    f.truncate()
+
+
+def finalize(upload_id: str, filename: str) -> str:
+    """Переместить собранный файл к остальным загрузкам (rename, без копирования). Возвращает URL"""
+    # Сессии, начатые до проверки расширения, сохраняются как jpg
+    final_name = f"{upload_id}.{file_extension(filename) or 'jpg'}"
+    os.replace(temp_path(upload_id), os.path.join(UPLOAD_DIR, final_name))
+    return f"/uploads/{final_name}"
+
+
+def discard(upload_id: str):
+    upload_locks.pop(upload_id, None)
+    try:
+        os.remove(temp_path(upload_id))
+    except FileNotFoundError:
+        pass
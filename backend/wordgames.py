@@ -0,0 +1,335 @@
+import os
+import random
+import sys
+from array import array
+from typing import Optional
+
+
+DECKS_DIR = os.getenv("DECKS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "decks"))
+
+WORD_GAMES = ("who_am_i", "alias", "codenames")
+DIFFICULTIES = ("easy", "medium", "hard")
+
+CODENAMES_BOARD = 25
+# 9 карт у команды, которая ходит первой, 8 у второй, 7 нейтральных и убийца
+CODENAMES_KEY = ["red"] * 9 + ["blue"] * 8 + ["neutral"] * 7 + ["assassin"]
+
+
+class WordGameError(Exception):
+    pass
+
+
+# ============ КОЛОДЫ ============
+
+class WordDecks:
+    """Все колоды в одном общем индексе.
+
+    Каждое слово хранится один раз (интернированная строка в общем списке),
+    колода (язык, сложность) — array с номерами слов, 4 байта на карту.
+    Загружается один раз на процесс; игровые сессии хранят только
+    номера, а не свои копии списков.
+    """
+
+    def __init__(self):
+        self.words: list[str] = []
+        self.word_ids: dict[str, int] = {}
+        self.decks: dict[tuple[str, str], array] = {}
+
+    @property
+    def loaded(self) -> bool:
+        return bool(self.decks)
+
+    def load(self, directory: str = DECKS_DIR):
+        """decks/<язык>/<сложность>.txt, по слову в строке"""
+        for language in sorted(os.listdir(directory)):
+            language_dir = os.path.join(directory, language)
+            if not os.path.isdir(language_dir):
+                continue
+            for difficulty in DIFFICULTIES:
+                path = os.path.join(language_dir, f"{difficulty}.txt")
+                if not os.path.exists(path):
+                    continue
+                ids = array("I")
+                with open(path, encoding="utf-8") as f:
+                    for line in f:
+                        word = line.strip()
+                        if word:
+                            ids.append(self._intern(word))
+                self.decks[(language, difficulty)] = ids
+
+    def _intern(self, word: str) -> int:
+        word_id = self.word_ids.get(word)
+        if word_id is None:
+            word_id = self.word_ids[word] = len(self.words)
+            self.words.append(sys.intern(word))
+        return word_id
+
+    def deck(self, language: str, difficulty: str) -> array:
+        if not self.loaded:
+            self.load()
+        deck = self.decks.get((language, difficulty))
+        if deck is None:
+            raise WordGameError("Нет такой колоды")
+        return deck
+
+    def languages(self) -> list[str]:
+        return sorted({language for language, _ in self.decks})
+
+
+word_decks = WordDecks()
+
+
+class DeckSampler:
+    """Карты из колоды без повторов, O(1) на карту.
+
+    Ленивый Фишер–Йетс: колоду не копируем и не перемешиваем целиком,
+    а помним только сделанные перестановки. Состояние сериализуется
+    в GameSession.data и занимает O(вытянутых карт).
+    """
+
+    def __init__(self, language: str, difficulty: str, remaining: Optional[int] = None,
+                 swaps: Optional[dict[int, int]] = None):
+        self.language = language
+        self.difficulty = difficulty
+        self.deck = word_decks.deck(language, difficulty)
+        self.remaining = len(self.deck) if remaining is None else remaining
+        self.swaps = swaps or {}
+
+    def draw(self) -> str:
+        if self.remaining == 0:
+            raise WordGameError("Колода закончилась")
+        last = self.remaining - 1
+        position = random.randint(0, last)
+        picked = self.swaps.get(position, position)
+        # На место вытянутой карты ставим последнюю из ещё не вытянутых
+        self.swaps[position] = self.swaps.pop(last, last)
+        if position == last:
+            self.swaps.pop(position, None)
+        self.remaining = last
+        return word_decks.words[self.deck[picked]]
+
+    def to_dict(self) -> dict:
+        return {
+            "language": self.language,
+            "difficulty": self.difficulty,
+            "remaining": self.remaining,
+            "swaps": {str(k): v for k, v in self.swaps.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DeckSampler":
+        swaps = {int(k): v for k, v in data["swaps"].items()}
+        return cls(data["language"], data["difficulty"], data["remaining"], swaps)
+
+
+def _text(data: dict, key: str, default: str = "") -> str:
+    """Строковое поле из data клиента: число или null вместо строки — ошибка ввода, а не 500"""
+    value = data.get(key, default)
+    if not isinstance(value, str):
+        raise WordGameError(f"Поле {key} должно быть строкой")
+    return value
+
+
+def _new_sampler(data: dict) -> DeckSampler:
+    language = _text(data, "language", "ru")
+    difficulty = _text(data, "difficulty", "easy")
+    if difficulty not in DIFFICULTIES:
+        raise WordGameError("Неизвестная сложность")
+    return DeckSampler(language, difficulty)
+
+
+def _same_word(a: str, b: str) -> bool:
+    return a.strip().casefold().replace("ё", "е") == b.strip().casefold().replace("ё", "е")
+
+
+# ============ КТО Я ============
+
+def _who_am_i(state: dict, action: str, data: dict, user_id: int, players: list[int]) -> tuple[dict, dict]:
+    if action == "deal":
+        if "cards" in state:
+            raise WordGameError("Карты уже розданы")
+        sampler = _new_sampler(data)
+        state["cards"] = {str(player_id): sampler.draw() for player_id in players}
+        state["guessed"] = []
+        state["deck"] = sampler.to_dict()
+        return {"action": "deal", "players": len(players)}, {}
+
+    if "cards" not in state:
+        raise WordGameError("Карты ещё не розданы")
+
+    if action == "state":
+        # Своё слово игрок не видит — его и надо угадать
+        return {
+            "action": "state",
+            "cards": {pid: word for pid, word in state["cards"].items() if pid != str(user_id)},
+            "guessed": state["guessed"],
+        }, {}
+
+    if action == "guess":
+        if user_id in state["guessed"]:
+            raise WordGameError("Вы уже угадали")
+        word = state["cards"].get(str(user_id))
+        if word is None:
+            raise WordGameError("Вы не участвуете в игре")
+        if not _same_word(_text(data, "word"), word):
+            return {"action": "guess", "correct": False}, {}
+
+        state["guessed"].append(user_id)
+        # Кто угадал раньше — получает больше очков
+        points = len(players) - len(state["guessed"]) + 1
+        if len(state["guessed"]) == len(state["cards"]):
+            state["winner_ids"] = [state["guessed"][0]]
+        return {"action": "guess", "correct": True, "word": word, "points": points,
+                "finished": "winner_ids" in state}, {user_id: points}
+
+    raise WordGameError("Неизвестное действие")
+
+
+# ============ ЭЛИАС ============
+
+def _alias(state: dict, action: str, data: dict, user_id: int, players: list[int]) -> tuple[dict, dict]:
+    if action == "start":
+        if "deck" in state:
+            raise WordGameError("Игра уже идёт")
+        state["deck"] = _new_sampler(data).to_dict()
+        state["explainer"] = None
+        state["word"] = None
+        return {"action": "start"}, {}
+
+    if "deck" not in state:
+        raise WordGameError("Игра ещё не началась")
+
+    if action == "state":
+        return {"action": "state", "explainer": state["explainer"], "remaining": state["deck"]["remaining"]}, {}
+
+    if action in ("draw", "guessed", "skip"):
+        scores = {}
+        if action != "draw":
+            if state["explainer"] != user_id or state["word"] is None:
+                raise WordGameError("Сейчас объясняет другой игрок")
+            if action == "guessed":
+                scores[user_id] = 1
+        elif state["word"] is not None and state["explainer"] != user_id:
+            raise WordGameError("Сейчас объясняет другой игрок")
+
+        sampler = DeckSampler.from_dict(state["deck"])
+        try:
+            word = sampler.draw()
+        except WordGameError:
+            state["word"] = None
+            state["winner_ids"] = []
+            return {"action": action, "word": None, "finished": True}, scores
+        state["deck"] = sampler.to_dict()
+        state["explainer"] = user_id
+        state["word"] = word
+        # Слово уходит только объясняющему — в ответе на его запрос
+        return {"action": action, "word": word, "remaining": sampler.remaining}, scores
+
+    if action == "finish":
+        if state["explainer"] == user_id:
+            state["word"] = None
+            state["explainer"] = None
+        return {"action": "finish"}, {}
+
+    raise WordGameError("Неизвестное действие")
+
+
+# ============ КОДОВЫЕ ИМЕНА ============
+
+def _codenames_view(state: dict, user_id: int) -> dict:
+    spymaster = user_id in state["spymasters"].values()
+    return {
+        "board": state["board"],
+        "revealed": [color if opened else None for color, opened in zip(state["key"], state["revealed"])],
+        "key": state["key"] if spymaster else None,
+        "teams": state["teams"],
+        "spymasters": state["spymasters"],
+        "turn": state["turn"],
+        "winner": state.get("winner"),
+    }
+
+
+def _codenames(state: dict, action: str, data: dict, user_id: int, players: list[int]) -> tuple[dict, dict]:
+    if action == "deal":
+        if "board" in state:
+            raise WordGameError("Поле уже разложено")
+        if len(players) < 4:
+            raise WordGameError("Нужно минимум 4 игрока")
+        sampler = _new_sampler(data)
+        if sampler.remaining < CODENAMES_BOARD:
+            raise WordGameError("В колоде мало слов")
+        key = CODENAMES_KEY[:]
+        random.shuffle(key)
+        # Команды по порядку входа, первый в каждой — капитан
+        teams = {str(player_id): ("red" if i % 2 == 0 else "blue") for i, player_id in enumerate(players)}
+        state.update(
+            board=[sampler.draw() for _ in range(CODENAMES_BOARD)],
+            key=key,
+            revealed=[False] * CODENAMES_BOARD,
+            teams=teams,
+            spymasters={"red": players[0], "blue": players[1]},
+            turn="red",
+        )
+        return {"action": "deal", **_codenames_view(state, user_id)}, {}
+
+    if "board" not in state:
+        raise WordGameError("Поле ещё не разложено")
+
+    if action == "state":
+        return {"action": "state", **_codenames_view(state, user_id)}, {}
+
+    if state.get("winner"):
+        raise WordGameError("Игра окончена")
+
+    team = state["teams"].get(str(user_id))
+    if team != state["turn"] or user_id == state["spymasters"][team]:
+        raise WordGameError("Сейчас не ваш ход")
+    other = "blue" if team == "red" else "red"
+
+    if action == "pass":
+        state["turn"] = other
+        return {"action": "pass", **_codenames_view(state, user_id)}, {}
+
+    if action == "reveal":
+        index = data.get("index")
+        if not isinstance(index, int) or isinstance(index, bool) or not 0 <= index < CODENAMES_BOARD or state["revealed"][index]:
+            raise WordGameError("Неверная карта")
+        state["revealed"][index] = True
+        color = state["key"][index]
+        scores = {}
+
+        if color == "assassin":
+            state["winner"] = other
+        elif color == team:
+            scores[user_id] = 1
+        else:
+            state["turn"] = other
+
+        for side in ("red", "blue"):
+            if all(opened for c, opened in zip(state["key"], state["revealed"]) if c == side):
+                state["winner"] = side
+        if state.get("winner"):
+            state["winner_ids"] = [int(pid) for pid, t in state["teams"].items() if t == state["winner"]]
+
+        return {"action": "reveal", "index": index, "color": color, **_codenames_view(state, user_id)}, scores
+
+    raise WordGameError("Неизвестное действие")
+
+
+_HANDLERS = {
+    "who_am_i": _who_am_i,
+    "alias": _alias,
+    "codenames": _codenames,
+}
+
+
+def play(game_type: str, state: dict, action: str, data: dict, user_id: int, players: list[int]) -> tuple[dict, dict]:
+    """Выполнить действие в словесной игре.
+
+    state (GameSession.data) меняется на месте. Возвращает ответ игроку
+    и прибавку очков {user_id: очки}. Когда игра окончена, в state
+    появляется winner_ids.
+    """
+    if user_id not in players:
+        raise WordGameError("Вы не участвуете в игре")
+    return _HANDLERS[game_type](state, action, data, user_id, players)
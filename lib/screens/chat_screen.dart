@@ -1,3 +1,4 @@
+import 'dart:async';
 import 'dart:convert';
 import 'package:flutter/material.dart';
 import 'package:flutter/services.dart';
@@ -42,6 +43,8 @@ class _ChatScreenState extends State<ChatScreen> with TickerProviderStateMixin {
   late Animation<double> _fadeAnimation;
 
   WebSocketChannel? _channel;
+  Duration? _reconnectAfter;
+  Timer? _reconnectTimer;
   String _myUsername = '';
   bool _isConnected = false;
   bool _isTyping = false;
@@ -95,13 +98,19 @@ class _ChatScreenState extends State<ChatScreen> with TickerProviderStateMixin {
     });
 
     const baseUrl = '26.81.184.119:8000';
-    final wsUrl = 'ws://$baseUrl/ws/dm/${widget.chatId}?token=${widget.token}';
+    final wsUrl =
+        'ws://$baseUrl/ws/dm/${widget.chatId}?token=${widget.token}&reconnect_hint=1';
 
     _channel = WebSocketChannel.connect(Uri.parse(wsUrl));
 
     _channel!.stream.listen(
       (message) {
         final decoded = jsonDecode(message);
+        if (decoded['type'] == 'reconnect') {
+          // Сервер перезапускается: переподключимся после паузы, которую он назначил
+          _reconnectAfter = Duration(milliseconds: decoded['after_ms'] ?? 1000);
+          return;
+        }
         if (decoded['type'] == 'messages_read') {
           // Обновляем статус сообщений
           setState(() {
@@ -128,7 +137,15 @@ class _ChatScreenState extends State<ChatScreen> with TickerProviderStateMixin {
         setState(() => _isConnected = false);
       },
       onDone: () {
+        if (!mounted) return;
         setState(() => _isConnected = false);
+        final delay = _reconnectAfter;
+        if (delay != null) {
+          _reconnectAfter = null;
+          _reconnectTimer = Timer(delay, () {
+            if (mounted) _initChat();
+          });
+        }
       },
     );
   }
@@ -295,6 +312,7 @@ class _ChatScreenState extends State<ChatScreen> with TickerProviderStateMixin {
 
   @override
   void dispose() {
+    _reconnectTimer?.cancel();
     _channel?.sink.close();
     _controller.dispose();
     _scrollController.dispose();